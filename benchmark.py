@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" MiLight Control Interface benchmarks
+
+Drives the MCI (Group.send_commands, apply2grps and the commandline utility) against fake
+bridges on the loopback interface, and reports the packets per second each bridge received,
+how late the commands were sent compared to their scheduled time, how long they waited in the
+queue, and the wall time of milight.py calls. The results are printed as JSON, to compare them
+between commits.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from concurrent.futures import wait
+from threading import Condition
+
+import mci
+from fakebridge import FakeBridge
+
+class Recorder(object):
+    """ Records the queue and send times of the commands of \"bridge\" """
+    def __init__(self, bridge):
+        """ init """
+        self.bridge = bridge
+        self.condition = Condition()
+        self.pending = 0
+        # seconds between the scheduled and the actual send time of each command
+        self.lateness = list()
+        # seconds between queueing and sending each command
+        self.queue_wait = list()
+        put = bridge.scheduler.put
+        def record_put(command):
+            queued = time.monotonic()
+            done = command.done
+            def record_done(sent):
+                if sent:
+                    # dispatch calls done right after sending the packet
+                    now = time.monotonic()
+                    self.lateness.append(now - command.when)
+                    self.queue_wait.append(now - queued)
+                with self.condition:
+                    self.pending -= 1
+                    self.condition.notify_all()
+                if done is not None:
+                    done(sent)
+            command.done = record_done
+            with self.condition:
+                self.pending += 1
+            put(command)
+        bridge.scheduler.put = record_put
+
+    def wait(self, timeout=None):
+        """ Wait until all recorded commands have been sent (or dropped) """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.pending == 0, timeout)
+
+def percentiles(values, scale=1000.0):
+    """ return the p50, p99 and max of \"values\" (multiplied by \"scale\", default: to ms) """
+    if not values:
+        return None
+    values = sorted(values)
+    def rank(p):
+        return values[min(len(values) - 1, int(p * len(values)))] * scale
+    return {'p50': rank(0.50), 'p99': rank(0.99), 'max': values[-1] * scale}
+
+def packet_rate(fake):
+    """ return the number of packets per second received by \"fake\" """
+    times = [t for (t, _, _) in fake.packets]
+    if len(times) < 2:
+        return None
+    return (len(times) - 1) / (times[-1] - times[0])
+
+def run(name, nbridges, pause, action, precise=False):
+    """ Run scenario \"name\": action(groups) is called with one WhiteGroup (group 1 to 4) per
+    bridge, and returns the futures to wait for. With \"precise\" the bridges use precise
+    timing (see Bridge.enable_precise_timing). Returns the results as a dict. """
+    fakes = [FakeBridge(port=0, discovery_port=None).start() for _ in range(nbridges)]
+    try:
+        groups = list()
+        recorders = list()
+        for fake in fakes:
+            bridge_groups = [mci.WhiteGroup(fake.ip_address, fake.port, pause, group=g) for g in range(1, 5)]
+            recorders.append(Recorder(bridge_groups[0].bridge))
+            if precise:
+                bridge_groups[0].bridge.enable_precise_timing()
+            groups.append(bridge_groups)
+        start = time.monotonic()
+        wait(action(groups))
+        for recorder in recorders:
+            recorder.wait(60)
+        wall_time = time.monotonic() - start
+        time.sleep(pause)  # let the fake bridges receive the last packets
+        return {
+            'scenario': name,
+            'commands': sum(len(r.lateness) for r in recorders),
+            'wall_time_s': wall_time,
+            'bridges': [{'packets': len(fake.packets), 'packets_per_second': packet_rate(fake)} for fake in fakes],
+            'lateness_ms': percentiles([x for r in recorders for x in r.lateness]),
+            'queue_wait_ms': percentiles([x for r in recorders for x in r.queue_wait]),
+        }
+    finally:
+        for fake in fakes:
+            fake.stop()
+
+def run_cli(runs):
+    """ Time \"runs\" calls of milight.py (executing locally, not through a daemon) """
+    milight = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'milight.py')
+    with FakeBridge(port=0, discovery_port=None) as fake:
+        times = list()
+        for _ in range(runs):
+            start = time.monotonic()
+            subprocess.check_call([sys.executable, milight, '--local', '-i', fake.ip_address,
+                                   '-P', str(fake.port), '-w', '1', '--on'])
+            times.append(time.monotonic() - start)
+        received = len(fake.packets)
+    result = percentiles(times)
+    result['mean'] = 1000.0 * sum(times) / len(times)
+    return {'scenario': 'cli', 'runs': runs, 'packets': received, 'wall_time_ms': result}
+
+def commit():
+    """ return the git commit of the MCI, or None """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    """ Main. """
+    parser = argparse.ArgumentParser(description='MiLight Control Interface benchmarks')
+    parser.add_argument('-s', '--steps', action='store', dest='steps', type=int, default=50,
+                        help='Number of steps per action (default: 50)')
+    parser.add_argument('-p', '--pause', action='store', dest='pause', type=float, default=0.1,
+                        help='Pause between packets, in seconds (default: 0.1)')
+    parser.add_argument('-b', '--bridges', action='store', dest='bridges', type=int, default=2,
+                        help='Number of bridges for the parallel scenario (default: 2)')
+    parser.add_argument('-r', '--cli_runs', action='store', dest='cli_runs', type=int, default=5,
+                        help='Number of milight.py calls to time, 0 to skip (default: 5)')
+    parser.add_argument('-d', '--dispatcher', action='store_true', dest='dispatcher', default=False,
+                        help='Send from a single Dispatcher thread instead of a thread per bridge')
+    parser.add_argument('-t', '--precise', action='store_true', dest='precise', default=False,
+                        help='Use precise timing (sleep, then spin until a packet is due)')
+    parser.add_argument('-o', '--output', action='store', dest='output', default=None,
+                        help='Write the results to this file (default: stdout)')
+    args = parser.parse_args()
+    steps = args.steps
+    if args.dispatcher:
+        mci.Dispatcher.install()
+
+    results = [
+        run('send_commands', 1, args.pause,
+            lambda groups: [groups[0][0].increase_brightness(steps)], args.precise),
+        run('send_commands_parallel', args.bridges, args.pause,
+            lambda groups: [grps[0].increase_brightness(steps, interleave=True) for grps in groups], args.precise),
+        run('send_commands_interleaved', 1, args.pause,
+            lambda groups: [grp.increase_brightness(steps // 4, interleave=True) for grp in groups[0]], args.precise),
+        run('apply2grps', 1, args.pause,
+            lambda groups: [mci.apply2grps(groups[0], 'increase_brightness', 0, [steps // 4])], args.precise),
+        run('apply2grps_fanout', args.bridges, args.pause,
+            lambda groups: [mci.apply2grps([g for grps in groups for g in grps], 'increase_brightness', 0,
+                                           [steps // 4], fanout=True)], args.precise),
+    ]
+    if args.cli_runs > 0:
+        results.append(run_cli(args.cli_runs))
+    report = {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'time': time.time(),
+        'steps': steps,
+        'pause_s': args.pause,
+        'dispatcher': args.dispatcher,
+        'precise': args.precise,
+        'results': results,
+    }
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" MiLight fake Wifi Bridge
+
+A local stand-in for the (v4.0) Wifi Bridge, to test the MiLight Control Interface without
+hardware. It listens for commands on the bridge port (8899) and decodes them with the command
+set of ColorGroup and WhiteGroup, keeping the state of each group of bulbs. Every packet is
+timestamped, and packet loss, jitter and the minimum time the bridge needs between packets
+can be simulated. Discovery messages ("Link_Wi-Fi") are answered like a real bridge does.
+"""
+
+import argparse
+import random
+import socket
+import time
+from threading import Thread, Lock
+
+import mci
+
+GROUPS = ('1', '2', '3', '4')
+
+class FakeBridge(object):
+    """ A fake Wifi Bridge, listening on (ip_address, port) for commands and on
+    (ip_address, discovery_port) for discovery messages (None to disable).
+
+    - loss: probability that a packet is lost
+    - jitter: maximum (random) time the bridge takes to process a packet, in seconds
+    - min_gap: packets that arrive less than min_gap seconds after the previous one are dropped
+
+    Use port=0 (and discovery_port=0) to listen on a free port, see address. The packets
+    received are kept in self.packets as (time, packet, description) tuples.
+    """
+    # decoding tables: opcode -> (kind, action, group)
+    OPCODES = dict()
+    for (group, command) in mci.ColorGroup.GROUP_ON.items():
+        OPCODES[command[0]] = ('RGBW', 'on', group)
+    for (group, command) in mci.ColorGroup.GROUP_OFF.items():
+        OPCODES[command[0]] = ('RGBW', 'off', group)
+    for (group, command) in mci.ColorGroup.GROUP_WHITE.items():
+        OPCODES[command[0]] = ('RGBW', 'white', group)
+    OPCODES[mci.ColorGroup.BRIGHTNESS[0]] = ('RGBW', 'brightness', None)
+    OPCODES[mci.ColorGroup.COLOR[0]] = ('RGBW', 'color', None)
+    OPCODES[mci.ColorGroup.DISCO_MODE[0]] = ('RGBW', 'disco', None)
+    OPCODES[mci.ColorGroup.DISCO_SPEED_FASTER[0]] = ('RGBW', 'disco faster', None)
+    OPCODES[mci.ColorGroup.DISCO_SPEED_SLOWER[0]] = ('RGBW', 'disco slower', None)
+    for (group, command) in mci.WhiteGroup.GROUP_ON.items():
+        OPCODES[command[0]] = ('WHITE', 'on', group)
+    for (group, command) in mci.WhiteGroup.GROUP_OFF.items():
+        OPCODES[command[0]] = ('WHITE', 'off', group)
+    for (group, command) in mci.WhiteGroup.FULL_BRIGHTNESS.items():
+        OPCODES[command[0]] = ('WHITE', 'brightmode', group)
+    for (group, command) in mci.WhiteGroup.NIGHT_MODE.items():
+        OPCODES[command[0]] = ('WHITE', 'nightmode', group)
+    OPCODES[mci.WhiteGroup.BRIGHTNESS_UP[0]] = ('WHITE', 'brightness up', None)
+    OPCODES[mci.WhiteGroup.BRIGHTNESS_DOWN[0]] = ('WHITE', 'brightness down', None)
+    OPCODES[mci.WhiteGroup.WARM_WHITE_INCREASE[0]] = ('WHITE', 'warmer', None)
+    OPCODES[mci.WhiteGroup.COOL_WHITE_INCREASE[0]] = ('WHITE', 'cooler', None)
+    del group, command
+    # names of the disco modes, by the number of DISCO_MODE commands in their code
+    DISCO_NAMES = dict((len(code) // 2, name.lower()) for (name, code) in mci.ColorGroup.DISCO_CODES.items())
+    # number of white brightness and warmth levels
+    WHITE_LEVELS = 10
+
+    def __init__(self, ip_address='127.0.0.1', port=8899, discovery_port=48899,
+                 mac='ACCF23000000', loss=0.0, jitter=0.0, min_gap=0.0):
+        """ init """
+        self.ip_address = ip_address
+        self.mac = mac
+        self.loss = loss
+        self.jitter = jitter
+        self.min_gap = min_gap
+        self.lock = Lock()
+        self.packets = list()
+        # number of packets received, lost (simulated) and dropped because they came too fast
+        self.received = 0
+        self.lost = 0
+        self.too_fast = 0
+        self._last_time = None
+        self.reset()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((ip_address, port))
+        self.port = self.sock.getsockname()[1]
+        self.discovery_sock = None
+        self.discovery_port = None
+        if discovery_port is not None:
+            self.discovery_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.discovery_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+            self.discovery_sock.bind(('', discovery_port))
+            self.discovery_port = self.discovery_sock.getsockname()[1]
+        self._threads = list()
+        self.running = False
+
+    def get_address(self):
+        return (self.ip_address, self.port)
+    address = property(get_address)
+
+    def reset(self):
+        """ Reset the state of all groups (all off) and the selected groups """
+        with self.lock:
+            self.groups = dict()
+            for kind in ('RGBW', 'WHITE'):
+                for group in GROUPS:
+                    if kind == 'RGBW':
+                        self.groups[(kind, group)] = {'on': False, 'mode': 'white', 'color': 0,
+                                                      'brightness': 25, 'disco': 0, 'speed': 0}
+                    else:
+                        self.groups[(kind, group)] = {'on': False, 'night': False,
+                                                      'brightness': self.WHITE_LEVELS, 'warmth': 0}
+            self.selected = {'RGBW': None, 'WHITE': None}
+
+    def state(self, kind, group):
+        """ return (a copy of) the state of \"group\" ('1' to '4') of \"kind\" ('RGBW' or 'WHITE') """
+        with self.lock:
+            return dict(self.groups[(kind, str(group))])
+
+    def start(self):
+        """ Start listening (in background threads) """
+        self.running = True
+        for sock in (self.sock, self.discovery_sock):
+            if sock is not None:
+                sock.settimeout(0.1)
+        self._threads = [Thread(target=self.serve, daemon=True)]
+        if self.discovery_sock is not None:
+            self._threads.append(Thread(target=self.serve_discovery, daemon=True))
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        """ Stop listening """
+        self.running = False
+        for thread in self._threads:
+            thread.join()
+        for sock in (self.sock, self.discovery_sock):
+            if sock is not None:
+                sock.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def serve(self):
+        """ Receive and process commands """
+        while self.running:
+            try:
+                (packet, _) = self.sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            self.receive(packet, time.time())
+
+    def serve_discovery(self):
+        """ Answer discovery messages """
+        while self.running:
+            try:
+                (message, sender) = self.discovery_sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if message == b"Link_Wi-Fi":
+                reply = self.ip_address + ',' + self.mac + ','
+                self.discovery_sock.sendto(reply.encode('utf-8'), sender)
+
+    def receive(self, packet, received):
+        """ Process \"packet\" which was received at (epoch) time \"received\" """
+        with self.lock:
+            self.received += 1
+            if self.loss and (random.random() < self.loss):
+                self.lost += 1
+                self.packets.append((received, packet, 'lost'))
+                return
+        if self.jitter:
+            time.sleep(random.uniform(0, self.jitter))
+        now = time.monotonic()
+        with self.lock:
+            if (self._last_time is not None) and (now - self._last_time < self.min_gap):
+                self.too_fast += 1
+                self.packets.append((received, packet, 'too fast'))
+                return
+            self._last_time = now
+            self.packets.append((received, packet, '; '.join(self.process(packet))))
+
+    @staticmethod
+    def split(packet):
+        """ return the (opcode, value) pairs in \"packet\": a single command (3 bytes, ending with
+        0x55), or a sequence of 2 byte commands (like ColorGroup.DISCO_CODE) """
+        if (len(packet) == 3) and (packet[2] == 0x55):
+            return [(packet[0], packet[1])]
+        return [(packet[i], packet[i + 1] if i + 1 < len(packet) else 0) for i in range(0, len(packet), 2)]
+
+    def process(self, packet):
+        """ Apply the commands in \"packet\" to the state (with the lock held), returns their descriptions """
+        return [self.apply(opcode, value) for (opcode, value) in self.split(packet)]
+
+    def apply(self, opcode, value):
+        """ Apply one command, returns its description """
+        decoded = self.OPCODES.get(opcode)
+        if decoded is None:
+            return 'unknown 0x%02X 0x%02X' % (opcode, value)
+        (kind, action, group) = decoded
+        if action in ('on', 'off'):
+            # on/off commands select the group for the commands that follow
+            self.selected[kind] = group
+        if group is None:
+            group = self.selected[kind]
+            if group is None:
+                return '%s %s (no group selected)' % (kind, action)
+        groups = GROUPS if group == 'ALL' else (group,)
+        for g in groups:
+            state = self.groups[(kind, g)]
+            if kind == 'RGBW':
+                self.apply_rgbw(state, action, value)
+            else:
+                self.apply_white(state, action)
+        if action == 'brightness':
+            return '%s %s brightness %d' % (kind, group, value - 2)
+        if action == 'color':
+            return '%s %s color %d' % (kind, group, value)
+        if action == 'disco':
+            return '%s %s %s' % (kind, group, self.groups[(kind, groups[0])]['mode'])
+        return '%s %s %s' % (kind, group, action)
+
+    def apply_rgbw(self, state, action, value):
+        """ Apply an RGBW command to the state of one group """
+        if action == 'on':
+            state['on'] = True
+        elif action == 'off':
+            state['on'] = False
+        elif not state['on']:
+            return  # the bulbs ignore other commands while they are off
+        elif action == 'white':
+            state['mode'] = 'white'
+            state['disco'] = 0
+        elif action == 'color':
+            state['mode'] = 'color %d' % value
+            state['color'] = value
+            state['disco'] = 0
+        elif action == 'brightness':
+            state['brightness'] = max(0, min(25, value - 2))
+        elif action == 'disco':
+            state['disco'] = state['disco'] % len(self.DISCO_NAMES) + 1
+            state['mode'] = 'disco ' + self.DISCO_NAMES[state['disco']]
+        elif action == 'disco faster':
+            state['speed'] += 1
+        elif action == 'disco slower':
+            state['speed'] -= 1
+
+    def apply_white(self, state, action):
+        """ Apply a White command to the state of one group """
+        if action == 'on':
+            state['on'] = True
+            state['night'] = False
+        elif action == 'off':
+            state['on'] = False
+        elif action == 'nightmode':
+            # night mode is sent after the off command of the group
+            state['on'] = True
+            state['night'] = True
+        elif not state['on']:
+            return
+        elif action == 'brightmode':
+            state['brightness'] = self.WHITE_LEVELS
+            state['night'] = False
+        elif action == 'brightness up':
+            state['brightness'] = min(self.WHITE_LEVELS, state['brightness'] + 1)
+        elif action == 'brightness down':
+            state['brightness'] = max(1, state['brightness'] - 1)
+        elif action == 'warmer':
+            state['warmth'] = min(self.WHITE_LEVELS, state['warmth'] + 1)
+        elif action == 'cooler':
+            state['warmth'] = max(-self.WHITE_LEVELS, state['warmth'] - 1)
+
+def main():
+    """ Main. """
+    parser = argparse.ArgumentParser(description='Fake MiLight Wifi Bridge')
+    parser.add_argument('-i', '--ip_address', action='store', dest='address', default='127.0.0.1',
+                        help='IP address to listen on (default: 127.0.0.1)')
+    parser.add_argument('-P', '--port', action='store', dest='port', type=int, default=8899,
+                        help='Port number (default: 8899)')
+    parser.add_argument('-D', '--discovery_port', action='store', dest='discovery_port', type=int, default=48899,
+                        help='Port number for discovery (default: 48899)')
+    parser.add_argument('-m', '--mac', action='store', dest='mac', default='ACCF23000000',
+                        help='Mac address reported to discovery (default: ACCF23000000)')
+    parser.add_argument('--loss', action='store', dest='loss', type=float, default=0.0,
+                        help='Probability that a packet is lost (default: 0)')
+    parser.add_argument('--jitter', action='store', dest='jitter', type=float, default=0.0,
+                        help='Maximum time to process a packet, in seconds (default: 0)')
+    parser.add_argument('--min_gap', action='store', dest='min_gap', type=float, default=0.0,
+                        help='Drop packets that arrive within this time (seconds) after the previous one (default: 0)')
+    args = parser.parse_args()
+    bridge = FakeBridge(args.address, args.port, args.discovery_port, args.mac,
+                        args.loss, args.jitter, args.min_gap)
+    print('Fake bridge listening on %s:%d' % bridge.address)
+    bridge.start()
+    start = time.time()
+    shown = 0
+    try:
+        while True:
+            time.sleep(0.05)
+            with bridge.lock:
+                packets = bridge.packets[shown:]
+            shown += len(packets)
+            for (received, packet, description) in packets:
+                print('%10.3f  %-22s %s' % (received - start, packet.hex(), description))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        bridge.stop()
+
+if __name__ == '__main__':
+    main()
@@ -8,73 +8,1939 @@ Based on the documentation from http://www.limitlessled.com/dev/
 
 import socket
 import time
-from queue import PriorityQueue
-from threading import Thread
+import os
+import re
+import json
+import struct
+import heapq
+import selectors
+import types
+import bisect
+from collections import deque
+from threading import Thread, Lock, RLock, Condition, local
+from itertools import count
+from queue import Full
+from concurrent.futures import Future, InvalidStateError, wait
 import inspect
+import colorsys
+import mmap
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # not available on windows, only the default broadcast address is used
+
+# ioctl to get the broadcast address of a network interface (linux)
+SIOCGIFBRDADDR = 0x8919
+MAC_ADDRESS = re.compile('^[0-9A-Fa-f]{2}([:-]?[0-9A-Fa-f]{2}){5}$')
+# hex RGB colors: '#RRGGBB', 'RRGGBB' or '#RGB'
+HEX_COLOR = re.compile('^(#?[0-9A-Fa-f]{6}|#[0-9A-Fa-f]{3})$')
 
 class DiscoverBridge(object):
     """ WIFI Bridge Auto Discovery
 
     - Step 1:Send UDP message to the LAN broadcast IP address and port 48899 => "Link_Wi-Fi"
     - All Wifi bridges on the LAN will respond with their details. Response is "10.10.100.254, ACCF232483E8"
+
+    The message is sent to the broadcast address of every local network interface, and all
+    responses are collected until \"wait_time\" seconds have passed (or the expected bridges
+    have responded). The bridges found are stored in the BridgeCache \"cache\" (default: the
+    default cache, use False to disable).
     """
 
-    def __init__(self, port=48899, wait_time=5):
+    def __init__(self, port=48899, wait_time=5, cache=True):
         """ init """
         self.port = port
         self.wait_time = wait_time
+        if cache is True:
+            cache = BridgeCache.default()
+        self.cache = cache or None
 
-    def discover(self):
-        """ Start discovery """
-        bufferSize = 1024
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, True)
-        sock.settimeout(self.wait_time)
-        sock.sendto(b"Link_Wi-Fi", ("<broadcast>", self.port))
-        found = list()
+    @staticmethod
+    def broadcast_addresses():
+        """ return the broadcast addresses of the local (IPv4) network interfaces """
+        addresses = ['<broadcast>']
+        if fcntl is None:
+            return addresses
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         try:
-            message = sock.recv(bufferSize)
-            lst = message.decode('utf-8').split(',')
-            if not len(lst) % 2:  # should be odd since the string ends with a ','
-                print('return values false')
-            for i in range(0, int(len(lst)/2)):
-                index = i*2
-                found.append((lst[index], lst[index + 1]))
-        except socket.timeout:
-            print("No server found")
-        sock.close()
+            for (_, name) in socket.if_nameindex():
+                try:
+                    request = struct.pack('256s', name.encode('utf-8')[:15])
+                    address = socket.inet_ntoa(fcntl.ioctl(sock.fileno(), SIOCGIFBRDADDR, request)[20:24])
+                except OSError:
+                    continue  # no IPv4 broadcast address
+                if (address != '0.0.0.0') and (address not in addresses):
+                    addresses.append(address)
+        except OSError:
+            pass
+        finally:
+            sock.close()
+        return addresses
+
+    @staticmethod
+    def parse(message):
+        """ return the (ip address, mac) tuples in a response """
+        lst = message.decode('utf-8').split(',')
+        if not len(lst) % 2:  # should be odd since the string ends with a ','
+            print('return values false')
+        found = list()
+        for i in range(0, int(len(lst)/2)):
+            index = i*2
+            found.append((lst[index].strip(), lst[index + 1].strip()))
         return found
 
+    def discover(self, expected=None, mac=None):
+        """ Start discovery, stop early when \"expected\" bridges or the bridge with mac address
+        \"mac\" have responded. Returns a list of (ip address, mac) tuples. """
+        bufferSize = 1024
+        if mac is not None:
+            mac = normalize_mac(mac)
+        found = dict()
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP) as sock:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, True)
+                deadline = time.monotonic() + self.wait_time
+                for address in self.broadcast_addresses():
+                    try:
+                        sock.sendto(b"Link_Wi-Fi", (address, self.port))
+                    except OSError:
+                        pass  # e.g. interface without route
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    sock.settimeout(remaining)
+                    message = sock.recv(bufferSize)
+                    for (addr, bridge_mac) in self.parse(message):
+                        found[normalize_mac(bridge_mac) or bridge_mac] = addr
+                    if (expected is not None) and (len(found) >= expected):
+                        break
+                    if (mac is not None) and (mac in found):
+                        break
+            except OSError:
+                pass  # the wait time is over (socket.timeout), or e.g. the network is down
+        if not found:
+            print("No server found")
+        elif self.cache is not None:
+            self.cache.update(found)
+        return [(addr, bridge_mac) for (bridge_mac, addr) in found.items()]
+
+def normalize_mac(mac):
+    """ return \"mac\" as 12 upper case hex digits (as reported by the bridges), or None if it
+    isn't a mac address """
+    if (mac is None) or not MAC_ADDRESS.match(mac):
+        return None
+    return re.sub('[^0-9A-F]', '', mac.upper())
+
+def resolve_bridge(address, port=48899):
+    """ Return the ip address of the bridge with mac address \"address\", from the BridgeCache or
+    by discovery. Any other address is returned as it is. """
+    mac = normalize_mac(address)
+    if mac is None:
+        return address
+    ip_address = BridgeCache.default().lookup(mac)
+    if ip_address is None:
+        found = dict((m, a) for (a, m) in DiscoverBridge(port=port).discover(mac=mac))
+        ip_address = found.get(mac)
+    if ip_address is None:
+        raise ValueError('No bridge found with mac address ' + address)
+    return ip_address
+
+class BridgeCache(object):
+    """ On disk cache of discovered bridges, keyed by mac address
+
+    The cache is a json file (default: ~/.cache/milight/bridges.json) mapping mac addresses to
+    the ip address and the (epoch) time the bridge was last seen. Entries older than \"ttl\"
+    seconds are ignored. The file is only read again when it changes.
+    """
+    _default = None
+
+    @classmethod
+    def default(cls):
+        """ return the cache at the default location """
+        if cls._default is None:
+            cls._default = cls()
+        return cls._default
+
+    def __init__(self, path=None, ttl=24*60*60):
+        """ init """
+        if path is None:
+            path = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                                'milight', 'bridges.json')
+        self.path = path
+        self.ttl = ttl
+        self._bridges = dict()
+        self._mtime = None
+
+    def load(self):
+        """ return the cached bridges as a dict: mac -> {'ip': ip address, 'seen': time} """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return self._bridges
+        if mtime != self._mtime:
+            try:
+                with open(self.path) as f:
+                    self._bridges = json.load(f)
+            except (OSError, ValueError):
+                self._bridges = dict()
+            self._mtime = mtime
+        return self._bridges
+
+    def update(self, found):
+        """ Store the bridges in \"found\" (a dict: mac -> ip address) """
+        bridges = dict(self.load())
+        now = time.time()
+        for (mac, ip_address) in found.items():
+            bridges[mac] = {'ip': ip_address, 'seen': now}
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + '.%d' % os.getpid()
+            with open(tmp, 'w') as f:
+                json.dump(bridges, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass  # the cache is an optimisation only
+        self._bridges = bridges
+        self._mtime = None
+
+    def lookup(self, mac):
+        """ return the ip address of the bridge with mac address \"mac\", or None if it isn't
+        cached (or has expired) """
+        entry = self.load().get(normalize_mac(mac) or mac)
+        if (entry is None) or (time.time() - entry['seen'] > self.ttl):
+            return None
+        return entry['ip']
+
+    def bridges(self):
+        """ return the (ip address, mac) tuples of all cached bridges that haven't expired """
+        now = time.time()
+        return [(entry['ip'], mac) for (mac, entry) in sorted(self.load().items())
+                    if now - entry['seen'] <= self.ttl]
+
+def monotonic_time(when):
+    """ Convert the epoch time \"when\" (as returned by time.time()) to the monotonic clock """
+    return time.monotonic() + (when - time.time())
+
+class Command(object):
+    """ A queued command, it can be cancelled until it has been sent
+
+    \"when\" is the time (on the monotonic clock) at which it should be sent, \"select\" is
+    the group selection command to send before it (or None), \"group\" identifies the
+    (kind, group) it was sent to and \"key\" is the state property it sets (or None).
+    Of the commands that are due the one with the highest \"priority\" is sent first, and
+    the command is dropped if it can't be sent before \"deadline\" (monotonic clock, or None).
+    """
+    __slots__ = ('when', 'seq', 'packet', 'select', 'group', 'key', 'done', 'scheduler', 'cancelled', 'queued',
+                 'priority', 'deadline')
+
+    def __init__(self, when, packet, select=None, group=None, done=None, key=None, priority=0, deadline=None):
+        """ init """
+        self.when = when
+        self.priority = priority
+        self.deadline = deadline
+        # set when the command is queued
+        self.seq = None
+        self.packet = packet
+        self.select = select
+        self.group = group
+        # the state property that the command sets (if it sets an absolute value)
+        self.key = key
+        self.done = done
+        # the scheduler the command is queued in, None once it is sent or cancelled
+        self.scheduler = None
+        self.cancelled = False
+        # time (monotonic clock) it was queued, only recorded when metrics are enabled
+        self.queued = None
+
+    def __lt__(self, other):
+        return (self.when, self.seq) < (other.when, other.seq)
+
+    def cancel(self):
+        """ Cancel the command, returns False if it has already been sent (or cancelled) """
+        scheduler = self.scheduler
+        if scheduler is not None:
+            return scheduler.cancel(self)
+        if (self.seq is not None) or self.cancelled:
+            return False
+        # not queued yet
+        self.cancelled = True
+        self.finish(False)
+        return True
+
+    def finish(self, sent):
+        """ Call the \"done\" callback, \"sent\" is False if the command was dropped """
+        if self.done is not None:
+            self.done(sent)
+
+class Scheduler(object):
+    """ Timer heap of Commands ordered on the monotonic clock
+
+    Cancelled commands stay in the heap until they reach the top, \"wakeup\" is called
+    (with the lock held) whenever a new command becomes the first one due. Commands that
+    are due are moved to a second heap ordered on their priority.
+
+    The number of queued commands can be limited to \"maxsize\" (0: no limit), \"policy\"
+    decides what happens to a command queued when it is full (see put).
+    """
+    POLICIES = ('reject', 'drop-oldest', 'supersede')
+
+    def __init__(self, wakeup=None, maxsize=0, policy='reject'):
+        """ init """
+        self.lock = RLock()
+        self.heap = list()
+        # (-priority, when, seq, command) of the commands that are due, once priorities are used
+        self.ready = list()
+        self.prioritised = False
+        self.wakeup = wakeup
+        self.set_limit(maxsize, policy)
+        self._seq = count()
+        # number of commands in the heap that haven't been cancelled
+        self._size = 0
+        # number of queued commands that were cancelled, dropped to make room (shed), dropped
+        # because their deadline had passed, and commands rejected because the queue was full
+        self.dropped = 0
+        self.shed = 0
+        self.expired = 0
+        self.rejected = 0
+
+    def set_limit(self, maxsize=0, policy='reject'):
+        """ Limit the number of queued commands to \"maxsize\" (0: no limit), see put for the policies """
+        if policy not in self.POLICIES:
+            raise ValueError('Unknown overflow policy: ' + str(policy))
+        self.maxsize = maxsize
+        self.policy = policy
+
+    def put(self, command):
+        """ Queue \"command\" (unless it has been cancelled). When the queue is full the policy
+        decides: 'reject' raises queue.Full, 'drop-oldest' drops the command that was queued
+        first, and 'supersede' drops the oldest command for the same group (and raises queue.Full
+        if there is none). """
+        shed = None
+        with self.lock:
+            if command.cancelled:
+                return
+            if self.maxsize and (self._size >= self.maxsize):
+                shed = self._overflow(command)
+                self._remove(shed, dropped=False)
+                self.shed += 1
+            command.seq = next(self._seq)
+            command.scheduler = self
+            heapq.heappush(self.heap, command)
+            self._size += 1
+            if command.priority:
+                self.prioritised = True
+            if ((self.heap[0] is command) or command.priority) and (self.wakeup is not None):
+                self.wakeup()
+        if shed is not None:
+            shed.finish(False)
+
+    def put_many(self, commands):
+        """ Queue all \"commands\" in one operation, returns the number queued (see put for the overflow policies) """
+        with self.lock:
+            commands = [c for c in commands if not c.cancelled]
+            if self.maxsize:
+                for command in commands:
+                    self.put(command)
+                return len(commands)
+            if not commands:
+                return 0
+            first = self.heap[0] if self.heap else None
+            for command in commands:
+                command.seq = next(self._seq)
+                command.scheduler = self
+                if command.priority:
+                    self.prioritised = True
+            self.heap.extend(commands)
+            heapq.heapify(self.heap)
+            self._size += len(commands)
+            if (self.heap[0] is not first) or self.prioritised:
+                if self.wakeup is not None:
+                    self.wakeup()
+            return len(commands)
+
+    def _overflow(self, command):
+        """ return the queued command to drop for \"command\", or raise queue.Full """
+        if self.policy == 'drop-oldest':
+            candidates = self.queued()
+        elif (self.policy == 'supersede') and (command.group is not None):
+            candidates = [c for c in self.queued() if c.group == command.group]
+        else:
+            candidates = None
+        if not candidates:
+            self.rejected += 1
+            raise Full('The command queue is full')
+        return min(candidates, key=lambda c: c.seq)
+
+    def replace(self, command, packet, selected=False):
+        """ Change the packet of \"command\" (with the lock held), which is queued here or, if
+        \"selected\" is True, is the command whose group selection has just been sent. Returns
+        False if that isn't possible because it has been sent or cancelled already. """
+        if command.cancelled or ((command.scheduler is not self) and not selected):
+            return False
+        command.packet = packet
+        return True
+
+    def queued(self):
+        """ return the queued commands (in no particular order) """
+        with self.lock:
+            return ([c for c in self.heap if c.scheduler is self] +
+                    [entry[3] for entry in self.ready if entry[3].scheduler is self])
+
+    def peek(self, now=None):
+        """ Return the command to send next (without removing it), or None if the heap is empty.
+        Of the commands due at \"now\" (default: the current time) the one with the highest
+        priority goes first. """
+        with self.lock:
+            heap = self.heap
+            while heap and (heap[0].scheduler is not self):
+                heapq.heappop(heap)
+            if not self.prioritised:
+                return heap[0] if heap else None
+            if now is None:
+                now = time.monotonic()
+            ready = self.ready
+            while heap and (heap[0].when <= now):
+                command = heapq.heappop(heap)
+                if command.scheduler is self:
+                    heapq.heappush(ready, (-command.priority, command.when, command.seq, command))
+            while ready and (ready[0][3].scheduler is not self):
+                heapq.heappop(ready)
+            if ready:
+                return ready[0][3]
+            while heap and (heap[0].scheduler is not self):
+                heapq.heappop(heap)
+            return heap[0] if heap else None
+
+    def pop(self, now=None):
+        """ Remove and return the command to send next (see peek), or None if the heap is empty """
+        with self.lock:
+            command = self.peek(now)
+            if command is not None:
+                if self.ready and (self.ready[0][3] is command):
+                    heapq.heappop(self.ready)
+                else:
+                    heapq.heappop(self.heap)
+                command.scheduler = None
+                self._size -= 1
+            return command
+
+    def _remove(self, command, dropped=True):
+        """ Mark queued \"command\" as cancelled (with the lock held), without calling its callback.
+        It is counted as dropped, unless \"dropped\" is False (e.g. when it is counted as shed). """
+        command.scheduler = None
+        command.cancelled = True
+        self._size -= 1
+        if dropped:
+            self.dropped += 1
+        if 2*self._size < len(self.heap) + len(self.ready) - 16:
+            # too many cancelled commands, drop them from the heaps
+            self.heap = [c for c in self.heap if c.scheduler is self]
+            heapq.heapify(self.heap)
+            self.ready = [entry for entry in self.ready if entry[3].scheduler is self]
+            heapq.heapify(self.ready)
+
+    def expire(self, command):
+        """ Mark the popped \"command\" as dropped because its deadline has passed """
+        with self.lock:
+            command.cancelled = True
+            self.expired += 1
+
+    def cancel(self, command):
+        """ Cancel \"command\", returns False if it isn't queued here """
+        with self.lock:
+            if command.scheduler is not self:
+                return False
+            self._remove(command)
+        command.finish(False)
+        return True
+
+    def cancel_group(self, group, key=None, before=None):
+        """ Cancel all commands for \"group\" (a (kind, group) tuple), or only the ones that set
+        state property \"key\" if it is given, and only the ones due at or before \"before\"
+        (monotonic clock) if it is given. Returns the number of commands cancelled. """
+        commands = [c for c in self.queued() if (c.group == group) and ((key is None) or (c.key == key))
+                        and ((before is None) or (c.when <= before))]
+        for command in commands:
+            command.cancel()
+        return len(commands)
+
+    def clear(self):
+        """ Cancel all commands, returns the number cancelled """
+        commands = self.queued()
+        for command in commands:
+            command.cancel()
+        return len(commands)
+
+    def qsize(self):
+        """ return the number of queued commands """
+        return self._size
+
+    def empty(self):
+        """ return True if there are no queued commands """
+        return self._size == 0
+
+class StateCache(object):
+    """ The state of the groups on a bridge, as sent through ColorGroup and WhiteGroup
+
+    For every (kind, group) it records the properties 'on', 'mode' (white, color or disco),
+    'brightness' and so on. A value of None means the state is unknown, e.g. after a relative
+    command like increase_brightness. Commands for group 'ALL' set the state of all groups.
+    """
+    def __init__(self):
+        """ init """
+        self.lock = Lock()
+        self.states = dict()
+        # number of commands that were skipped or folded into a newer one
+        self.elided = 0
+        self.coalesced = 0
+        # bridge time (in seconds) saved by skipping those commands
+        self.saved_time = 0.0
+
+    def get(self, group):
+        """ return the known state of \"group\" (a (kind, group) tuple) as a dict """
+        with self.lock:
+            return dict(self.states.get(group, ()))
+
+    def unchanged(self, group, state):
+        """ return True if setting the (property, value) pairs in \"state\" doesn't change \"group\" """
+        with self.lock:
+            current = self.states.get(group, {})
+            return all((value is not None) and (current.get(prop) == value) for (prop, value) in state)
+
+    def update(self, group, state):
+        """ Set the (property, value) pairs in \"state\" for \"group\" """
+        with self.lock:
+            self.apply(self.states, group, state)
+
+    @staticmethod
+    def apply(states, group, state):
+        """ Set the (property, value) pairs in \"state\" for \"group\" in \"states\" (a dict:
+        (kind, group) -> dict) """
+        (kind, number) = group
+        if number == 'ALL':
+            groups = [(kind, n) for n in ('ALL', '1', '2', '3', '4')]
+        else:
+            groups = [group]
+        for g in groups:
+            current = states.setdefault(g, dict())
+            for (prop, value) in state:
+                current[prop] = value
+        if number != 'ALL':
+            # the groups may differ now, so the state of ALL is unknown
+            current = states.setdefault((kind, 'ALL'), dict())
+            for (prop, value) in state:
+                if current.get(prop) != value:
+                    current[prop] = None
+
+    def invalidate(self, group, state):
+        """ Forget the properties in \"state\" for \"group\" """
+        self.update(group, [(prop, None) for (prop, _) in state])
+
+    def sent(self, bridge):
+        """ Called (with the lock of \"bridge\" held) when a packet has been sent, see SharedStateCache """
+
+    def sync(self, bridge):
+        """ Called (with the lock of \"bridge\" held) before sending, see SharedStateCache """
+
+    def count(self, elided=0, coalesced=0, saved_time=0.0):
+        """ Add to the counters """
+        with self.lock:
+            self.elided += elided
+            self.coalesced += coalesced
+            self.saved_time += saved_time
+
+    def stats(self):
+        """ return the counters as a dict """
+        with self.lock:
+            return {'elided': self.elided, 'coalesced': self.coalesced, 'saved_time': self.saved_time}
+
+class SharedState(object):
+    """ Group state shared between processes, in a memory-mapped file
+
+    The file (default: ~/.cache/milight/state.bin) has a fixed layout: a header followed by
+    \"slots\" bridge records. Each record holds the (ip address, port) of a bridge, the (epoch)
+    time a packet was last sent to it, the group selected on the bridge per kind of group, and
+    the 'on', 'mode' and 'brightness' of each (kind, group). Writers take a lock on the file
+    (and a thread lock), readers don't lock at all: each record has a sequence number which is
+    odd while the record is written (a seqlock), a reader simply retries when it changed.
+    Use SharedState.open to share one instance per file within a process.
+    """
+    MAGIC = b"MCIS"
+    VERSION = 1
+    HEADER = struct.Struct('<4sHHI')
+    # sequence number, port, ip address, last send time, selected RGBW and White group,
+    # and (on, brightness, mode) of the groups in GROUPS
+    GROUPS = [(kind, group) for kind in ('RGBW', 'WHITE') for group in ('ALL', '1', '2', '3', '4')]
+    SEQUENCE = struct.Struct('<I')
+    RECORD = struct.Struct('<I H 48s d bb' + ' bbh' * len(GROUPS))
+    # encoding of the selected groups, 'on' and 'brightness' (-1 is unknown)
+    NUMBERS = {'ALL': 0, '1': 1, '2': 2, '3': 3, '4': 4}
+    ON = {False: 0, True: 1, 'night': 2}
+    FULL = 100
+    # modes: 0 to 255 are colors, then white and the disco modes (see encode_mode)
+    WHITE_MODE = 256
+    DISCO_MODES = None
+    _opened = dict()
+    _opened_lock = Lock()
+
+    @classmethod
+    def open(cls, path=None):
+        """ return the SharedState of the file at \"path\" (default: ~/.cache/milight/state.bin) """
+        path = cls.default_path() if path is None else path
+        with cls._opened_lock:
+            shared = cls._opened.get(path)
+            if shared is None:
+                shared = cls(path)
+                cls._opened[path] = shared
+        return shared
+
+    @staticmethod
+    def default_path():
+        return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                            'milight', 'state.bin')
+
+    def __init__(self, path=None, slots=256):
+        """ init, creates the file if it doesn't exist (an existing file keeps its number of slots) """
+        if path is None:
+            path = self.default_path()
+        self.path = path
+        self.lock = Lock()
+        # slot numbers of the bridges found so far, keyed by (ip_address, port)
+        self.slots = dict()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        with self.write_lock():
+            header = os.pread(self.fd, self.HEADER.size, 0)
+            if len(header) < self.HEADER.size:
+                os.ftruncate(self.fd, self.HEADER.size + slots * self.RECORD.size)
+                os.pwrite(self.fd, self.HEADER.pack(self.MAGIC, self.VERSION, 0, slots), 0)
+            else:
+                (magic, version, _, slots) = self.HEADER.unpack(header)
+                if (magic != self.MAGIC) or (version != self.VERSION):
+                    os.close(self.fd)
+                    raise ValueError('Not a (version %d) shared state file: %s' % (self.VERSION, path))
+        self.nslots = slots
+        self.map = mmap.mmap(self.fd, self.HEADER.size + slots * self.RECORD.size)
+
+    def close(self):
+        """ Unmap and close the file """
+        self.map.close()
+        os.close(self.fd)
+
+    def write_lock(self):
+        """ return a context manager which locks the file (and this object) for writing """
+        shared = self
+        class WriteLock(object):
+            def __enter__(self):
+                shared.lock.acquire()
+                if fcntl is not None:
+                    fcntl.lockf(shared.fd, fcntl.LOCK_EX)
+            def __exit__(self, exc_type, exc_value, traceback):
+                if fcntl is not None:
+                    fcntl.lockf(shared.fd, fcntl.LOCK_UN)
+                shared.lock.release()
+                return False
+        return WriteLock()
+
+    def offset(self, slot):
+        return self.HEADER.size + slot * self.RECORD.size
+
+    def find(self, ip_address, port, claim=False):
+        """ return the slot number of bridge (ip_address, port), or None if it isn't in the file.
+        If \"claim\" is True a free slot is taken for it (raises ValueError if the file is full). """
+        key = (ip_address, port)
+        slot = self.slots.get(key)
+        if slot is not None:
+            return slot
+        name = ip_address.encode('utf-8')[:48]
+        for slot in range(self.nslots):
+            (_, used_port, used_name) = self.RECORD.unpack_from(self.map, self.offset(slot))[:3]
+            if used_port == 0:
+                break
+            if (used_port == port) and (used_name.rstrip(b"\x00") == name):
+                self.slots[key] = slot
+                return slot
+        if not claim:
+            return None
+        with self.write_lock():
+            for slot in range(self.nslots):
+                (_, used_port, used_name) = self.RECORD.unpack_from(self.map, self.offset(slot))[:3]
+                if (used_port == port) and (used_name.rstrip(b"\x00") == name):
+                    break
+                if used_port == 0:
+                    # unknown state everywhere
+                    values = [0, port, name, 0.0, -1, -1] + [-1] * (3 * len(self.GROUPS))
+                    self.RECORD.pack_into(self.map, self.offset(slot), *values)
+                    break
+            else:
+                raise ValueError('The shared state file is full: ' + self.path)
+        self.slots[key] = slot
+        return slot
+
+    def values(self, slot):
+        """ return the raw values of the record of \"slot\" (a consistent copy, see RECORD) """
+        offset = self.offset(slot)
+        for _ in range(1000):
+            values = self.RECORD.unpack_from(self.map, offset)
+            if (values[0] % 2 == 0) and (self.SEQUENCE.unpack_from(self.map, offset)[0] == values[0]):
+                break
+            time.sleep(0)  # a writer is busy
+        # else: the writer died halfway, the next write repairs the record
+        return values
+
+    def read(self, slot):
+        """ return the record of \"slot\" as (last send time, selected, states), where \"selected\"
+        is a dict: kind -> group and \"states\" a dict: (kind, group) -> dict (see decode) """
+        values = self.values(slot)
+        numbers = dict((n, group) for (group, n) in self.NUMBERS.items())
+        selected = {'RGBW': numbers.get(values[4]), 'WHITE': numbers.get(values[5])}
+        states = dict((group, self.decode(values, i)) for (i, group) in enumerate(self.GROUPS))
+        return (values[3] or None, selected, states)
+
+    def decode(self, values, i):
+        """ return the state of group GROUPS[i] in the record \"values\" as a dict, without the
+        properties that are unknown """
+        (on, brightness, mode) = values[6 + 3 * i:9 + 3 * i]
+        state = dict()
+        for (value, decoded) in self.ON.items():
+            if on == decoded:
+                state['on'] = value
+        if brightness >= 0:
+            state['brightness'] = 'full' if brightness == self.FULL else brightness
+        mode = self.decode_mode(mode)
+        if mode is not None:
+            state['mode'] = mode
+        return state
+
+    def get(self, slot, group):
+        """ return the state of \"group\" (a (kind, group) tuple) in \"slot\", see decode """
+        return self.decode(self.values(slot), self.GROUPS.index(group))
+
+    def write(self, slot, last_send=None, selected=None, states=None):
+        """ Update the record of \"slot\" (call with the write_lock held): the last send time,
+        the selected groups and/or the states (see read) """
+        offset = self.offset(slot)
+        values = list(self.RECORD.unpack_from(self.map, offset))
+        if last_send is not None:
+            values[3] = last_send
+        if selected is not None:
+            values[4] = self.NUMBERS.get(selected.get('RGBW'), -1)
+            values[5] = self.NUMBERS.get(selected.get('WHITE'), -1)
+        if states is not None:
+            for (i, group) in enumerate(self.GROUPS):
+                state = states.get(group, {})
+                on = state.get('on')
+                brightness = state.get('brightness')
+                values[6 + 3 * i] = self.ON.get(on, -1) if on is not None else -1
+                if brightness == 'full':
+                    values[7 + 3 * i] = self.FULL
+                elif type(brightness) is int:
+                    values[7 + 3 * i] = max(0, min(25, brightness))
+                else:
+                    values[7 + 3 * i] = -1
+                values[8 + 3 * i] = self.encode_mode(state.get('mode'))
+        sequence = values[0]
+        self.SEQUENCE.pack_into(self.map, offset, (sequence + 1) & 0xFFFFFFFF)
+        values[0] = (sequence + 1) & 0xFFFFFFFF
+        self.RECORD.pack_into(self.map, offset, *values)
+        self.SEQUENCE.pack_into(self.map, offset, (sequence + 2) & 0xFFFFFFFF)
+
+    @classmethod
+    def disco_modes(cls):
+        """ return the names of the disco modes (as in the 'mode' of the state) """
+        if cls.DISCO_MODES is None:
+            cls.DISCO_MODES = ['disco ' + name.lower() for name in sorted(ColorGroup.DISCO_CODES)]
+        return cls.DISCO_MODES
+
+    @classmethod
+    def encode_mode(cls, mode):
+        """ return the number of \"mode\" ('white', 'color N' or 'disco NAME'), -1 if it is unknown """
+        if mode == 'white':
+            return cls.WHITE_MODE
+        if type(mode) is str:
+            if mode.startswith('color '):
+                return int(mode[6:]) % 256
+            if mode in cls.disco_modes():
+                return cls.WHITE_MODE + 1 + cls.disco_modes().index(mode)
+        return -1
+
+    @classmethod
+    def decode_mode(cls, number):
+        """ return the mode for \"number\" (see encode_mode), None if it is unknown """
+        if 0 <= number < cls.WHITE_MODE:
+            return 'color %d' % number
+        if number == cls.WHITE_MODE:
+            return 'white'
+        modes = cls.disco_modes()
+        if 0 <= number - cls.WHITE_MODE - 1 < len(modes):
+            return modes[number - cls.WHITE_MODE - 1]
+        return None
+
+    def state(self, ip_address, port=8899, kind='RGBW', group='ALL'):
+        """ return the known state of \"group\" of \"kind\" on bridge (ip_address, port) as a dict """
+        slot = self.find(ip_address, port)
+        if slot is None:
+            return dict()
+        return self.get(slot, (kind, str(group)))
+
+    def last_send(self, ip_address, port=8899):
+        """ return the (epoch) time a packet was last sent to bridge (ip_address, port), or None """
+        slot = self.find(ip_address, port)
+        if slot is None:
+            return None
+        return self.values(slot)[3] or None
+
+class SharedStateCache(StateCache):
+    """ A StateCache which keeps the state of the groups in a SharedState, so the state sent by
+    one process is known to all others (and survives restarts). The bridge also records the
+    time of every packet and the selected groups there, see Bridge.enable_cache. """
+    def __init__(self, shared, ip_address, port):
+        """ init """
+        super().__init__()
+        self.shared = shared
+        self.slot = shared.find(ip_address, port, claim=True)
+        # the last send time that this process wrote
+        self.last_send = 0.0
+
+    def get(self, group):
+        """ return the known state of \"group\" (a (kind, group) tuple) as a dict """
+        return self.shared.get(self.slot, group)
+
+    def unchanged(self, group, state):
+        """ return True if setting the (property, value) pairs in \"state\" doesn't change \"group\" """
+        current = self.get(group)
+        return all((value is not None) and (current.get(prop) == value) for (prop, value) in state)
+
+    def update(self, group, state):
+        """ Set the (property, value) pairs in \"state\" for \"group\" """
+        with self.shared.write_lock():
+            states = self.shared.read(self.slot)[2]
+            self.apply(states, group, state)
+            self.shared.write(self.slot, states=states)
+
+    def sent(self, bridge):
+        """ Record the send time (now) and the selected groups of \"bridge\" (with its lock held) """
+        self.last_send = time.time()
+        with self.shared.write_lock():
+            self.shared.write(self.slot, last_send=self.last_send, selected=bridge.selected)
+
+    def sync(self, bridge):
+        """ Take over the send time and the selected groups (with the lock of \"bridge\" held),
+        when another process sent a packet to the bridge after this one did """
+        if not (self.shared.values(self.slot)[3] > self.last_send):
+            return
+        (last_send, selected, _) = self.shared.read(self.slot)
+        if last_send is not None:
+            self.last_send = last_send
+            bridge.last_command_time = max(bridge.last_command_time, monotonic_time(last_send))
+            bridge.selected.clear()
+            bridge.selected.update(dict((kind, group) for (kind, group) in selected.items() if group is not None))
+
+class Histogram(object):
+    """ Counts observed values (in seconds) in fixed buckets, like a Prometheus histogram """
+    BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0)
+
+    def __init__(self, buckets=BUCKETS):
+        """ init """
+        self.buckets = tuple(buckets)
+        # the last count is for values above the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        """ Add \"value\" """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        """ return the histogram as a dict, with the cumulative count per bucket (upper bound) """
+        cumulative = list()
+        total = 0
+        for (bound, n) in zip(self.buckets + (float('inf'),), self.counts):
+            total += n
+            cumulative.append((bound, total))
+        return {'count': self.count, 'sum': self.sum, 'max': self.max, 'buckets': cumulative}
+
+class Metrics(object):
+    """ Counters and histograms of the dispatch path of a bridge, see Bridge.enable_metrics
+
+    Records the commands queued and sent, the packets sent (including group selections), how late
+    commands were sent compared to their scheduled time, how long they waited in the queue, and
+    how long packets were held back by the pause between packets. Hooks added with add_hook are
+    called as hook(bridge, packet, command, time) for every packet sent, command is None for a
+    group selection and time is on the monotonic clock.
+    """
+    def __init__(self, bridge):
+        """ init """
+        self.bridge = bridge
+        self.lock = Lock()
+        self.hooks = ()
+        self.queued = 0
+        self.sent = 0
+        self.packets = 0
+        self.selections = 0
+        self.lateness = Histogram()
+        self.queue_wait = Histogram()
+        self.pacing_delay = Histogram()
+        # send times of the last packets, for the send rate
+        self._times = deque(maxlen=50)
+
+    def add_hook(self, hook):
+        """ Call \"hook\" for every packet sent """
+        with self.lock:
+            self.hooks = self.hooks + (hook,)
+
+    def remove_hook(self, hook):
+        """ Stop calling \"hook\" """
+        with self.lock:
+            self.hooks = tuple(h for h in self.hooks if h is not hook)
+
+    def record_queued(self, command):
+        """ Called when \"command\" is queued """
+        command.queued = time.monotonic()
+        with self.lock:
+            self.queued += 1
+
+    def record_sent(self, packet, command, selection, now, due):
+        """ Called when \"packet\" has been sent at \"now\", it was due at \"due\". It is either
+        \"command\" or the group selection of \"selection\". """
+        with self.lock:
+            self.packets += 1
+            self._times.append(now)
+            if command is not None:
+                self.sent += 1
+                self.lateness.observe(now - command.when)
+                if command.queued is not None:
+                    self.queue_wait.observe(now - command.queued)
+                intended = command.when
+            else:
+                self.selections += 1
+                intended = selection.when - self.bridge.pause
+            self.pacing_delay.observe(max(0.0, due - intended))
+        for hook in self.hooks:
+            hook(self.bridge, packet, command, now)
+
+    def send_rate(self):
+        """ return the number of packets per second sent recently """
+        with self.lock:
+            times = list(self._times)
+        if (len(times) < 2) or (time.monotonic() - times[-1] > 2 * self.bridge.pause + 1):
+            return 0.0
+        return (len(times) - 1) / (times[-1] - times[0])
+
+    def snapshot(self):
+        """ return all counters and histograms as a dict """
+        bridge = self.bridge
+        cache = bridge.cache.stats() if bridge.cache is not None else {}
+        with self.lock:
+            snapshot = {
+                'bridge': '%s:%s' % (bridge.ip_address, bridge.port),
+                'queued': self.queued,
+                'sent': self.sent,
+                'dropped': bridge.scheduler.dropped,
+                'shed': bridge.scheduler.shed,
+                'expired': bridge.scheduler.expired,
+                'rejected': bridge.scheduler.rejected,
+                'errors': bridge.errors,
+                'elided': cache.get('elided', 0),
+                'coalesced': cache.get('coalesced', 0),
+                'packets': self.packets,
+                'selections': self.selections,
+                'redundant': bridge.redundancy.sent if bridge.redundancy is not None else 0,
+                'queue_depth': bridge.scheduler.qsize(),
+                'lateness': self.lateness.snapshot(),
+                'queue_wait': self.queue_wait.snapshot(),
+                'pacing_delay': self.pacing_delay.snapshot(),
+            }
+        snapshot['send_rate'] = self.send_rate()
+        return snapshot
+
+    # (name, snapshot key, type, help) of the values in the Prometheus text format
+    PROMETHEUS = (
+        ('milight_commands_queued_total', 'queued', 'counter', 'Commands queued'),
+        ('milight_commands_sent_total', 'sent', 'counter', 'Commands sent'),
+        ('milight_commands_dropped_total', 'dropped', 'counter', 'Queued commands that were cancelled'),
+        ('milight_commands_shed_total', 'shed', 'counter', 'Queued commands dropped because the queue was full'),
+        ('milight_commands_expired_total', 'expired', 'counter', 'Commands dropped because their deadline had passed'),
+        ('milight_commands_rejected_total', 'rejected', 'counter', 'Commands rejected because the queue was full'),
+        ('milight_send_errors_total', 'errors', 'counter', 'Packets that could not be sent (socket errors)'),
+        ('milight_commands_elided_total', 'elided', 'counter', 'Commands skipped because they did not change the state'),
+        ('milight_commands_coalesced_total', 'coalesced', 'counter', 'Queued commands replaced by a newer one'),
+        ('milight_packets_sent_total', 'packets', 'counter', 'Packets sent, including group selections'),
+        ('milight_selections_sent_total', 'selections', 'counter', 'Group selections sent'),
+        ('milight_redundant_sent_total', 'redundant', 'counter', 'Redundant copies of idempotent commands sent'),
+        ('milight_queue_depth', 'queue_depth', 'gauge', 'Commands in the queue'),
+        ('milight_send_rate', 'send_rate', 'gauge', 'Packets per second sent recently'),
+        ('milight_lateness_seconds', 'lateness', 'histogram', 'Time commands were sent after their scheduled time'),
+        ('milight_queue_wait_seconds', 'queue_wait', 'histogram', 'Time commands waited in the queue'),
+        ('milight_pacing_delay_seconds', 'pacing_delay', 'histogram', 'Time packets were held back by the pause between packets'),
+    )
+
+    @classmethod
+    def prometheus(cls, bridges=None):
+        """ return the metrics of \"bridges\" (default: all bridges with metrics enabled) in
+        the Prometheus text format """
+        if bridges is None:
+            bridges = Bridge.bridges()
+        snapshots = [b.metrics.snapshot() for b in bridges if b.metrics is not None]
+        lines = list()
+        for (name, key, kind, description) in cls.PROMETHEUS:
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for snapshot in snapshots:
+                label = 'bridge="%s"' % snapshot['bridge']
+                value = snapshot[key]
+                if kind != 'histogram':
+                    lines.append('%s{%s} %s' % (name, label, value))
+                    continue
+                for (bound, total) in value['buckets']:
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (name, label, le, total))
+                lines.append('%s_sum{%s} %r' % (name, label, value['sum']))
+                lines.append('%s_count{%s} %d' % (name, label, value['count']))
+        return '\n'.join(lines) + '\n'
+
+class PrecisionTimer(object):
+    """ Precise send times for the packets of a bridge, see Bridge.enable_precise_timing
+
+    The dispatch thread sleeps until shortly before a packet is due and spins (yielding to the
+    other threads) for the rest of the time. How far the sleeps overshoot is measured, and the
+    estimate of it is added to the time the thread wakes up early, so it still wakes up in time
+    on a loaded host. The lateness of the packets (the time they were sent after they were due)
+    is recorded, see snapshot.
+    """
+    BUCKETS = (0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1)
+
+    def __init__(self, spin=0.001, catch_up=0.001):
+        """ init, \"spin\" is the time (in seconds) spent spinning before a packet is due, and a
+        packet that is sent less than \"catch_up\" seconds late doesn't delay the next one """
+        self.lock = Lock()
+        self.spin = spin
+        self.catch_up = catch_up
+        # estimate of how far a sleep overshoots, in seconds
+        self.oversleep = 0.0
+        self.lateness = Histogram(self.BUCKETS)
+        self.oversleeps = Histogram(self.BUCKETS)
+        # the last lateness values, for the percentiles
+        self._recent = deque(maxlen=1000)
+
+    def lead(self):
+        """ return how long before a packet is due the dispatch thread should wake up """
+        return self.spin + self.oversleep
+
+    def woke(self, target, now):
+        """ Called when a sleep until (monotonic) time \"target\" ended at \"now\" """
+        late = now - target
+        if late < 0:
+            return  # woken up early, e.g. for a new command
+        with self.lock:
+            self.oversleeps.observe(late)
+            # follow increases quickly and decreases slowly
+            weight = 0.5 if late > self.oversleep else 0.05
+            self.oversleep = min(0.05, self.oversleep + (late - self.oversleep) * weight)
+
+    def wait(self, due):
+        """ Spin until (monotonic) time \"due\" """
+        while time.monotonic() < due:
+            time.sleep(0)
+
+    def sent(self, due, now):
+        """ Called when a packet that was due at \"due\" has been sent at \"now\" """
+        with self.lock:
+            self.lateness.observe(max(0.0, now - due))
+            self._recent.append(now - due)
+
+    def snapshot(self):
+        """ return the lateness (with the p50 and p99 of the last 1000 packets) and oversleep
+        statistics as a dict """
+        with self.lock:
+            recent = sorted(self._recent)
+            snapshot = {
+                'spin': self.spin,
+                'oversleep_estimate': self.oversleep,
+                'lateness': self.lateness.snapshot(),
+                'oversleep': self.oversleeps.snapshot(),
+            }
+        if recent:
+            snapshot['lateness_p50'] = recent[len(recent) // 2]
+            snapshot['lateness_p99'] = recent[min(len(recent) - 1, int(0.99 * len(recent)))]
+        return snapshot
+
+class Redundancy(object):
+    """ Redundant copies of idempotent commands, sent in idle pacing slots (see Bridge.enable_redundancy)
+
+    The bridge protocol is UDP without acknowledgements, so a lost packet is simply lost.
+    Commands that set an absolute value (on/off, brightness, color, white, brightmode, nightmode,
+    see PROPERTIES) can be repeated without changing the result, so after such a command has been
+    sent \"copies\" more copies of it are sent, within \"window\" seconds, in pacing slots that no
+    queued command needs. Relative commands (like increase_brightness or the disco speed) are
+    never repeated. A copy is forgotten when a newer command for the same property of the group
+    has been sent, so it never undoes a later command, and it is only sent when it doesn't
+    change the group selected on the bridge, so it never costs a queued command an extra
+    selection. At most \"limit\" commands are kept, the oldest are dropped first.
+    """
+    def __init__(self, copies=1, window=1.0, limit=16):
+        """ init """
+        self.copies = copies
+        self.window = window
+        self.limit = limit
+        # [packet, (kind, group), properties, copies left, expiry time (monotonic)] lists, oldest first
+        self.pending = list()
+        # number of copies sent
+        self.sent = 0
+
+    def record(self, packet, group, now, repeat=True):
+        """ Called (with the lock of the bridge held) when \"packet\" has been sent to \"group\" (a
+        (kind, group) tuple), it is repeated later if \"repeat\" is True and it is idempotent """
+        (props, absolute) = PROPERTIES.get(packet[0], (None, False))
+        if (group is None) or (len(packet) != 3):
+            # a sequence of commands (or an unknown target), which could change anything
+            self.pending = [p for p in self.pending if (group is not None) and (p[1][0] != group[0])]
+            return
+        (kind, number) = group
+        if props is None:
+            self.pending = [p for p in self.pending if p[1][0] != kind]
+        else:
+            self.pending = [p for p in self.pending if not ((p[1][0] == kind) and set(p[2]).intersection(props) and
+                                                            ('ALL' in (p[1][1], number) or p[1][1] == number))]
+        if repeat and absolute and (self.copies > 0):
+            self.pending.append([packet, group, props, self.copies, now + self.window])
+            if len(self.pending) > self.limit:
+                del self.pending[0]
+
+    def peek(self, bridge, now):
+        """ return the copy to send next (with the lock of \"bridge\" held), or None. Copies that
+        expired, or that would need or change the group selection, are dropped. """
+        while self.pending:
+            (packet, (kind, number), _, _, expires) = self.pending[0]
+            selects = GROUP_SELECTS.get(packet[0])
+            if selects is not None:
+                # an on/off command, which selects its group itself
+                number = selects[1] if selects[2] else None
+            if (now <= expires) and (bridge.selected.get(kind) == number):
+                return self.pending[0]
+            del self.pending[0]
+        return None
+
+    def take(self, bridge, now):
+        """ return the packet of the copy to send now (see peek), or None """
+        copy = self.peek(bridge, now)
+        if copy is None:
+            return None
+        copy[3] -= 1
+        del self.pending[0]
+        if copy[3] > 0:
+            # the other commands get their copies first
+            self.pending.append(copy)
+        self.sent += 1
+        return copy[0]
+
+class Bridge(object):
+    """ A WIFI bridge, with its own command scheduler, dispatch thread and UDP socket
+
+    Bridges are shared between all groups that use the same (ip_address, port),
+    use Bridge.get to obtain one. Each bridge paces its own commands, so commands
+    for different bridges are sent in parallel.
+    """
+    # static registry of bridges, keyed by (ip_address, port)
+    _bridges = dict()
+    _bridges_lock = Lock()
+    # Dispatcher used by new bridges instead of a thread each, see Dispatcher.install
+    default_dispatcher = None
+
+    @classmethod
+    def get(cls, ip_address, port=8899, pause=0.1):
+        """ Return the bridge at (ip_address, port), create it if it doesn't exist yet """
+        key = (ip_address, port)
+        with cls._bridges_lock:
+            bridge = cls._bridges.get(key)
+            if bridge is None:
+                bridge = cls(ip_address, port, pause)
+                cls._bridges[key] = bridge
+        return bridge
+
+    @classmethod
+    def bridges(cls):
+        """ return all known bridges """
+        with cls._bridges_lock:
+            return list(cls._bridges.values())
+
+    def __init__(self, ip_address, port=8899, pause=0.1):
+        """ init """
+        self.ip_address = ip_address
+        self.port = port
+        if pause <= 0:
+            pause = 0.1
+        self.pause = pause
+        # time (monotonic clock) that the last command was sent to this bridge
+        self.last_command_time = time.monotonic() - pause
+        self.scheduler = Scheduler(wakeup=self.wakeup)
+        # flag to indicate if all commands have been processed
+        self.finished = True
+        # command whose group selection has been sent, it goes out next
+        self._selected = None
+        # group that is currently selected on the bridge, per kind of group ('RGBW', 'WHITE')
+        self.selected = dict()
+        # if False the group selection is sent before every command that has one
+        self.track_selection = True
+        # StateCache used to skip redundant commands, see enable_cache
+        self.cache = None
+        # Metrics of the dispatch path, see enable_metrics
+        self.metrics = None
+        # PrecisionTimer used to wake up the dispatch thread, see enable_precise_timing
+        self.timer = None
+        # Redundancy which repeats idempotent commands in idle slots, see enable_redundancy
+        self.redundancy = None
+        # number of packets that couldn't be sent (socket errors)
+        self.errors = 0
+        # the Dispatcher that sends the packets, or None if the bridge has its own thread
+        self.dispatcher = self.default_dispatcher
+        # future of the sequence (e.g. a fade) that is running, per (kind, group)
+        self.sequences = dict()
+        self.sock = self.open()
+        self._wakeup = Condition(self.scheduler.lock)
+        self.qprocess = Thread()
+        self.start()
+
+    def enable_cache(self, enable=True, shared=None):
+        """ Keep track of the state of the groups on this bridge, and skip (or fold
+        together) commands that don't change it. If \"shared\" is True (or the path of the file,
+        or a SharedState) the state is kept in a memory-mapped file, shared with the other
+        processes that use the bridge, together with the time of the last packet and the
+        selected groups (see SharedStateCache). """
+        if not enable:
+            self.cache = None
+        elif shared:
+            if not isinstance(shared, SharedState):
+                shared = SharedState.open(None if shared is True else shared)
+            if not (isinstance(self.cache, SharedStateCache) and (self.cache.shared is shared)):
+                with self.scheduler.lock:
+                    self.cache = SharedStateCache(shared, self.ip_address, self.port)
+                    self.cache.sync(self)
+        elif self.cache is None:
+            self.cache = StateCache()
+        return self.cache
+
+    def enable_metrics(self, enable=True):
+        """ Record metrics of the commands and packets sent to this bridge (see Metrics), returns
+        the Metrics (or None). When disabled they cost no more than a check per packet. """
+        if not enable:
+            self.metrics = None
+        elif self.metrics is None:
+            self.metrics = Metrics(self)
+        return self.metrics
+
+    def enable_precise_timing(self, enable=True, spin=0.001):
+        """ Send the packets within a fraction of a millisecond of the time they are due: the
+        dispatch thread sleeps until \"spin\" seconds (plus the measured oversleep) before a
+        packet is due and spins for the rest, see PrecisionTimer. Returns the PrecisionTimer
+        (or None), its snapshot has the lateness statistics. """
+        with self.scheduler.lock:
+            if not enable:
+                self.timer = None
+            elif self.timer is None:
+                self.timer = PrecisionTimer(spin)
+            else:
+                self.timer.spin = spin
+            self.wakeup()
+        return self.timer
+
+    def enable_redundancy(self, copies=1, window=1.0):
+        """ Send \"copies\" redundant copies of idempotent commands (like on, brightness or color,
+        but not relative commands like increase_brightness) within \"window\" seconds after them,
+        in pacing slots that no queued command needs, to make up for lost packets. The copies
+        stop when the queue is busy. Use copies=0 to disable. Returns the Redundancy (or None),
+        its \"sent\" attribute counts the copies sent. """
+        with self.scheduler.lock:
+            if copies <= 0:
+                self.redundancy = None
+            elif self.redundancy is None:
+                self.redundancy = Redundancy(copies, window)
+            else:
+                self.redundancy.copies = copies
+                self.redundancy.window = window
+        return self.redundancy
+
+    def limit_queue(self, maxsize=0, policy='reject'):
+        """ Limit the number of queued commands to \"maxsize\" (0: no limit). When the queue is
+        full a new command is rejected ('reject', it raises queue.Full), or the command queued
+        first is dropped ('drop-oldest'), or the oldest command for the same group is dropped
+        ('supersede'). """
+        with self.scheduler.lock:
+            self.scheduler.set_limit(maxsize, policy)
+
+    def open(self):
+        """ Return the socket used to send commands """
+        return socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def start(self):
+        """ Start the dispatch thread (if it isn't running already) """
+        if self.dispatcher is not None:
+            self.dispatcher.attach(self)
+        elif not self.qprocess.is_alive():
+            self.qprocess = Thread(target=self.qworker, daemon=True,
+                                   name='milight-%s:%s' % (self.ip_address, self.port))
+            self.qprocess.start()
+
+    def wakeup(self):
+        """ Called (with the scheduler lock held) when a new command becomes the first one due """
+        if self.dispatcher is not None:
+            self.dispatcher.schedule(self, self.next_due())
+        else:
+            self._wakeup.notify()
+
+    def put(self, cmdtime, command, select=None, done=None, group=None, key=None, priority=0, deadline=None):
+        """ Queue \"command\" to be sent at (epoch) time \"cmdtime\", optionally preceded by the
+        group selection command \"select\". \"done\" is called with True once the command
+        has been sent, or with False if it is dropped from the queue. \"group\" and \"key\" are the
+        (kind, group) it is sent to and the state property it sets. The command is dropped if it
+        can't be sent before (epoch) time \"deadline\". Returns the Command. """
+        if cmdtime is None:
+            cmdtime = time.monotonic()
+        else:
+            cmdtime = monotonic_time(cmdtime)
+        if deadline is not None:
+            deadline = monotonic_time(deadline)
+        cmd = Command(cmdtime, command, select, group, done, key, priority, deadline)
+        self.put_command(cmd)
+        return cmd
+
+    def put_command(self, command):
+        """ Queue the Command \"command\", raises queue.Full if it is rejected (see limit_queue) """
+        self.finished = False
+        if self.metrics is not None:
+            self.metrics.record_queued(command)
+        self.scheduler.put(command)
+
+    def put_commands(self, commands):
+        """ Queue the Commands \"commands\" in one operation """
+        self.finished = False
+        if self.metrics is not None:
+            for command in commands:
+                self.metrics.record_queued(command)
+        self.scheduler.put_many(commands)
+
+    def batch(self):
+        """ Return a new Scene, to be used as: with bridge.batch() as scene: ... """
+        return Scene()
+
+    def send(self, packet):
+        """ Send a single packet to the bridge (no pacing) """
+        if self.dispatcher is not None:
+            self.dispatcher.send(self, packet)
+        else:
+            self.sock.sendto(packet, (self.ip_address, self.port))
+
+    def track(self, packet, selected=None):
+        """ Keep track of the group selected by \"packet\" (if it is an on/off command), in
+        \"selected\" (default: the groups currently selected on the bridge) """
+        selects = GROUP_SELECTS.get(packet[0])
+        if selects is not None:
+            if selected is None:
+                selected = self.selected
+            (kind, group, on) = selects
+            # after an off command the group has to be switched on again
+            selected[kind] = group if on else None
+
+    def needs_select(self, command, selected=None):
+        """ return True if the group selection has to be sent before \"command\", given the
+        groups in \"selected\" (default: the groups currently selected on the bridge) """
+        if command.select is None:
+            return False
+        if (command.group is not None) and (GROUP_SELECTS.get(command.packet[0], ())[:2] == command.group):
+            # on/off commands select the group themselves
+            return False
+        if (not self.track_selection) or (command.group is None):
+            return True
+        if selected is None:
+            selected = self.selected
+        (kind, group) = command.group
+        return selected.get(kind) != group
+
+    def next_due(self):
+        """ Return the time (monotonic clock) at which the next packet is due, or None
+        if there is nothing to send """
+        with self.scheduler.lock:
+            due = self.command_due()
+            redundancy = self.redundancy
+            if (redundancy is not None) and redundancy.pending:
+                # a redundant copy only goes out in a slot that no queued command needs
+                slot = self.last_command_time + self.pause
+                if ((due is None) or (due >= slot + self.pause)) and \
+                        (redundancy.peek(self, max(slot, time.monotonic())) is not None):
+                    return slot
+            return due
+
+    def command_due(self):
+        """ Return the time (monotonic clock) at which the next queued packet is due, or None """
+        with self.scheduler.lock:
+            # Lights require time between commands, 100ms is recommended by the documentation
+            if self._selected is not None:
+                return max(self._selected.when, self.last_command_time + self.pause)
+            command = self.scheduler.peek(max(time.monotonic(), self.last_command_time + self.pause))
+            if command is None:
+                self.finished = True
+                return None
+            if self.needs_select(command):
+                # the selection goes out one pause before the command
+                return max(command.when - self.pause, self.last_command_time + self.pause)
+            return max(command.when, self.last_command_time + self.pause)
+
+    def dispatch(self):
+        """ Send the next packet if it is due, and return the time at which the packet
+        after it is due (or None if there is nothing to send) """
+        # commands whose deadline has passed
+        expired = list()
+        with self.scheduler.lock:
+            cache = self.cache
+            if cache is not None:
+                cache.sync(self)
+            while True:
+                due = self.next_due()
+                now = time.monotonic()
+                if (due is None) or (due > now):
+                    break
+                # the command whose group selection is sent (if it is one)
+                selection = None
+                if (self.redundancy is not None) and (self._selected is None):
+                    due_command = self.command_due()
+                    if (due_command is None) or (due_command > now):
+                        # an idle slot, for a redundant copy
+                        command = None
+                        packet = self.redundancy.take(self, now)
+                        if packet is None:
+                            continue
+                        self.last_command_time = now
+                        self.track(packet)
+                        if cache is not None:
+                            cache.sent(self)
+                        break
+                if self._selected is not None:
+                    command = self._selected
+                    self._selected = None
+                    packet = command.packet
+                else:
+                    command = self.scheduler.pop(now)
+                    packet = None
+                if (command.deadline is not None) and (now > command.deadline):
+                    # too late to be of any use, try the next one
+                    self.scheduler.expire(command)
+                    expired.append(command)
+                    continue
+                if packet is None:
+                    if self.needs_select(command):
+                        # select the group first, the command itself goes out one pause later
+                        self._selected = command
+                        packet = command.select
+                        selection = command
+                        command = None
+                    else:
+                        packet = command.packet
+                if (self.timer is not None) and (now - due < self.timer.catch_up):
+                    # don't let a tiny lateness push back the packets after this one
+                    self.last_command_time = due
+                else:
+                    self.last_command_time = now
+                self.track(packet)
+                if cache is not None:
+                    cache.sent(self)
+                if self.redundancy is not None:
+                    target = command if selection is None else selection
+                    self.redundancy.record(packet, target.group, now, selection is None)
+                break
+        for dropped in expired:
+            dropped.finish(False)
+        if (due is None) or (due > now):
+            return due
+        try:
+            self.send(packet)
+        except OSError:
+            # e.g. no route to the bridge: drop the command, but keep the dispatch thread going
+            self.send_failed(command, selection)
+            return self.next_due()
+        if self.timer is not None:
+            self.timer.sent(due, time.monotonic())
+        if (self.metrics is not None) and ((command is not None) or (selection is not None)):
+            self.metrics.record_sent(packet, command, selection, now, due)
+        if command is not None:
+            command.finish(True)
+        return self.next_due()
+
+    def send_failed(self, command, selection=None):
+        """ Drop \"command\" (or the command whose group selection is \"selection\"), its packet
+        couldn't be sent """
+        with self.scheduler.lock:
+            self.errors += 1
+            if (selection is not None) and (self._selected is selection):
+                self._selected = None
+            # the bridge may not have received the selection
+            self.selected.clear()
+        failed = selection if command is None else command
+        if failed is not None:
+            failed.cancelled = True
+            failed.finish(False)
+
+    def qworker(self):
+        """ Process command queue """
+        while True:
+            with self._wakeup:
+                due = self.next_due()
+                while True:
+                    timer = self.timer
+                    # with precise timing wake up early, and spin for the rest
+                    target = due if (due is None) or (timer is None) else due - timer.lead()
+                    if (target is not None) and (target <= time.monotonic()):
+                        break
+                    self._wakeup.wait(None if target is None else target - time.monotonic())
+                    if (timer is not None) and (target is not None):
+                        timer.woke(target, time.monotonic())
+                    due = self.next_due()
+            if timer is not None:
+                timer.wait(due)
+            self.dispatch()
+
+class Dispatcher(object):
+    """ A single thread that sends the packets of many bridges, instead of a thread per bridge
+
+    The dispatcher keeps one timer heap with the time the next packet of each bridge is due,
+    and waits for it in a selectors (epoll) loop. The packets of all bridges that are due are
+    sent in the same tick, on the non-blocking sockets of the bridges; packets that can't be
+    sent straight away are sent when the socket becomes writable. Each bridge keeps its own
+    scheduler and pacing (see Bridge.next_due and Bridge.dispatch). Use install (before the
+    groups are created) to have all new bridges use the dispatcher:
+
+        mci.Dispatcher.install()
+    """
+    @classmethod
+    def install(cls):
+        """ Let all bridges created from now on use a (shared) Dispatcher, which is returned """
+        if Bridge.default_dispatcher is None:
+            Bridge.default_dispatcher = cls()
+        return Bridge.default_dispatcher
+
+    def __init__(self):
+        """ init """
+        self.lock = Lock()
+        self.selector = selectors.DefaultSelector()
+        # (due, seq, bridge) entries, an entry is only valid if it is the due time in _timers
+        self.heap = list()
+        self._timers = dict()
+        self._seq = count()
+        # packets waiting for the socket of a bridge to become writable
+        self._outbox = dict()
+        # to wake up the select call when a timer is set before the one it waits for
+        (self._wakeup_recv, self._wakeup_send) = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self.selector.register(self._wakeup_recv, selectors.EVENT_READ)
+        self._woken = False
+        self.bridges = set()
+        self.thread = Thread()
+
+    def attach(self, bridge):
+        """ Let the dispatcher send the packets of \"bridge\" (and start it) """
+        with self.lock:
+            if bridge not in self.bridges:
+                bridge.sock.setblocking(False)
+                self.bridges.add(bridge)
+            if not self.thread.is_alive():
+                self.thread = Thread(target=self.run, daemon=True, name='milight-dispatcher')
+                self.thread.start()
+        with bridge.scheduler.lock:
+            self.schedule(bridge, bridge.next_due())
+
+    def schedule(self, bridge, due):
+        """ Dispatch \"bridge\" at (monotonic) time \"due\" (None: nothing to send) """
+        if due is None:
+            return
+        with self.lock:
+            current = self._timers.get(bridge)
+            if (current is not None) and (current <= due):
+                return
+            self._timers[bridge] = due
+            heapq.heappush(self.heap, (due, next(self._seq), bridge))
+            if (self.heap[0][2] is not bridge) or self._woken:
+                return
+            self._woken = True
+        try:
+            self._wakeup_send.send(b"\x00")
+        except BlockingIOError:
+            pass  # it is awake already
+
+    def send(self, bridge, packet):
+        """ Send \"packet\" on the socket of \"bridge\", or queue it until the socket is writable """
+        address = (bridge.ip_address, bridge.port)
+        with self.lock:
+            outbox = self._outbox.get(bridge)
+            if outbox is None:
+                try:
+                    bridge.sock.sendto(packet, address)
+                    return
+                except (BlockingIOError, InterruptedError):
+                    outbox = self._outbox[bridge] = deque()
+                    self.selector.register(bridge.sock, selectors.EVENT_WRITE, bridge)
+            outbox.append(packet)
+
+    def _flush(self, bridge):
+        """ Send the packets that are waiting for the socket of \"bridge\" """
+        with self.lock:
+            outbox = self._outbox[bridge]
+            while outbox:
+                try:
+                    bridge.sock.sendto(outbox[0], (bridge.ip_address, bridge.port))
+                except (BlockingIOError, InterruptedError):
+                    return
+                except OSError:
+                    # the commands of these packets have been reported as sent already
+                    bridge.errors += 1
+                outbox.popleft()
+            del self._outbox[bridge]
+            self.selector.unregister(bridge.sock)
+
+    def run(self):
+        """ The event loop """
+        while True:
+            with self.lock:
+                timeout = None
+                target = None
+                if self.heap:
+                    (target, _, bridge) = self.heap[0]
+                    timer = bridge.timer
+                    if timer is not None:
+                        # wake up early, and spin for the rest (see PrecisionTimer)
+                        target -= timer.lead()
+                    timeout = max(0, target - time.monotonic())
+            events = self.selector.select(timeout)
+            if timeout and (timer is not None):
+                timer.woke(target, time.monotonic())
+            for (key, _) in events:
+                if key.fileobj is self._wakeup_recv:
+                    with self.lock:
+                        self._woken = False
+                        try:
+                            while self._wakeup_recv.recv(64):
+                                pass
+                        except BlockingIOError:
+                            pass
+                else:
+                    self._flush(key.data)
+            # all bridges that are due in this tick
+            now = time.monotonic()
+            due = list()
+            with self.lock:
+                heap = self.heap
+                while heap:
+                    (when, _, bridge) = heap[0]
+                    timer = bridge.timer
+                    if when > (now if timer is None else now + timer.lead()):
+                        break
+                    heapq.heappop(heap)
+                    if self._timers.get(bridge) == when:
+                        del self._timers[bridge]
+                        due.append((when, bridge))
+            for (when, bridge) in due:
+                if bridge.timer is not None:
+                    bridge.timer.wait(when)
+                try:
+                    next_due = bridge.dispatch()
+                except OSError:
+                    # a socket error of one bridge must not stop the others (dispatch drops the
+                    # command whose packet can't be sent, see Bridge.send_failed)
+                    bridge.errors += 1
+                    next_due = bridge.next_due()
+                self.schedule(bridge, next_due)
+
+class Scene(object):
+    """ A batch of actions on (possibly) several groups and bridges, which is sent as one plan
+
+    While a scene is recorded (in a with statement) the actions of all groups are collected
+    instead of sent. When the with statement ends the actions are compiled into one plan per
+    bridge: actions are ordered by group, to send as few group selections as possible, and the
+    bridges send their part of the plan in parallel. E.g.:
+
+        with mci.Scene() as scene:
+            grp1.on()
+            grp2.color('red')
+            grp1.brightness(20)
+            print(scene.compile())  # predicted time at which the last packet is sent
+    """
+    _local = local()
+
+    @classmethod
+    def current(cls):
+        """ return the scene that is being recorded in this thread, or None """
+        scenes = getattr(cls._local, 'scenes', None)
+        if scenes:
+            return scenes[-1]
+        return None
+
+    def __init__(self):
+        """ init """
+        # (bridge, commands, immediate) tuples, in the order of the calls
+        self.actions = list()
+        self.submitted = False
+        # predicted (epoch) time at which the last packet is sent, and the time it takes
+        self.completion = None
+        self.duration = None
+        # Future for the submitted scene
+        self.future = None
+
+    def __enter__(self):
+        scenes = getattr(self._local, 'scenes', None)
+        if scenes is None:
+            scenes = self._local.scenes = list()
+        scenes.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._local.scenes.remove(self)
+        if exc_type is None:
+            self.submit()
+        else:
+            self.discard()
+        return False
+
+    def add(self, bridge, commands, immediate=False):
+        """ Add the Commands \"commands\" for \"bridge\" to the scene, \"immediate\" is True if they
+        weren't given a time to be sent (so they can be reordered) """
+        if self.submitted:
+            raise ValueError('The scene has already been submitted')
+        self.actions.append((bridge, commands, immediate))
+
+    def discard(self):
+        """ Drop all actions of the scene """
+        for (_, commands, _) in self.actions:
+            for command in commands:
+                command.cancel()
+        self.actions = list()
+
+    def compile(self):
+        """ Plan when each packet is sent, and return the predicted (epoch) time at which the last
+        one is sent. The times are also set as self.completion and self.duration. """
+        now = time.monotonic()
+        bridges = dict()
+        for (order, (bridge, commands, immediate)) in enumerate(self.actions):
+            bridges.setdefault(bridge, list()).append((order, commands, immediate))
+        finish = now
+        for (bridge, actions) in bridges.items():
+            finish = max(finish, self._plan(bridge, actions, now))
+        self.duration = finish - now
+        self.completion = time.time() + self.duration
+        return self.completion
+
+    @staticmethod
+    def _plan(bridge, actions, now):
+        """ Set the time of the commands of \"actions\" for \"bridge\", return the time at which
+        the last one is sent """
+        pause = bridge.pause
+        with bridge.scheduler.lock:
+            selected = dict(bridge.selected)
+            free = max(now, bridge.last_command_time + pause) + bridge.scheduler.qsize()*pause
+        # commands for ALL don't commute with those for single groups of the same kind,
+        # so they split the actions of that kind in segments which keep their order
+        segments = dict()
+        steps = list()
+        for (order, commands, immediate) in actions:
+            if not commands:
+                continue
+            (kind, group) = commands[0].group or (None, None)
+            segment = segments.get(kind, 0)
+            if group == 'ALL':
+                segment += 1
+                segments[kind] = segment + 1
+            # the group that is selected already goes first
+            rank = (group != selected.get(kind), str(group))
+            start = commands[0].when
+            for command in commands:
+                if immediate:
+                    desired = now + (command.when - start)
+                else:
+                    desired = command.when
+                steps.append((desired, str(kind), segment, rank, order, command.seq or 0, command))
+        steps.sort(key=lambda step: step[:5])
+        last = now
+        for step in steps:
+            (desired, command) = (step[0], step[-1])
+            if bridge.needs_select(command, selected):
+                free = max(desired - pause, free) + pause
+                bridge.track(command.select, selected)
+            last = max(desired, free)
+            free = last + pause
+            bridge.track(command.packet, selected)
+            command.when = last
+        return last
+
+    def submit(self):
+        """ Compile the plan and queue it on the bridges. Returns a Future which is done (with
+        the number of commands sent) when all commands of the scene have been sent or dropped. """
+        if self.submitted:
+            raise ValueError('The scene has already been submitted')
+        self.compile()
+        self.submitted = True
+        future = Future()
+        commands = [c for (_, cmds, _) in self.actions for c in cmds]
+        if not commands:
+            future.set_result(0)
+            return future
+        counts = [len(commands), 0]
+        lock = Lock()
+        def finished(sent):
+            with lock:
+                counts[0] -= 1
+                counts[1] += 1 if sent else 0
+                last = (counts[0] == 0)
+            if last:
+                future.set_result(counts[1])
+        for command in commands:
+            command.done = self._chain(command.done, finished)
+        rejected = list()
+        for (bridge, cmds, _) in self.actions:
+            for command in cmds:
+                try:
+                    bridge.put_command(command)
+                except Full:
+                    rejected.append(command)
+        for command in commands:
+            if command.cancelled and (command.seq is None):
+                finished(False)
+        # commands that didn't fit in the queue are dropped
+        for command in rejected:
+            command.cancel()
+        self.future = future
+        return future
+
+    @staticmethod
+    def _chain(first, second):
+        """ return a done callback which calls \"first\" (if not None) and \"second\" """
+        if first is None:
+            return second
+        def done(sent):
+            first(sent)
+            second(sent)
+        return done
+
+class Stream(object):
+    """ A stream of settings (e.g. colors for music-reactive lighting) for a group, see Group.stream
+
+    Values are sent as fast as the pacing of the bridge allows, and only the newest value of
+    each property is kept: when a value is set while the command of the previous value is still
+    queued, that command is changed instead of queueing another one. So the lights stay (about)
+    one pause behind the producer, however fast it produces values.
+    """
+    def __init__(self, group):
+        """ init """
+        self.group = group
+        self.bridge = group.bridge
+        # the (command, state) that is queued per property
+        self.pending = dict()
+        # number of values sent, and replaced by a newer value before they were sent
+        self.sent = 0
+        self.replaced = 0
+
+    def set(self, **values):
+        """ Set properties, e.g. stream.set(brightness=20, color='red'), see Group.stream_command """
+        for (prop, value) in values.items():
+            (packet, state) = self.group.stream_command(prop, value)
+            self.put(prop, packet, state)
+
+    def put(self, prop, packet, state=None):
+        """ Send \"packet\", which sets property \"prop\" (\"state\" is used by the bridge cache),
+        replacing the packet for \"prop\" that is still queued (if there is one) """
+        bridge = self.bridge
+        with bridge.scheduler.lock:
+            queued = self.pending.get(prop)
+            if queued is not None:
+                command = queued[0]
+                if (command.scheduler is not None) or (bridge._selected is command):
+                    if bridge.scheduler.replace(command, packet, bridge._selected is command):
+                        self.pending[prop] = (command, state)
+                        self.replaced += 1
+                        return
+                    # the command can't be changed, drop it and queue the new value
+                    if command.cancel():
+                        self.replaced += 1
+            current = [None]
+            def done(sent):
+                with bridge.scheduler.lock:
+                    (command, state) = self.pending[prop]
+                    if command is current[0]:
+                        del self.pending[prop]
+                    else:
+                        # a newer value has been queued already
+                        state = None
+                    if sent:
+                        self.sent += 1
+                if sent and (state is not None) and (bridge.cache is not None):
+                    bridge.cache.update(command.group, state)
+            group = self.group
+            current[0] = Command(time.monotonic(), packet, group.select_command(), group.group_key(),
+                                 done, prop, group.priority)
+            self.pending[prop] = (current[0], state)
+            bridge.put_command(current[0])
+
+    def feed(self, values):
+        """ Set the properties in each dict from the iterable \"values\" (as fast as they come),
+        returns the number of dicts """
+        n = 0
+        for settings in values:
+            self.set(**settings)
+            n += 1
+        return n
+
+    async def feed_async(self, values):
+        """ Like feed, for an async iterable \"values\" """
+        n = 0
+        async for settings in values:
+            self.set(**settings)
+            n += 1
+        return n
+
+    def close(self):
+        """ Drop the values that haven't been sent yet """
+        with self.bridge.scheduler.lock:
+            commands = [command for (command, _) in self.pending.values()]
+        for command in commands:
+            command.cancel()
+
 class Group(object):
     """ Common functions for bulb/strip groups """
-    # static record of time that last command was executed
-    _last_command_time = time.time() 
+    # the scheduler, dispatch thread and timing are shared by all groups on the same bridge
     def get_last_time(self):
-        return self._last_command_time
+        return self.bridge.last_command_time
     def set_last_time(self, val):
-        self._last_command_time = val
+        self.bridge.last_command_time = val
     last_command_time = property(get_last_time, set_last_time)
-    # static queue for storing commands
-    _queue = PriorityQueue()
     def get_queue(self):
-        return self._queue
+        return self.bridge.scheduler
     queue = property(get_queue)
-    # static process for handling commands
-    _qprocess = Thread()
     def get_process(self):
-        return self._qprocess
+        return self.bridge.qprocess
     qprocess = property(get_process)
-    # static variable to indicate if all commands have been processed
-    _finished = True
     def get_finished(self):
-        return self._finished
+        return self.bridge.finished
     def set_finished(self, val):
-        self._finished = val
+        self.bridge.finished = val
     finished = property(get_finished, set_finished)
+    def get_metrics(self):
+        return self.bridge.metrics
+    metrics = property(get_metrics)
+    # priority of the commands of this group (higher is sent first when several are due), and
+    # the time in seconds after which a command that couldn't be sent is dropped (None: never)
+    priority = 0
+    max_delay = None
     # initialisation
-    def ___init___(self, ip_address, port=8899, pause=0.1, group=None):
-        """ init """
-        self.ip_address = ip_address
+    def ___init___(self, ip_address, port=8899, pause=0.1, group=None, cache=False):
+        """ init, \"ip_address\" can also be the mac address of the bridge (see resolve_bridge).
+        If \"cache\" is True the bridge skips commands that don't change the state of the
+        lights (see Bridge.enable_cache), with cache='shared' that state is shared with other
+        processes (see SharedStateCache). """
+        self.ip_address = resolve_bridge(ip_address)
         self.port = port
         if pause <= 0:
             pause = 0.1
@@ -83,58 +1949,127 @@ class Group(object):
             self.group = str(group)
         else:
             self.group = 'ALL'
-        if self.qprocess._target is None:
-            self.qprocess._target = self.qworker
-            self.qprocess.daemon = True
-            self.qprocess.start()
-        
-    def qworker(self):
-        """ Process command queue """
-        while True:
-            (cmdtime,command,group) = self.queue.get()
-            self.finished = False
-            if cmdtime is None:
-                cmdtime = time.time()
-            # Lights require time between commands, 100ms is recommended by the documentation
-            pause_remaining = max(cmdtime - time.time(),
-                                      (self.pause - (time.time() - self.last_command_time)))
-            if pause_remaining > 0:
-                time.sleep(pause_remaining)
-            # open the connection and send the command(s)
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)                
-            if group is not None:
-                oncmd = self.GROUP_ON[group] + b"\x00" + b"\x55"
-                sock.sendto(oncmd, (self.ip_address, self.port))
-                time.sleep(self.pause)    
-            self.last_command_time = time.time()
-            sock.sendto(command, (self.ip_address, self.port))
-            # close the connection and flag if the queue is empty
-            sock.close()
-            self.queue.task_done()
-            if self.queue.empty():
-                self.finished = True
+        self.bridge = Bridge.get(self.ip_address, port, pause)
+        if cache:
+            self.bridge.enable_cache(shared=(cache == 'shared'))
+
+    def enable_metrics(self, enable=True):
+        """ Record metrics of the commands sent to the bridge of this group (see Bridge.enable_metrics) """
+        return self.bridge.enable_metrics(enable)
+
+    def limit_queue(self, maxsize=0, policy='reject'):
+        """ Limit the command queue of the bridge of this group (see Bridge.limit_queue) """
+        self.bridge.limit_queue(maxsize, policy)
+
+    def deadline(self, when, deadline=None):
+        """ return the deadline of a command to be sent at \"when\" (monotonic clock), or None:
+        (epoch) time \"deadline\" if it is given, else \"when\" plus max_delay """
+        if deadline is not None:
+            return monotonic_time(deadline)
+        if self.max_delay is None:
+            return None
+        return when + self.max_delay
+
+    def select_command(self, group=None):
+        """ return the command which selects \"group\" (default: this group) on the bridge """
+        if group is None:
+            group = self.group
+        return self.GROUP_ON[group] + b"\x00" + b"\x55"
+
+    def group_key(self):
+        """ return the (kind, group) tuple which identifies this group on its bridge """
+        return (self.KIND, self.group)
 
     def empty_queue(self, when=None):
-        """ Empty the command queue without executing the commands """
+        """ Empty the command queue (for all groups on this bridge) without executing the commands """
         now = time.time()
         if (when is not None) and (when > now):
             time.sleep(when - now)
-        while not self.queue.empty():
-            self.queue.get()
-            self.queue.task_done()
+        return self.queue.clear()
 
-    def send_commands(self, command, steps=1, period=None, pause=None, when=None,
+    def cancel(self, when=None):
+        """ Cancel the queued commands of this group, returns the number of commands cancelled """
+        now = time.time()
+        if (when is not None) and (when > now):
+            time.sleep(when - now)
+        return self.queue.cancel_group(self.group_key())
+
+    def get_state(self):
+        """ return the known state of this group (empty if the bridge cache isn't enabled) """
+        cache = self.bridge.cache
+        if cache is None:
+            return dict()
+        return cache.get(self.group_key())
+    state = property(get_state)
+
+    def update_state(self, state, steps=1, when=None):
+        """ Check a command with (property, value) pairs \"state\", to be sent at \"when\" (monotonic
+        clock, None: after all queued commands, see state_time), against the bridge cache (if it
+        is enabled), and cancel the queued commands due before it that set the same property.
+        Returns False if the command wouldn't change the state that has been sent, and should be
+        skipped. The state itself is recorded when the command has been sent (see make_commands). """
+        cache = self.bridge.cache
+        if (cache is None) or (state is None):
+            return True
+        key = self.state_key(state, steps)
+        if key is not None:
+            group = self.group_key()
+            if cache.unchanged(group, state) and not self.pending(key, when):
+                cache.count(elided=1, saved_time=self.bridge.pause)
+                return False
+            # fold queued commands that set the same property into this one
+            coalesced = self.queue.cancel_group(group, key, when)
+            cache.count(coalesced=coalesced, saved_time=coalesced*self.bridge.pause)
+        return True
+
+    @staticmethod
+    def state_time(plan, when=None):
+        """ return the time (monotonic clock) at which the commands of \"plan\" (see plan_commands)
+        take effect, for update_state. A Scene plans the commands without a time (\"when\" is None)
+        after the queued ones, whatever time they have now, so that is None for those. """
+        if (when is None) and (Scene.current() is not None):
+            return None
+        return monotonic_time(plan[0][0])
+
+    def pending(self, key, when=None):
+        """ return the queued commands due at or before \"when\" (monotonic clock, None: any time)
+        which may change property \"key\" of this group: the ones for this group (or for all groups
+        of its kind, or any group of its kind if this is 'ALL') that set \"key\" or a relative value """
+        (kind, number) = self.group_key()
+        bridge = self.bridge
+        with bridge.scheduler.lock:
+            commands = bridge.scheduler.queued()
+            if bridge._selected is not None:
+                commands.append(bridge._selected)
+        return [c for c in commands if (c.group is not None) and (c.group[0] == kind)
+                    and ('ALL' in (number, c.group[1]) or (c.group[1] == number))
+                    and (c.key in (None, key)) and ((when is None) or (c.when <= when))]
+
+    def record_state(self, done, state):
+        """ return a done callback which records \"state\" in the bridge cache when the command
+        has been sent, before calling \"done\" """
+        group = self.group_key()
+        bridge = self.bridge
+        def recorded(sent):
+            if sent and (bridge.cache is not None):
+                bridge.cache.update(group, state)
+            done(sent)
+        return recorded
+
+    @staticmethod
+    def state_key(state, steps=1):
+        """ return the property set by a command with \"state\", or None if it is a relative command """
+        if (state is None) or (steps != 1) or any(value is None for (_, value) in state):
+            return None
+        return state[-1][0]
+
+    def plan_commands(self, command, steps=1, period=None, pause=None, when=None,
                           interleave=False, byte2=b"\x00", byte3=b"\x55"):
-        """ Send \"steps\" repeats of \"command\" with pause of length \"pause\" inbetween, 
-        or if \"period\" is given then make pauses long enough so that commands are all sent
-        within that amount of time (in seconds). If \"when\" is supplied, only start sending the commands
-        at that time. If \"interleave\" is True (its False by default) then interleave commands with calls 
-        to \"on\" to ensure that all commands go to the same group number. In this case (interleave = True), 
-        the minimum delay between commands (default = 0.1) will be twice as large as normal (so 0.2 by default).
-        Optionally increment command with \"byte2\" and \"byte3\". """
+        """ Return the list of (cmdtime, command, select) tuples that send_commands queues
+        for the given arguments, \"select\" is the group selection command which the bridge
+        sends (one pause) before \"command\" if the group isn't selected already. """
         if command is None:
-            return
-        self.finished = False
+            return []
         steps = max(1, min(30, steps))  # value should be between 1 and 30
         command += byte2
         command += byte3
@@ -142,38 +2077,314 @@ class Group(object):
             pause = self.pause
         elif period is not None:
             pause = period / steps
-        if interleave and (pause < 2*(self.pause)):
-            pause = 2*(self.pause)
         if when is None:
             cmdtime = time.time()
         else:
             cmdtime = when
+        select = self.select_command()
+        plan = list()
         for i in range(0, steps):
-            if interleave or i == 0:
-                self.queue.put((cmdtime-self.pause,command,self.group))
-            else:
-                self.queue.put((cmdtime,command,None))
+            plan.append((cmdtime, command, select))
             cmdtime = cmdtime + pause
-        if not interleave:
-            self.queue.join()
-        return command
+        return plan
+
+    def send_commands(self, command, steps=1, period=None, pause=None, when=None,
+                          interleave=False, byte2=b"\x00", byte3=b"\x55", state=None,
+                          priority=None, deadline=None):
+        """ Send \"steps\" repeats of \"command\" with pause of length \"pause\" inbetween, 
+        or if \"period\" is given then make pauses long enough so that commands are all sent
+        within that amount of time (in seconds). If \"when\" is supplied, only start sending the commands
+        at that time. If \"interleave\" is True (its False by default) then return straight away, so the
+        commands can be interleaved with other commands. The bridge keeps track of the selected group, and
+        precedes a command with a call to \"on\" (which costs an extra pause) only when another group was
+        selected in the meantime, so all commands go to the same group number.
+        Optionally increment command with \"byte2\" and \"byte3\".
+        \"state\" is a list of the (property, value) pairs the command sets, used by the bridge cache.
+        \"priority\" overrides the priority of the group for these commands, and \"deadline\" is the
+        (epoch) time after which they are dropped if they couldn't be sent yet (default: max_delay
+        after their scheduled time, see Bridge.put).
+        Returns a concurrent.futures.Future which is done when the commands of this call
+        have been sent (its result is the command), or cancelled when they are dropped
+        by empty_queue or cancel. Cancelling the future cancels the commands that haven't
+        been sent yet. If \"interleave\" is False this only returns once it is done (unless a Scene
+        is being recorded, see Scene). If the command was skipped because it doesn't change the state the result is None.
+        Raises queue.Full if the queue of the bridge is full (see limit_queue). """
+        future = Future()
+        plan = self.plan_commands(command, steps, period, pause, when, interleave, byte2, byte3)
+        if (not plan) or (not self.update_state(state, steps, self.state_time(plan, when))):
+            future.set_result(None)
+            return future
+        done = self._tracker(future, plan[0][1], len(plan))
+        commands = self.make_commands(plan, done, state, steps, priority, deadline)
+        def cancelled(f):
+            if f.cancelled():
+                # wake up threads that wait on the future
+                f.set_running_or_notify_cancel()
+                for c in commands:
+                    c.cancel()
+        future.add_done_callback(cancelled)
+        if (self.queue_commands(commands, when is None) is None) and not interleave:
+            self.wait_for(future)
+        return future
+
+    def make_commands(self, plan, done, state=None, steps=1, priority=None, deadline=None):
+        """ return the Commands for the (cmdtime, command, select) tuples in \"plan\", which
+        record \"state\" in the bridge cache once they have been sent (see send_commands for
+        \"priority\" and \"deadline\") """
+        if priority is None:
+            priority = self.priority
+        group = self.group_key()
+        key = self.state_key(state, steps)
+        if (state is not None) and (self.bridge.cache is not None):
+            done = self.record_state(done, state)
+        commands = list()
+        for (cmdtime, packet, select) in plan:
+            when = monotonic_time(cmdtime)
+            commands.append(Command(when, packet, select, group, done, key, priority, self.deadline(when, deadline)))
+        return commands
+
+    def queue_commands(self, commands, immediate=False):
+        """ Queue \"commands\" on the bridge, or add them to the current Scene if there is one
+        (which is returned). \"immediate\" is True if they weren't given a time to be sent. """
+        scene = Scene.current()
+        if scene is not None:
+            scene.add(self.bridge, commands, immediate)
+            return scene
+        try:
+            for command in commands:
+                self.bridge.put_command(command)
+        except Full:
+            # the queue is full, drop the whole call
+            for command in commands:
+                command.cancel()
+            raise
+        return None
+
+    def new_future(self):
+        """ return a new future for the result of an action """
+        return Future()
+
+    def wait_for(self, future):
+        """ Wait until \"future\" is done (or cancelled) """
+        wait([future])
+
+    def send_sequence(self, steps, when=None, interleave=False, priority=None, deadline=None):
+        """ Send the (offset, command, state) tuples from the iterator \"steps\", where \"offset\" is
+        the time in seconds after \"when\" (default: now) at which \"command\" should be sent, and
+        \"state\" the (property, value) pairs it sets in the bridge cache once it is sent. The tuples
+        are only taken from the iterator once the previous command has been sent, so a sequence
+        can be long (or endless) without filling the queue. Starting a sequence cancels the
+        sequence that is running on this group (see stop_sequence).
+        Returns a future like send_commands (its result is the number of commands sent), cancel
+        it to stop the sequence. If \"interleave\" is False this only returns once it is done.
+        \"priority\" and \"deadline\" apply to every command of the sequence (see send_commands). """
+        bridge = self.bridge
+        if priority is None:
+            priority = self.priority
+        future = self.new_future()
+        if when is None:
+            start = time.monotonic()
+        else:
+            start = monotonic_time(when)
+        group = self.group_key()
+        select = self.select_command()
+        steps = iter(steps)
+        lock = Lock()
+        # the command that is queued, its state, and the number of commands sent
+        current = [None, None, 0]
+        def queue_next():
+            step = next(steps, None)
+            if step is None:
+                current[0] = None
+                return False
+            (offset, packet, current[1]) = step
+            when = start + offset
+            current[0] = Command(when, packet, select, group, done, None, priority, self.deadline(when, deadline))
+            try:
+                bridge.put_command(current[0])
+            except Full:
+                # the queue is full, which stops the sequence
+                current[0] = None
+                return None
+            return True
+        def done(sent):
+            with lock:
+                if future.done():
+                    return
+                if sent:
+                    current[2] += 1
+                    if (current[1] is not None) and (bridge.cache is not None):
+                        bridge.cache.update(group, current[1])
+                    running = queue_next()
+                    if running:
+                        return
+            if (not sent) or (running is None):
+                # outside the lock, the cancel callback takes it
+                future.cancel()
+                return
+            try:
+                future.set_result(current[2])
+            except InvalidStateError:
+                pass
+        def cancelled(f):
+            if f.cancelled():
+                if isinstance(f, Future):
+                    f.set_running_or_notify_cancel()
+                with lock:
+                    command = current[0]
+                if command is not None:
+                    command.cancel()
+        future.add_done_callback(cancelled)
+        self.stop_sequence()
+        with bridge.scheduler.lock:
+            bridge.sequences[group] = future
+        with lock:
+            running = queue_next()
+        if running is None:
+            future.cancel()
+        elif not running:
+            future.set_result(0)
+        elif not interleave:
+            self.wait_for(future)
+        return future
+
+    def stop_sequence(self):
+        """ Stop the sequence (e.g. a fade) that is running on this group, returns True if there was one """
+        with self.bridge.scheduler.lock:
+            future = self.bridge.sequences.pop(self.group_key(), None)
+        return (future is not None) and future.cancel()
 
-    def on(self, when=None):
+    @staticmethod
+    def _tracker(future, result, count):
+        """ Return a callback which completes \"future\" after it has been called \"count\" times """
+        remaining = [count]
+        lock = Lock()
+        def done(sent):
+            with lock:
+                remaining[0] -= 1
+                last = (remaining[0] == 0)
+            if future.done():
+                return
+            if not sent:
+                future.cancel()
+            elif last:
+                try:
+                    future.set_result(result)
+                except InvalidStateError:
+                    pass  # cancelled while the last command was being sent
+        return done
+
+    def on(self, when=None, priority=None, deadline=None):
         """ Switch group on """
-        if not self.qprocess.is_alive():
-            # make sure we can send commands to the queue
-            self.qprocess = Process(target=self.qworker)
-            self.qprocess.daemon = True
-            self.qprocess.start()
-        self.send_commands(command=self.GROUP_ON[self.group], when=when)
+        # make sure we can send commands to the queue
+        self.bridge.start()
+        return self.send_commands(command=self.GROUP_ON[self.group], when=when,
+                                  state=[('on', True)], priority=priority, deadline=deadline)
         
-    def off(self, when=None):
+    def off(self, when=None, priority=None, deadline=None):
         """ Switch group off """
-        self.send_commands(self.GROUP_OFF[self.group], when=when)
+        return self.send_commands(self.GROUP_OFF[self.group], when=when, state=[('on', False)],
+                                  priority=priority, deadline=deadline)
+
+    def send_schedule(self, timestamps, groups=None, opcodes=None, values=None, start=None):
+        """ Send a whole (pre-planned) schedule in one call: command opcodes[i] with byte2 values[i]
+        (default: 0) to group groups[i] (1 to 4, or 0 or 'ALL'; default: this group) at
+        timestamps[i] seconds after (epoch) time \"start\" (default: now). The packets are taken
+        from the PACKETS table and the commands are merged into the queue of the bridge in one
+        operation. \"timestamps\" can also be a numpy structured array (or any array with
+        dtype.names) with fields 'timestamp', 'group', 'opcode' and 'value'.
+        Returns a future which is done (with the number of commands sent) when all commands
+        have been sent or dropped, cancelling it cancels the commands that haven't been sent.
+        The state of the groups in the bridge cache becomes unknown. """
+        names = getattr(getattr(timestamps, 'dtype', None), 'names', None)
+        if names:
+            schedule = timestamps
+            timestamps = schedule['timestamp'].tolist()
+            groups = schedule['group'].tolist() if 'group' in names else None
+            opcodes = schedule['opcode'].tolist()
+            values = schedule['value'].tolist() if 'value' in names else None
+        if opcodes is None:
+            raise ValueError('A schedule needs opcodes')
+        n = len(timestamps)
+        if groups is None:
+            groups = [self.group] * n
+        if values is None:
+            values = [0] * n
+        if not (n == len(groups) == len(opcodes) == len(values)):
+            raise ValueError('The columns of a schedule must have the same length')
+        for value in values:
+            if not (0 <= value <= 255):
+                raise ValueError('Invalid value in schedule (should be 0 to 255): ' + str(value))
+        future = self.new_future()
+        if n == 0:
+            future.set_result(0)
+            return future
+        base = time.monotonic() if start is None else monotonic_time(start)
+        kind = self.KIND
+        # selection and (kind, group) per group number
+        selects = dict()
+        for group in set(groups):
+            number = str(group) if str(group) in ('1', '2', '3', '4') else 'ALL'
+            selects[group] = (self.select_command(number), (kind, number))
+        counts = [n, 0]
+        lock = Lock()
+        def done(sent):
+            with lock:
+                counts[0] -= 1
+                counts[1] += 1 if sent else 0
+                last = (counts[0] == 0)
+            if last and not future.done():
+                future.set_result(counts[1])
+        priority = self.priority
+        max_delay = self.max_delay
+        commands = list()
+        try:
+            for (offset, group, opcode, value) in zip(timestamps, groups, opcodes, values):
+                when = base + offset
+                (select, key) = selects[group]
+                commands.append(Command(when, PACKETS[opcode][value], select, key, done, None, priority,
+                                        None if max_delay is None else when + max_delay))
+        except KeyError:
+            raise ValueError('Unknown opcode in schedule: ' + str(opcode))
+        def cancelled(f):
+            if f.cancelled():
+                if isinstance(f, Future):
+                    f.set_running_or_notify_cancel()
+                for c in commands:
+                    c.cancel()
+        future.add_done_callback(cancelled)
+        bridge = self.bridge
+        if bridge.cache is not None:
+            for (_, key) in selects.values():
+                bridge.cache.invalidate(key, [(prop, None) for prop in ('on', 'mode', 'brightness', 'speed', 'warmth')])
+        try:
+            bridge.put_commands(commands)
+        except Full:
+            for command in commands:
+                command.cancel()
+            raise
+        return future
+
+    def stream(self):
+        """ Return a new Stream for this group, which sends only the newest value of each property:
+            stream = grp.stream()
+            for level in levels:
+                stream.set(brightness=level)
+        """
+        self.bridge.start()
+        return Stream(self)
+
+    def stream_command(self, prop, value):
+        """ return the (packet, state) which sets property \"prop\" to \"value\" in a Stream """
+        if prop == 'on':
+            commands = self.GROUP_ON if value else self.GROUP_OFF
+            return (commands[self.group] + b"\x00\x55", [('on', bool(value))])
+        raise ValueError('Property ' + str(prop) + ' can not be streamed to a ' + self.KIND + ' group')
 
             
 class ColorGroup(Group):
     """ A group of RGBW color bulbs/strips """
+    KIND = 'RGBW'
     # Standard ON/OFF
     RGBW_ALL_ON = (66).to_bytes(1, byteorder='big')
     RGBW_ALL_OFF = (65).to_bytes(1, byteorder='big')
@@ -255,41 +2466,75 @@ class ColorGroup(Group):
         "ORCHID": b"\xE0",
         "LAVENDER": b"\xF0"
     }
-    def __init__(self, ip_address, port=8899, pause=0.1, group=None):
+    def __init__(self, ip_address, port=8899, pause=0.1, group=None, cache=False):
         """ init """
-        super().___init___(ip_address, port, pause, group)
+        super().___init___(ip_address, port, pause, group, cache)
 
-    def white(self, when=None):
+    def white(self, when=None, priority=None, deadline=None):
         """ Switch to white """
-        self.send_commands(command=self.GROUP_WHITE[self.group], when=when)
+        return self.send_commands(command=self.GROUP_WHITE[self.group], when=when,
+                                  state=[('on', True), ('mode', 'white')],
+                                  priority=priority, deadline=deadline)
 
-    def brightness(self, value=10, when=None):
+    def brightness(self, value=10, when=None, priority=None, deadline=None):
         """ Set brightness level """
         value += 2                      # value should be between 0 and 25
         value = max(2, min(27, value))  # value should be between 2 and 27
-        self.send_commands(command=self.BRIGHTNESS, when=when, byte2=(value).to_bytes(1, byteorder='big'))
+        return self.send_commands(command=self.BRIGHTNESS, when=when, byte2=(value).to_bytes(1, byteorder='big'),
+                                  state=[('on', True), ('brightness', value - 2)],
+                                  priority=priority, deadline=deadline)
 
-    def disco(self, mode='', when=None):
+    def disco(self, mode='', when=None, priority=None, deadline=None):
         """ Enable disco mode, if no valid mode is provided the default disco mode is started """
         if mode.upper() in self.DISCO_CODES:
             command = self.DISCO_CODE + self.DISCO_CODES[mode.upper()]
-            self.send_commands(command=command, when=when, byte2=b"", byte3=b"")
+            return self.send_commands(command=command, when=when, byte2=b"", byte3=b"",
+                                      state=[('on', True), ('mode', 'disco ' + mode.lower())],
+                                      priority=priority, deadline=deadline)
         else:
-            self.send_commands(comand=self.DISCO_MODE)
+            return self.send_commands(command=self.DISCO_MODE, when=when,
+                                      state=[('on', True), ('mode', None)],
+                                      priority=priority, deadline=deadline)
 
-    def increase_disco_speed(self, steps=1, period=None, pause=None, when=None, interleave=False):
+    def increase_disco_speed(self, steps=1, period=None, pause=None, when=None, interleave=False,
+                             priority=None, deadline=None):
         """ Increase disco_speed """
-        self.send_commands(command=self.DISCO_SPEED_FASTER, steps=steps,
-                               period=period, pause=pause, when=when,  interleave=interleave)
+        return self.send_commands(command=self.DISCO_SPEED_FASTER, steps=steps,
+                               period=period, pause=pause, when=when,  interleave=interleave,
+                               state=[('on', True), ('speed', None)], priority=priority, deadline=deadline)
 
-    def decrease_disco_speed(self, steps=1, period=None, pause=None, when=None, interleave=False):
+    def decrease_disco_speed(self, steps=1, period=None, pause=None, when=None, interleave=False,
+                             priority=None, deadline=None):
         """ Decrease disco_speed """
-        self.send_commands(command=self.DISCO_SPEED_SLOWER, steps=steps,
-                               period=period, pause=pause, when=when, interleave=interleave)
+        return self.send_commands(command=self.DISCO_SPEED_SLOWER, steps=steps,
+                               period=period, pause=pause, when=when, interleave=interleave,
+                               state=[('on', True), ('speed', None)], priority=priority, deadline=deadline)
 
-    def color(self, value, when=None):
+    def color(self, value, when=None, priority=None, deadline=None):
         """ Set color """
+        colorcode = self.color_code(value)
+        return self.send_commands(command=self.COLOR, when=when, byte2=colorcode,
+                                  state=[('on', True), ('mode', 'color %d' % colorcode[0])],
+                                  priority=priority, deadline=deadline)
+
+    def stream_command(self, prop, value):
+        """ return the (packet, state) which sets property \"prop\" ('on', 'brightness' or 'color')
+        to \"value\" in a Stream """
+        if prop == 'brightness':
+            value = max(2, min(27, int(value) + 2))
+            return (self.BRIGHTNESS + (value).to_bytes(1, byteorder='big') + b"\x55",
+                    [('on', True), ('brightness', value - 2)])
+        if prop == 'color':
+            colorcode = self.color_code(value)
+            return (self.COLOR + colorcode + b"\x55", [('on', True), ('mode', 'color %d' % colorcode[0])])
+        return Group.stream_command(self, prop, value)
+
+    def color_code(self, value):
+        """ return the color code (1 byte) for \"value\", see color """
         colorcode = None
+        if (type(value) is str) and HEX_COLOR.match(value.strip()):
+            # before the integer conversion, hex colors can consist of decimal digits only
+            return (rgb_code(value)[0]).to_bytes(1, byteorder='big')
         try:
             cvalue = int(value)
             value = cvalue
@@ -299,22 +2544,176 @@ class ColorGroup(Group):
             if len(value) == 1:
                 colorcode = value
             else:
-                ValueError('The requested color value in bytes should be between x00 and xFF (= 1 byte), received ' + len(value) + ' bytes')
+                raise ValueError('The requested color value in bytes should be between x00 and xFF (= 1 byte), received ' + str(len(value)) + ' bytes')
         elif type(value) is int:
             value = max(0, min(255, value))  # value should be between 0 and 255
             colorcode = (value).to_bytes(1, byteorder='big')
         elif type(value) is str:
             if value.upper() in self.COLOR_CODES:
                 colorcode = self.COLOR_CODES[value.upper()]
+            elif value.startswith('#'):
+                colorcode = (rgb_code(value)[0]).to_bytes(1, byteorder='big')
             else:
-                ValueError('The requested color as string should be valid (see self.COLOR_CODES)')
+                raise ValueError('The requested color as string should be valid (see self.COLOR_CODES)')
+        elif type(value) in (tuple, list):
+            colorcode = (rgb_code(value)[0]).to_bytes(1, byteorder='big')
         else:
-            raise ValueError('Invalid color requested (supported types: byte, integer, string)')
+            raise ValueError('Invalid color requested (supported types: byte, integer, string, RGB tuple)')
         if colorcode is not None:
-            self.send_commands(command=self.COLOR, when=when, byte2=colorcode)
+            return colorcode
         else:
             raise ValueError('Invalid color requested (unspecified error, value-type: ' + str(type(value)) + ')')
 
+    def rgb(self, value, when=None, interleave=False, priority=None, deadline=None):
+        """ Set the color and brightness of RGB color \"value\" (an (r, g, b) tuple or a hex string
+        like '#FF8000'), unsaturated colors (greys) switch to white. The bulbs have a fixed
+        saturation, so only the hue and the brightness of the color are shown. Returns a future
+        like send_sequence. """
+        (hue, level) = rgb_code(value)
+        return self.send_sequence(self.color_steps(hue, level), when=when, interleave=interleave,
+                                  priority=priority, deadline=deadline)
+
+    def hsv(self, hue, saturation=1.0, value=1.0, when=None, interleave=False, priority=None, deadline=None):
+        """ Set the color and brightness of HSV color (\"hue\", \"saturation\", \"value\"), all between
+        0.0 and 1.0, unsaturated colors switch to white. Returns a future like send_sequence. """
+        level = int(round(max(0.0, min(1.0, value)) * 25))
+        if saturation < WHITE_SATURATION:
+            level |= WHITE_LEVEL
+        return self.send_sequence(self.color_steps(hue_code(hue % 1.0), level), when=when,
+                                  interleave=interleave, priority=priority, deadline=deadline)
+
+    def kelvin(self, value=None, when=None, priority=None, deadline=None):
+        """ Switch to white for color temperature \"value\" (in Kelvin): the white leds of RGBW bulbs
+        have a fixed color temperature, so any temperature is shown as white """
+        return self.white(when=when, priority=priority, deadline=deadline)
+
+    def color_steps(self, hue, level):
+        """ return the sequence (see send_sequence) which sets color code \"hue\" (or white, if
+        WHITE_LEVEL is set in \"level\") and brightness \"level\" """
+        if level & WHITE_LEVEL:
+            first = (self.GROUP_WHITE[self.group] + b"\x00\x55", [('on', True), ('mode', 'white')])
+        else:
+            first = (self.COLOR + (hue).to_bytes(1, byteorder='big') + b"\x55",
+                     [('on', True), ('mode', 'color %d' % hue)])
+        level = (level & (WHITE_LEVEL - 1)) + 2
+        return [(0, first[0], first[1]),
+                (0, self.BRIGHTNESS + (level).to_bytes(1, byteorder='big') + b"\x55",
+                 [('on', True), ('brightness', level - 2)])]
+
+    def color_schedule(self, colors, timestamps):
+        """ Convert RGB colors \"colors\" (see rgb_codes) shown at \"timestamps\" (seconds) to the
+        (timestamps, opcodes, values) columns of a schedule for send_schedule. Commands that
+        don't change the color or brightness of the frame before them are left out. For numpy
+        arrays the conversion is done with numpy (without a loop in Python). """
+        (hues, levels) = rgb_codes(colors)
+        white = self.GROUP_WHITE[self.group][0]
+        if hasattr(hues, 'dtype'):
+            import numpy
+            n = len(hues)
+            # per frame: the color (or white) command followed by the brightness command
+            is_white = (levels & WHITE_LEVEL) != 0
+            modes = numpy.where(is_white, 256, hues)
+            opcodes = numpy.empty((n, 2), dtype=numpy.intp)
+            opcodes[:, 0] = numpy.where(is_white, white, self.COLOR[0])
+            opcodes[:, 1] = self.BRIGHTNESS[0]
+            values = numpy.empty((n, 2), dtype=numpy.intp)
+            values[:, 0] = numpy.where(is_white, 0, hues)
+            values[:, 1] = (levels & (WHITE_LEVEL - 1)) + 2
+            changed = numpy.ones((n, 2), dtype=bool)
+            changed[1:, 0] = modes[1:] != modes[:-1]
+            changed[1:, 1] = values[1:, 1] != values[:-1, 1]
+            times = numpy.repeat(numpy.asarray(timestamps, dtype=float), 2).reshape(n, 2)
+            return (times[changed].tolist(), opcodes[changed].tolist(), values[changed].tolist())
+        times = list()
+        opcodes = list()
+        values = list()
+        (mode, brightness) = (None, None)
+        for (timestamp, hue, level) in zip(timestamps, hues, levels):
+            if level & WHITE_LEVEL:
+                command = (white, 0)
+            else:
+                command = (self.COLOR[0], hue)
+            if command != mode:
+                mode = command
+                times.append(timestamp)
+                opcodes.append(command[0])
+                values.append(command[1])
+            level = (level & (WHITE_LEVEL - 1)) + 2
+            if level != brightness:
+                brightness = level
+                times.append(timestamp)
+                opcodes.append(self.BRIGHTNESS[0])
+                values.append(level)
+        return (times, opcodes, values)
+
+    def send_colors(self, colors, timestamps, start=None):
+        """ Show RGB colors \"colors\" at \"timestamps\" seconds after (epoch) time \"start\" (default:
+        now), see color_schedule and send_schedule """
+        (timestamps, opcodes, values) = self.color_schedule(colors, timestamps)
+        return self.send_schedule(timestamps, None, opcodes, values, start)
+
+    def fade_to(self, brightness=None, color=None, duration=1.0, when=None, interleave=False,
+                    from_brightness=None, from_color=None, priority=None, deadline=None):
+        """ Fade smoothly to \"brightness\" (0 to 25) and/or \"color\" (see color) in \"duration\"
+        seconds, starting at \"when\" (default: now). The fade starts from \"from_brightness\"
+        and \"from_color\", or from the state in the bridge cache (see Bridge.enable_cache) if they
+        aren't given. When the start is unknown the target is set straight away. The color takes
+        the shortest way around the color wheel, and no more steps are used than the bridge
+        pacing allows (or than there are values in between). Starting a fade cancels the fade
+        (or other sequence) that is running on this group. Returns a future like send_commands. """
+        self.stop_sequence()
+        state = self.state
+        fades = list()
+        if brightness is not None:
+            brightness = max(0, min(25, int(brightness)))
+            if from_brightness is None:
+                from_brightness = state.get('brightness')
+            if not isinstance(from_brightness, int):
+                from_brightness = brightness
+            fades.append((self.BRIGHTNESS, from_brightness, brightness, 0))
+        if color is not None:
+            color = self.color_code(color)[0]
+            if from_color is None:
+                mode = state.get('mode') or ''
+                if mode.startswith('color '):
+                    from_color = int(mode[6:])
+            else:
+                from_color = self.color_code(from_color)[0]
+            if from_color is None:
+                from_color = color
+            # take the shortest way around the color wheel
+            distance = (color - from_color + 128) % 256 - 128
+            fades.append((self.COLOR, from_color, from_color + distance, 256))
+        return self.send_sequence(self.fade_steps(fades, duration), when=when, interleave=interleave,
+                                  priority=priority, deadline=deadline)
+
+    def fade_steps(self, fades, duration):
+        """ Generate the (offset, command, state) tuples of a fade, \"fades\" is a list of (command,
+        start, end, modulo) tuples with the values to fade in between (modulo 256 for colors, 0 for
+        brightness) """
+        # each step sends one packet per faded value, and the bridge needs a pause after each
+        pause = self.bridge.pause * max(1, len(fades))
+        distance = max([abs(end - start) for (_, start, end, _) in fades] + [0])
+        steps = max(1, min(distance, int(duration / pause)))
+        sent = dict()
+        for i in range(1, steps + 1):
+            # with nothing in between (e.g. the start is unknown) the target is set straight away
+            offset = duration * i / steps if distance else 0.0
+            for (command, start, end, modulo) in fades:
+                value = int(round(start + (end - start) * i / steps))
+                if modulo:
+                    value = value % modulo
+                else:
+                    value = value + 2   # brightness values are 2 to 27
+                if sent.get(command) == value:
+                    continue
+                sent[command] = value
+                if modulo:
+                    state = [('on', True), ('mode', 'color %d' % value)]
+                else:
+                    state = [('on', True), ('brightness', value - 2)]
+                yield (offset, command + (value).to_bytes(1, byteorder='big') + b"\x55", state)
+
     def disco_codes(self):
         """ return the disco-codes """
         return [c.lower() for c in self.DISCO_CODES.keys()]
@@ -325,6 +2724,7 @@ class ColorGroup(Group):
 
 class WhiteGroup(Group):
     """ A group of white bulbs/strips """
+    KIND = 'WHITE'
 
     # Standard ON/OFF
     WHITE_ALL_ON = (53).to_bytes(1, byteorder='big')
@@ -385,57 +2785,249 @@ class WhiteGroup(Group):
         '4': NIGHT_MODE_GROUP_4
     }
 
-    def __init__(self, ip_address, port=8899, pause=0.1, group=None):
+    def __init__(self, ip_address, port=8899, pause=0.1, group=None, cache=False):
         """ init """
-        super().___init___(ip_address, port, pause, group)
+        super().___init___(ip_address, port, pause, group, cache)
 
-    def increase_brightness(self, steps=1, period=None, pause=None, when=None, interleave=False):
+    def increase_brightness(self, steps=1, period=None, pause=None, when=None, interleave=False,
+                            priority=None, deadline=None):
         """ Increase brightness """
-        self.send_commands(self.BRIGHTNESS_UP, steps=steps, period=period, pause=pause,
-                               when=when, interleave=interleave)
+        return self.send_commands(self.BRIGHTNESS_UP, steps=steps, period=period, pause=pause,
+                               when=when, interleave=interleave, state=[('on', True), ('brightness', None)],
+                               priority=priority, deadline=deadline)
 
-    def decrease_brightness(self, steps=1, period=None, pause=None, when=None, interleave=False):
+    def decrease_brightness(self, steps=1, period=None, pause=None, when=None, interleave=False,
+                            priority=None, deadline=None):
         """ Decrease brightness """
-        self.send_commands(self.BRIGHTNESS_DOWN, steps=steps, period=period, pause=pause,
-                               when=when, interleave=interleave)
+        return self.send_commands(self.BRIGHTNESS_DOWN, steps=steps, period=period, pause=pause,
+                               when=when, interleave=interleave, state=[('on', True), ('brightness', None)],
+                               priority=priority, deadline=deadline)
 
-    def increase_warmth(self, steps=1, period=None, pause=None, when=None, interleave=False):
+    def increase_warmth(self, steps=1, period=None, pause=None, when=None, interleave=False,
+                        priority=None, deadline=None):
         """ Increase warmth """
-        self.send_commands(self.WARM_WHITE_INCREASE, steps=steps,  period=period, pause=pause,
-                               when=when, interleave=interleave)
+        return self.send_commands(self.WARM_WHITE_INCREASE, steps=steps,  period=period, pause=pause,
+                               when=when, interleave=interleave, state=[('on', True), ('warmth', None)],
+                               priority=priority, deadline=deadline)
 
-    def decrease_warmth(self, steps=1, period=None, pause=None, when=None, interleave=False):
+    def decrease_warmth(self, steps=1, period=None, pause=None, when=None, interleave=False,
+                        priority=None, deadline=None):
         """ Decrease warmth """
-        self.send_commands(self.COOL_WHITE_INCREASE, steps=steps, period=period, pause=pause, 
-                               when=when, interleave=interleave)
+        return self.send_commands(self.COOL_WHITE_INCREASE, steps=steps, period=period, pause=pause, 
+                               when=when, interleave=interleave, state=[('on', True), ('warmth', None)],
+                               priority=priority, deadline=deadline)
 
-    def brightmode(self, when=None):
+    def brightmode(self, when=None, priority=None, deadline=None):
         """ Enable full brightness """
-        self.send_commands(self.FULL_BRIGHTNESS[self.group], when=when)
+        return self.send_commands(self.FULL_BRIGHTNESS[self.group], when=when,
+                                  state=[('on', True), ('brightness', 'full')],
+                                  priority=priority, deadline=deadline)
 
-    def nightmode(self, when=None):
+    def nightmode(self, when=None, priority=None, deadline=None):
         """ Enable nightmode """
-        self.send_commands(self.NIGHT_MODE[self.group], when=when)
+        return self.send_commands(self.NIGHT_MODE[self.group], when=when,
+                                  state=[('brightness', None), ('on', 'night')],
+                                  priority=priority, deadline=deadline)
+
+# first byte of the commands that select a group on the bridge: (kind, group, on)
+GROUP_SELECTS = dict()
+for cls in (ColorGroup, WhiteGroup):
+    for (group, command) in cls.GROUP_ON.items():
+        GROUP_SELECTS[command[0]] = (cls.KIND, group, True)
+    for (group, command) in cls.GROUP_OFF.items():
+        GROUP_SELECTS[command[0]] = (cls.KIND, group, False)
+del cls, group, command
+
+# state properties changed by each opcode, and whether it sets them to an absolute value:
+# (properties, absolute), see Redundancy
+PROPERTIES = dict()
+for cls in (ColorGroup, WhiteGroup):
+    for name in ('GROUP_ON', 'GROUP_OFF'):
+        for command in getattr(cls, name).values():
+            PROPERTIES[command[0]] = (('on',), True)
+    for name in ('NIGHT_MODE', 'FULL_BRIGHTNESS'):
+        for command in getattr(cls, name, {}).values():
+            PROPERTIES[command[0]] = (('on', 'brightness'), True)
+    for command in getattr(cls, 'GROUP_WHITE', {}).values():
+        PROPERTIES[command[0]] = (('mode',), True)
+PROPERTIES[ColorGroup.BRIGHTNESS[0]] = (('brightness',), True)
+PROPERTIES[ColorGroup.COLOR[0]] = (('mode',), True)
+PROPERTIES[ColorGroup.DISCO_MODE[0]] = (('mode',), False)
+PROPERTIES[ColorGroup.DISCO_SPEED_FASTER[0]] = (('speed',), False)
+PROPERTIES[ColorGroup.DISCO_SPEED_SLOWER[0]] = (('speed',), False)
+PROPERTIES[WhiteGroup.BRIGHTNESS_UP[0]] = (('brightness',), False)
+PROPERTIES[WhiteGroup.BRIGHTNESS_DOWN[0]] = (('brightness',), False)
+PROPERTIES[WhiteGroup.WARM_WHITE_INCREASE[0]] = (('warmth',), False)
+PROPERTIES[WhiteGroup.COOL_WHITE_INCREASE[0]] = (('warmth',), False)
+del cls, name, command
+
+# packet (command, byte2 and 0x55) for every opcode and value, see Group.send_schedule
+PACKETS = dict()
+for cls in (ColorGroup, WhiteGroup):
+    for (name, value) in vars(cls).items():
+        if name.isupper() and (type(value) is bytes) and (len(value) == 1):
+            PACKETS[value[0]] = None
+        elif name in ('GROUP_ON', 'GROUP_OFF', 'GROUP_WHITE', 'FULL_BRIGHTNESS', 'NIGHT_MODE'):
+            for command in value.values():
+                PACKETS[command[0]] = None
+for opcode in PACKETS:
+    PACKETS[opcode] = tuple(bytes((opcode, byte2, 0x55)) for byte2 in range(256))
+PACKETS = types.MappingProxyType(PACKETS)
+del cls, name, value, command, opcode
+
+# the RGB color table quantises each channel to COLOR_BITS bits, see color_table
+COLOR_BITS = 5
+# colors with a lower saturation are shown in white mode
+WHITE_SATURATION = 0.2
+# flag in the levels of color_table (and rgb_codes) for colors that are shown in white mode
+WHITE_LEVEL = 0x80
+_color_table = None
+_color_table_lock = Lock()
+
+def hue_code(hue):
+    """ return the MiLight color code (0 to 255) for \"hue\" (0.0 to 1.0, 0.0 is red); the MiLight
+    color wheel runs the other way round and starts at violet (red is 176) """
+    return (176 - int(round(hue * 256))) % 256
+
+def color_table():
+    """ return the (hues, levels) lookup tables (bytes) from quantised RGB to the MiLight color
+    code and brightness (0 to 25, plus WHITE_LEVEL for unsaturated colors), indexed by
+    (r << 2 * COLOR_BITS) | (g << COLOR_BITS) | b with r, g and b the top COLOR_BITS bits of
+    each channel. The tables are computed the first time they are needed. """
+    global _color_table
+    with _color_table_lock:
+        if _color_table is None:
+            top = (1 << COLOR_BITS) - 1
+            channel = [q / top for q in range(top + 1)]
+            hues = bytearray()
+            levels = bytearray()
+            for r in channel:
+                for g in channel:
+                    for b in channel:
+                        (h, s, v) = colorsys.rgb_to_hsv(r, g, b)
+                        hues.append(hue_code(h))
+                        levels.append(int(round(v * 25)) | (WHITE_LEVEL if s < WHITE_SATURATION else 0))
+            _color_table = (bytes(hues), bytes(levels))
+        return _color_table
+
+def color_index(red, green, blue):
+    """ return the index of the (0 to 255) RGB color in color_table """
+    shift = 8 - COLOR_BITS
+    return ((red >> shift) << (2 * COLOR_BITS)) | ((green >> shift) << COLOR_BITS) | (blue >> shift)
+
+def parse_rgb(value):
+    """ return the (red, green, blue) tuple (0 to 255) of \"value\": a tuple or list of 3 integers,
+    or a hex string ('#RRGGBB' or '#RGB') """
+    if type(value) is str:
+        digits = value.strip().lstrip('#')
+        if len(digits) == 3:
+            digits = ''.join(d * 2 for d in digits)
+        try:
+            if len(digits) != 6:
+                raise ValueError
+            return tuple(int(digits[i:i + 2], 16) for i in (0, 2, 4))
+        except ValueError:
+            raise ValueError('Invalid hex color: ' + value)
+    if (type(value) in (tuple, list)) and (len(value) == 3):
+        return tuple(max(0, min(255, int(c))) for c in value)
+    raise ValueError('Invalid RGB color requested (supported types: (r, g, b) tuple, hex string)')
 
-def apply2grps(grps, fn, delay=0, args=None):
+def rgb_code(value):
+    """ return the (color code, level) of RGB color \"value\" (see parse_rgb) from color_table """
+    (hues, levels) = color_table()
+    index = color_index(*parse_rgb(value))
+    return (hues[index], levels[index])
+
+def rgb_codes(colors):
+    """ Convert a batch of RGB colors to (hues, levels) with color_table, see rgb_code. \"colors\"
+    is a numpy array of shape (..., 3), a bytes-like object with 3 bytes (r, g, b) per color or
+    a sequence of (r, g, b) tuples. For numpy arrays the conversion is done with numpy indexing
+    (without a loop in Python) and numpy arrays are returned, otherwise bytes. """
+    (hues, levels) = color_table()
+    shift = 8 - COLOR_BITS
+    if hasattr(colors, 'dtype') and hasattr(colors, 'astype'):
+        import numpy
+        rgb = numpy.clip(colors, 0, 255).astype(numpy.intp) >> shift
+        index = (rgb[..., 0] << (2 * COLOR_BITS)) | (rgb[..., 1] << COLOR_BITS) | rgb[..., 2]
+        return (numpy.frombuffer(hues, dtype=numpy.uint8)[index],
+                numpy.frombuffer(levels, dtype=numpy.uint8)[index])
+    if isinstance(colors, (bytes, bytearray, memoryview)):
+        data = bytes(colors)
+        if len(data) % 3:
+            raise ValueError('Packed RGB colors need 3 bytes per color')
+        indexes = [color_index(r, g, b) for (r, g, b) in zip(data[0::3], data[1::3], data[2::3])]
+    else:
+        indexes = [color_index(*parse_rgb(c)) for c in colors]
+    return (bytes(hues[i] for i in indexes), bytes(levels[i] for i in indexes))
+
+# parameter names of the group methods, by (class, method name), see apply2grps
+_parameters = dict()
+
+def parameters(grp, fn):
+    """ return the names of the parameters of member function \"fn\" of \"grp\" (cached per class) """
+    key = (type(grp), fn)
+    names = _parameters.get(key)
+    if names is None:
+        names = tuple(inspect.signature(getattr(grp, fn)).parameters)
+        _parameters[key] = names
+    return names
+
+def gather(futures):
+    """ return a Future which is done when all \"futures\" are done (or cancelled), its result
+    is the list of their results (None for the ones that were cancelled) """
+    future = Future()
+    futures = [f for f in futures if isinstance(f, Future)]
+    if not futures:
+        future.set_result([])
+        return future
+    remaining = [len(futures)]
+    lock = Lock()
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            last = (remaining[0] == 0)
+        if last:
+            future.set_result([None if f.cancelled() else f.result() for f in futures])
+    for f in futures:
+        f.add_done_callback(done)
+    return future
+
+def apply2grps(grps, fn, delay=0, args=None, fanout=False):
     """ Call member function \"fn\" on each Group object in \"grps\" (in order)
 with arguments \"args\", and with a pause of \"delay\" seconds in between each call. 
 E.g: apply2grps([grp1,grp2,grp3],\"increase_brightness\",1,[10,5,None,None,True])
 If args contains a value for \"when\" then the delay will be consecutively added to 
-this time. """
+this time. If \"fanout\" is True all calls are scheduled up front (as a Scene, and with
+interleave=True if \"fn\" takes it) instead of one after the other, so different bridges
+send in parallel and this returns straight away.
+Returns a future which is done when all calls are done (see gather). """
     if args is None:
         args = []
     if type(args) in [tuple, list]:
-        args = dict(zip(inspect.getargspec(getattr(grps[0], fn)).args, args))
+        args = dict(zip(parameters(grps[0], fn), args))
+    else:
+        args = dict(args)
     if 'when' in args:
         exectime = args.pop('when')
         if exectime is None:
             exectime = time.time()
     else:
         exectime = time.time()
-    for grp in grps:
-        grpfn = getattr(grp, fn)
-        args['when'] = exectime
-        grpfn(**args)
-        exectime = exectime + delay
-
+    def call_all():
+        futures = list()
+        when = exectime
+        for grp in grps:
+            grpfn = getattr(grp, fn)
+            grpargs = dict(args)
+            grpargs['when'] = when
+            if fanout and ('interleave' not in args) and ('interleave' in parameters(grp, fn)):
+                grpargs['interleave'] = True
+            futures.append(grpfn(**grpargs))
+            when = when + delay
+        return futures
+    if fanout:
+        with Scene():
+            futures = call_all()
+    else:
+        futures = call_all()
+    return gather(futures)
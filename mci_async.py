@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+""" MiLight Control Interface, asyncio engine
+
+Awaitable versions of the ColorGroup and WhiteGroup API's. Commands are sent from the
+asyncio event loop (using a datagram endpoint and loop.call_at for the pacing) instead
+of a dispatch thread, so no call ever blocks the event loop.
+"""
+
+import asyncio
+import time
+import weakref
+
+import mci
+
+class AsyncBridge(mci.Bridge):
+    """ A WIFI bridge driven by an asyncio event loop
+
+    Bridges are shared between all async groups that use the same (ip_address, port)
+    from the same event loop, use AsyncBridge.get to obtain one. The commands are paced
+    by the same scheduler as Bridge, but sent from loop.call_at timers.
+    """
+    # static registry of bridges, per event loop keyed by (ip_address, port)
+    _bridges = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def get(cls, ip_address, port=8899, pause=0.1, loop=None):
+        """ Return the bridge at (ip_address, port) for \"loop\" (default: the running loop) """
+        if loop is None:
+            loop = asyncio.get_running_loop()
+        with cls._bridges_lock:
+            bridges = cls._bridges.setdefault(loop, dict())
+            bridge = bridges.get((ip_address, port))
+            if bridge is None:
+                bridge = cls(ip_address, port, pause, loop)
+                bridges[(ip_address, port)] = bridge
+        return bridge
+
+    @classmethod
+    def bridges(cls):
+        """ return all known bridges """
+        with cls._bridges_lock:
+            return [b for bridges in cls._bridges.values() for b in bridges.values()]
+
+    def __init__(self, ip_address, port=8899, pause=0.1, loop=None):
+        """ init """
+        if loop is None:
+            loop = asyncio.get_running_loop()
+        self.loop = loop
+        self.transport = None
+        self._connect = None
+        self._timer = None
+        self._closed = False
+        super().__init__(ip_address, port, pause)
+
+    def open(self):
+        """ The datagram endpoint is opened by start """
+        return None
+
+    def start(self):
+        """ Open the datagram endpoint (if it isn't open already, and the bridge hasn't been closed) """
+        if (self.transport is None) and (self._connect is None) and not self._closed:
+            self._connect = self.loop.create_task(self._open())
+
+    async def _open(self):
+        """ Open the datagram endpoint and start sending the queued commands. If it can't be
+        opened the queued commands are cancelled, the next command tries again. """
+        try:
+            transport, _ = await self.loop.create_datagram_endpoint(
+                asyncio.DatagramProtocol, remote_addr=(self.ip_address, self.port))
+        except Exception:
+            # e.g. an invalid address
+            self.scheduler.clear()
+            return
+        finally:
+            self._connect = None
+        if self._closed:
+            transport.close()
+            return
+        self.transport = transport
+        self._reschedule()
+
+    def close(self):
+        """ Close the datagram endpoint for good, queued commands are not sent """
+        self._closed = True
+        if self._connect is not None:
+            self._connect.cancel()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        self._connect = None
+        # the groups get a new bridge for the commands after this
+        with self._bridges_lock:
+            bridges = self._bridges.get(self.loop, dict())
+            if bridges.get((self.ip_address, self.port)) is self:
+                del bridges[(self.ip_address, self.port)]
+
+    def send(self, packet):
+        """ Send a single packet to the bridge (no pacing) """
+        self.transport.sendto(packet)
+
+    def wakeup(self):
+        """ Called when a new command becomes the first one due """
+        self.loop.call_soon_threadsafe(self._reschedule)
+
+    def _reschedule(self):
+        """ Set the timer for the next packet """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._closed:
+            return
+        if self.transport is None:
+            self.start()
+            return
+        due = self.next_due()
+        if due is not None:
+            self._timer = self.loop.call_at(self.loop.time() + (due - time.monotonic()), self._dispatch)
+
+    def _dispatch(self):
+        """ Send the packet that is due """
+        self._timer = None
+        self.dispatch()
+        self._reschedule()
+
+class AsyncGroup(object):
+    """ Common functions for async bulb/strip groups
+
+    All actions return an awaitable which is done when the commands of that call have
+    been sent (or straight away if \"interleave\" is True), and cancelled when they are
+    dropped by empty_queue or cancel. Cancelling it cancels the commands of that call.
+    """
+    def get_bridge(self):
+        bridge = AsyncBridge.get(self.ip_address, self.port, self.pause)
+        if self.cache and (bridge.cache is None):
+            bridge.enable_cache(shared=(self.cache == 'shared'))
+        return bridge
+    bridge = property(get_bridge)
+    def get_finished(self):
+        return self.bridge.finished
+    finished = property(get_finished)
+    def get_queue(self):
+        return self.bridge.scheduler
+    queue = property(get_queue)
+
+    def __init__(self, ip_address, port=8899, pause=0.1, group=None, cache=False):
+        """ init """
+        self.ip_address = mci.resolve_bridge(ip_address)
+        self.port = port
+        if pause <= 0:
+            pause = 0.1
+        self.pause = pause
+        if str(group) in ['1', '2', '3', '4']:
+            self.group = str(group)
+        else:
+            self.group = 'ALL'
+        self.cache = cache
+
+    def new_future(self):
+        """ return a new future (of the event loop) for the result of an action """
+        return self.bridge.loop.create_future()
+
+    def wait_for(self, future):
+        """ Nothing to wait for, the caller awaits the future """
+
+    def _call_at(self, when, fn):
+        """ Call \"fn\" at (epoch) time \"when\" (or now), returns an awaitable for its result """
+        loop = self.bridge.loop
+        future = loop.create_future()
+        def call():
+            if not future.cancelled():
+                future.set_result(fn())
+        if when is None:
+            call()
+        else:
+            loop.call_at(loop.time() + (when - time.time()), call)
+        return future
+
+    def empty_queue(self, when=None):
+        """ Empty the command queue (for all groups on this bridge) without executing the commands """
+        return self._call_at(when, self.queue.clear)
+
+    def cancel(self, when=None):
+        """ Cancel the queued commands of this group """
+        return self._call_at(when, lambda: self.queue.cancel_group(self.group_key()))
+
+    def send_commands(self, command, steps=1, period=None, pause=None, when=None,
+                          interleave=False, byte2=b"\x00", byte3=b"\x55", state=None,
+                          priority=None, deadline=None):
+        """ Like Group.send_commands, but returns an awaitable instead of blocking """
+        bridge = self.bridge
+        future = self.new_future()
+        plan = self.plan_commands(command, steps, period, pause, when, interleave, byte2, byte3)
+        if (not plan) or (not self.update_state(state, steps, self.state_time(plan, when))):
+            future.set_result(None)
+            return future
+        remaining = [len(plan)]
+        def done(sent):
+            remaining[0] -= 1
+            if future.done():
+                return
+            if not sent:
+                future.cancel()
+            elif remaining[0] == 0:
+                future.set_result(plan[0][1])
+        commands = self.make_commands(plan, done, state, steps, priority, deadline)
+        def cancelled(f):
+            if f.cancelled():
+                for c in commands:
+                    c.cancel()
+        future.add_done_callback(cancelled)
+        self.queue_commands(commands, when is None)
+        if interleave and not future.done():
+            future.set_result(plan[0][1])
+        return future
+
+class AsyncColorGroup(AsyncGroup, mci.ColorGroup):
+    """ A group of RGBW color bulbs/strips, controlled from asyncio """
+
+class AsyncWhiteGroup(AsyncGroup, mci.WhiteGroup):
+    """ A group of white bulbs/strips, controlled from asyncio """
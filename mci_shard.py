@@ -0,0 +1,479 @@
+#!/usr/bin/env python3
+
+""" MiLight Control Interface, sharded engine
+
+For very large installations the bridges can be split over a pool of worker processes
+(shards), each running its own Dispatcher, so the pacing of the packets doesn't suffer from
+the application code in the main process. The ColorGroup and WhiteGroup API's stay the same
+(see ShardColorGroup and ShardWhiteGroup): the commands are planned in the main process and
+sent to the shard of their bridge as compact packed records over a pipe, and the shards report
+back when each command has been sent (or dropped), together with their metrics.
+"""
+
+import json
+import math
+import multiprocessing
+import os
+import struct
+import time
+from itertools import count
+from queue import SimpleQueue
+from threading import Thread, Lock
+
+import mci
+
+# record types, main process -> shard
+BRIDGE = b'B'       # bridge index, port, pause, ip address
+PUT = b'P'          # bridge index, command id, when, deadline, priority, group, key, packet, select
+BATCH = b'L'        # bridge index, number of commands, (length, PUT record) per command
+CANCEL = b'C'       # bridge index, command id
+SEND = b'D'         # bridge index, packet (sent straight away)
+STOP = b'S'         # (nothing)
+# record types, shard -> main process
+RESULT = b'R'       # command id, sent, time
+METRICS = b'M'      # json list of the metrics snapshots of the bridges
+
+BRIDGE_RECORD = struct.Struct('<cHHd')
+PUT_RECORD = struct.Struct('<cHIddhBBBBB')
+CANCEL_RECORD = struct.Struct('<cHI')
+BATCH_RECORD = struct.Struct('<cHI')
+LENGTH = struct.Struct('<H')
+SEND_RECORD = struct.Struct('<cH')
+RESULT_RECORD = struct.Struct('<cIBd')
+
+KINDS = ('RGBW', 'WHITE')
+GROUPS = ('ALL', '1', '2', '3', '4')
+NONE = 255
+
+def pack_put(bridge, ident, command):
+    """ return the PUT record for \"command\" (a mci.Command) """
+    if command.group is None:
+        (kind, group) = (NONE, NONE)
+    else:
+        (kind, group) = (KINDS.index(command.group[0]), GROUPS.index(command.group[1]))
+    key = (command.key or '').encode('utf-8')
+    select = command.select or b''
+    deadline = math.nan if command.deadline is None else command.deadline
+    return (PUT_RECORD.pack(PUT, bridge, ident, command.when, deadline, command.priority, kind, group,
+                            len(key), len(command.packet), len(select)) + key + command.packet + select)
+
+def unpack_put(data):
+    """ return the (bridge, command id, mci.Command) of PUT record \"data\" """
+    (_, bridge, ident, when, deadline, priority, kind, group, nkey, npacket, nselect) = PUT_RECORD.unpack_from(data)
+    offset = PUT_RECORD.size
+    key = data[offset:offset + nkey].decode('utf-8') or None
+    offset += nkey
+    packet = data[offset:offset + npacket]
+    offset += npacket
+    select = data[offset:offset + nselect] or None
+    group = None if kind == NONE else (KINDS[kind], GROUPS[group])
+    deadline = None if math.isnan(deadline) else deadline
+    return (bridge, ident, mci.Command(when, packet, select, group, None, key, priority, deadline))
+
+def writer(conn, outbox):
+    """ Send the records put in \"outbox\" through the pipe \"conn\", until None is put (thread).
+    The records are written by this thread only, so no lock is held while a write blocks. """
+    while True:
+        data = outbox.get()
+        if data is None:
+            return
+        try:
+            conn.send_bytes(data)
+        except OSError:
+            return  # the other end has gone
+
+def pack_batch(bridge, idents, commands):
+    """ return the BATCH record for \"commands\" (mci.Commands) with ids \"idents\" """
+    records = [BATCH_RECORD.pack(BATCH, bridge, len(commands))]
+    for (ident, command) in zip(idents, commands):
+        record = pack_put(bridge, ident, command)
+        records.append(LENGTH.pack(len(record)))
+        records.append(record)
+    return b"".join(records)
+
+def unpack_batch(data):
+    """ return the (bridge, [(command id, mci.Command)]) of BATCH record \"data\" """
+    (_, bridge, n) = BATCH_RECORD.unpack_from(data)
+    offset = BATCH_RECORD.size
+    commands = list()
+    for _ in range(n):
+        (length,) = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        (_, ident, command) = unpack_put(data[offset:offset + length])
+        offset += length
+        commands.append((ident, command))
+    return (bridge, commands)
+
+def shard_main(conn, metrics_interval=1.0):
+    """ Main of a shard process: run the bridges sent through the pipe \"conn\" """
+    mci.Dispatcher.install()
+    bridges = dict()
+    commands = dict()
+    lock = Lock()
+    outbox = SimpleQueue()
+    sender = Thread(target=writer, args=(conn, outbox), daemon=True)
+    sender.start()
+    reply = outbox.put
+    def result(ident):
+        def done(sent):
+            with lock:
+                commands.pop(ident, None)
+            reply(RESULT_RECORD.pack(RESULT, ident, sent, time.monotonic()))
+        return done
+    def report():
+        while True:
+            time.sleep(metrics_interval)
+            with lock:
+                snapshots = [bridge.metrics.snapshot() for bridge in bridges.values()]
+            reply(METRICS + json.dumps(snapshots).encode('utf-8'))
+    if metrics_interval:
+        Thread(target=report, daemon=True).start()
+    while True:
+        try:
+            data = conn.recv_bytes()
+        except (EOFError, OSError):
+            return
+        op = data[:1]
+        if op == STOP:
+            outbox.put(None)
+            sender.join(1)
+            conn.close()
+            return
+        if op == PUT:
+            (index, ident, command) = unpack_put(data)
+            command.done = result(ident)
+            with lock:
+                commands[ident] = command
+            bridges[index].put_command(command)
+        elif op == BATCH:
+            (index, batch) = unpack_batch(data)
+            for (ident, command) in batch:
+                command.done = result(ident)
+            with lock:
+                commands.update(batch)
+            # merged into the queue in one operation
+            bridges[index].put_commands([command for (_, command) in batch])
+        elif op == CANCEL:
+            (_, index, ident) = CANCEL_RECORD.unpack_from(data)
+            with lock:
+                command = commands.get(ident)
+            if command is not None:
+                command.cancel()
+        elif op == SEND:
+            (_, index) = SEND_RECORD.unpack_from(data)
+            bridges[index].send(data[SEND_RECORD.size:])
+        elif op == BRIDGE:
+            (_, index, port, pause) = BRIDGE_RECORD.unpack_from(data)
+            bridge = mci.Bridge.get(data[BRIDGE_RECORD.size:].decode('utf-8'), port, pause)
+            bridge.enable_metrics()
+            with lock:
+                bridges[index] = bridge
+
+class Shard(object):
+    """ A worker process which sends the packets of some of the bridges """
+    def __init__(self, number, context, metrics_interval=1.0):
+        """ init """
+        self.number = number
+        (self.conn, child) = context.Pipe()
+        self.process = context.Process(target=shard_main, args=(child, metrics_interval), daemon=True,
+                                       name='milight-shard-%d' % number)
+        self.process.start()
+        child.close()
+        self.lock = Lock()
+        # records to send to the shard, written by the writer thread
+        self.outbox = SimpleQueue()
+        self.writer = Thread(target=writer, args=(self.conn, self.outbox), daemon=True,
+                             name='milight-shard-%d-writer' % number)
+        self.writer.start()
+        # commands that haven't been sent yet, by id
+        self.commands = dict()
+        self._ids = count()
+        self._bridges = count()
+        # latest metrics snapshots of the bridges of this shard
+        self.metrics = list()
+        self.reader = Thread(target=self.read, daemon=True, name='milight-shard-%d-reader' % number)
+        self.reader.start()
+
+    def send(self, data):
+        """ Send a record to the shard (it is written by the writer thread, this never blocks) """
+        self.outbox.put(data)
+
+    def add_bridge(self, bridge):
+        """ return the index of \"bridge\" (a ShardBridge) in this shard """
+        index = next(self._bridges)
+        self.send(BRIDGE_RECORD.pack(BRIDGE, index, bridge.port, bridge.pause) + bridge.ip_address.encode('utf-8'))
+        return index
+
+    def put(self, bridge, command):
+        """ Send \"command\" to the shard, to be sent by the bridge with index \"bridge\" """
+        ident = next(self._ids)
+        with self.lock:
+            self.commands[ident] = command
+        self.send(pack_put(bridge, ident, command))
+        return ident
+
+    def put_many(self, bridge, commands):
+        """ Send \"commands\" to the shard as one record, returns their ids """
+        idents = [next(self._ids) for _ in commands]
+        with self.lock:
+            self.commands.update(zip(idents, commands))
+        self.send(pack_batch(bridge, idents, commands))
+        return idents
+
+    def cancel(self, bridge, ident):
+        """ Cancel command \"ident\" """
+        with self.lock:
+            self.commands.pop(ident, None)
+        self.send(CANCEL_RECORD.pack(CANCEL, bridge, ident))
+
+    def send_packet(self, bridge, packet):
+        """ Let the bridge with index \"bridge\" send \"packet\" straight away (no pacing) """
+        self.send(SEND_RECORD.pack(SEND, bridge) + packet)
+
+    def read(self):
+        """ Receive the results and metrics from the shard """
+        while True:
+            try:
+                data = self.conn.recv_bytes()
+            except (EOFError, OSError):
+                return
+            op = data[:1]
+            if op == RESULT:
+                (_, ident, sent, when) = RESULT_RECORD.unpack_from(data)
+                with self.lock:
+                    command = self.commands.pop(ident, None)
+                scheduler = None if command is None else command.scheduler
+                if scheduler is not None:
+                    scheduler.finish(command, bool(sent), when)
+            elif op == METRICS:
+                self.metrics = json.loads(data[1:].decode('utf-8'))
+
+    def close(self):
+        """ Stop the shard process """
+        self.send(STOP)
+        self.outbox.put(None)
+        self.writer.join(1)
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.reader.join(1)
+        self.conn.close()
+
+class ShardPool(object):
+    """ A pool of shards (worker processes), bridges are spread over them as they are created
+
+    - shards: number of worker processes (default: the number of cpus)
+    - metrics_interval: seconds between the metrics reports of the shards (0: none)
+    """
+    _default = None
+
+    @classmethod
+    def default(cls):
+        """ return the default pool (it is created when it is first used) """
+        if cls._default is None:
+            cls._default = cls()
+        return cls._default
+
+    def __init__(self, shards=None, metrics_interval=1.0):
+        """ init """
+        if shards is None:
+            shards = os.cpu_count() or 1
+        # spawn, forking a process with threads isn't safe
+        context = multiprocessing.get_context('spawn')
+        self.shards = [Shard(i, context, metrics_interval) for i in range(shards)]
+        self._next = count()
+        self.lock = Lock()
+
+    def shard(self):
+        """ return the shard for a new bridge """
+        with self.lock:
+            return self.shards[next(self._next) % len(self.shards)]
+
+    def metrics(self):
+        """ return the latest metrics of each shard: a list of {'shard': number, 'bridges': snapshots} """
+        return [{'shard': shard.number, 'bridges': shard.metrics} for shard in self.shards]
+
+    def close(self):
+        """ Stop all shards, queued commands are not sent """
+        for shard in self.shards:
+            shard.close()
+
+class ShardScheduler(mci.Scheduler):
+    """ The queue of a ShardBridge: the commands are queued in the shard """
+    def __init__(self, bridge):
+        """ init """
+        super().__init__()
+        self.bridge = bridge
+        self.commands = dict()
+
+    def put(self, command):
+        """ Send \"command\" to the shard, see Scheduler.put for the overflow policies """
+        shed = None
+        with self.lock:
+            if command.cancelled:
+                return
+            if self.maxsize and (self._size >= self.maxsize):
+                shed = self._overflow(command)
+                self._remove(shed, dropped=False)
+                self.shed += 1
+            command.scheduler = self
+            self._size += 1
+            bridge = self.bridge
+            # the id of the command in the shard
+            command.seq = bridge.shard.put(bridge.index, command)
+            self.commands[command.seq] = command
+        if shed is not None:
+            self.bridge.shard.cancel(self.bridge.index, shed.seq)
+            shed.finish(False)
+
+    def put_many(self, commands):
+        """ Send all \"commands\" to the shard in one record (see put for the overflow policies) """
+        with self.lock:
+            commands = [c for c in commands if not c.cancelled]
+            if self.maxsize:
+                for command in commands:
+                    self.put(command)
+                return len(commands)
+            if not commands:
+                return 0
+            bridge = self.bridge
+            for (command, ident) in zip(commands, bridge.shard.put_many(bridge.index, commands)):
+                command.seq = ident
+                command.scheduler = self
+                self.commands[ident] = command
+            self._size += len(commands)
+        return len(commands)
+
+    def replace(self, command, packet, selected=False):
+        """ Commands that have been passed to the shard can't be changed """
+        return False
+
+    def queued(self):
+        """ return the commands that haven't been sent yet """
+        with self.lock:
+            return list(self.commands.values())
+
+    def cancel(self, command):
+        """ Cancel \"command\", returns False if it isn't queued (or has been sent already) """
+        with self.lock:
+            if command.scheduler is not self:
+                return False
+            self._remove(command)
+        self.bridge.shard.cancel(self.bridge.index, command.seq)
+        command.finish(False)
+        return True
+
+    def _remove(self, command, dropped=True):
+        """ Take queued \"command\" back from the shard (with the lock held), see Scheduler._remove """
+        del self.commands[command.seq]
+        command.scheduler = None
+        command.cancelled = True
+        self._size -= 1
+        if dropped:
+            self.dropped += 1
+
+    def finish(self, command, sent, when):
+        """ Called when the shard has sent (or dropped) \"command\" at (monotonic) time \"when\" """
+        bridge = self.bridge
+        with self.lock:
+            if command.scheduler is not self:
+                return
+            if sent:
+                del self.commands[command.seq]
+                command.scheduler = None
+                self._size -= 1
+                cache = bridge.cache
+                if cache is not None:
+                    cache.sync(bridge)
+                bridge.last_command_time = when
+                bridge.track(command.packet)
+                if cache is not None:
+                    cache.sent(bridge)
+            elif (command.deadline is not None) and (when > command.deadline):
+                # the shard dropped it because its deadline had passed
+                self._remove(command, dropped=False)
+                self.expired += 1
+            else:
+                # e.g. the packet couldn't be sent
+                self._remove(command)
+            if self._size == 0:
+                bridge.finished = True
+        command.finish(sent)
+
+class ShardBridge(mci.Bridge):
+    """ A WIFI bridge whose packets are sent by a shard (worker process)
+
+    Bridges are shared between all shard groups that use the same (ip_address, port), use
+    ShardBridge.get to obtain one. The pacing, priorities and deadlines are applied in the
+    shard, the queue limits (see limit_queue) and the state cache in the main process.
+    """
+    # static registry of bridges, keyed by (ip_address, port)
+    _bridges = dict()
+    _bridges_lock = Lock()
+    default_dispatcher = None
+
+    @classmethod
+    def get(cls, ip_address, port=8899, pause=0.1, pool=None):
+        """ Return the bridge at (ip_address, port), create it (in a shard of \"pool\", default: the
+        default ShardPool) if it doesn't exist yet """
+        key = (ip_address, port)
+        with cls._bridges_lock:
+            bridge = cls._bridges.get(key)
+            if bridge is None:
+                bridge = cls(ip_address, port, pause, pool)
+                cls._bridges[key] = bridge
+        return bridge
+
+    def __init__(self, ip_address, port=8899, pause=0.1, pool=None):
+        """ init """
+        if pool is None:
+            pool = ShardPool.default()
+        self.pool = pool
+        self.shard = pool.shard()
+        self.index = None
+        super().__init__(ip_address, port, pause)
+        self.scheduler = ShardScheduler(self)
+        self._wakeup = None
+        self.index = self.shard.add_bridge(self)
+
+    def open(self):
+        """ The packets are sent by the shard """
+        return None
+
+    def start(self):
+        """ The shard process is started by the pool """
+
+    def wakeup(self):
+        """ The shard is told about new commands by the records themselves """
+
+    def put_command(self, command):
+        """ Send the Command \"command\" to the shard, raises queue.Full if it is rejected (see limit_queue) """
+        self.finished = False
+        self.scheduler.put(command)
+
+    def send(self, packet):
+        """ Send a single packet to the bridge (no pacing), through the shard """
+        self.shard.send_packet(self.index, packet)
+
+class ShardGroup(object):
+    """ Common functions for bulb/strip groups whose bridge is handled by a shard """
+    def __init__(self, ip_address, port=8899, pause=0.1, group=None, cache=False, pool=None):
+        """ init, see Group, \"pool\" is the ShardPool (default: the default pool) """
+        self.ip_address = mci.resolve_bridge(ip_address)
+        self.port = port
+        if pause <= 0:
+            pause = 0.1
+        self.pause = pause
+        if str(group) in ['1', '2', '3', '4']:
+            self.group = str(group)
+        else:
+            self.group = 'ALL'
+        self.bridge = ShardBridge.get(self.ip_address, port, pause, pool)
+        if cache:
+            self.bridge.enable_cache(shared=(cache == 'shared'))
+
+class ShardColorGroup(ShardGroup, mci.ColorGroup):
+    """ A group of RGBW color bulbs/strips, sent by a shard """
+
+class ShardWhiteGroup(ShardGroup, mci.WhiteGroup):
+    """ A group of white bulbs/strips, sent by a shard """
@@ -0,0 +1,580 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" MiLight Control Interface, shows
+
+A show is a file of fixed-size records, sorted by time: the time offset (in seconds from the
+start of the show), the bridge (an index in the table of bridges after the header), the
+(kind, group) the command is sent to, the opcode and its value (byte2). Shows are recorded
+from the live traffic of the bridges (ShowRecorder), or compiled from a script (ShowWriter,
+compile_script). They are played back (ShowPlayer) straight from a memory-mapped file: the
+records are read and queued only a little ahead of the time they are due, so a show of hours
+starts instantly and plays in constant memory, and the playback can seek to any time.
+
+    mci_show.py compile show.txt show.bin
+    mci_show.py play show.bin --seek 60
+"""
+
+import argparse
+import bisect
+import heapq
+import mmap
+import os
+import struct
+import time
+from collections import deque
+from concurrent.futures import Future
+from queue import Full
+from threading import Thread, Lock, Condition
+
+import mci
+
+MAGIC = b"MSHW"
+VERSION = 1
+# magic, version, number of bridges, number of records, duration (seconds)
+HEADER = struct.Struct('<4sHHId')
+# ip address, port, pause
+BRIDGE = struct.Struct('<48sHd')
+# time offset, bridge index, group (see GROUP_CODES), opcode, value, select opcode (0: see SELECTS)
+RECORD = struct.Struct('<dHBBBB2x')
+OFFSET = struct.Struct('<d')
+# number of records ShowWriter keeps in memory before it writes them out
+CHUNK = 4096
+
+KINDS = ('RGBW', 'WHITE')
+GROUPS = ('ALL', '1', '2', '3', '4')
+# group codes of the (kind, group) tuples, NONE for commands without a group selection
+GROUP_CODES = dict(((kind, group), 8 * k + g) for (k, kind) in enumerate(KINDS) for (g, group) in enumerate(GROUPS))
+GROUP_KEYS = dict((code, key) for (key, code) in GROUP_CODES.items())
+NONE = 255
+# the command that selects each (kind, group) on the bridge
+SELECTS = dict()
+for cls in (mci.ColorGroup, mci.WhiteGroup):
+    for (group, command) in cls.GROUP_ON.items():
+        SELECTS[(cls.KIND, group)] = command + b"\x00\x55"
+del cls, group, command
+
+class ShowWriter(object):
+    """ Writes a show file, the records can be added in any order (they are sorted when the
+    file is closed). Use as:
+
+        with ShowWriter('show.bin') as show:
+            bridge = show.bridge('10.0.0.60')
+            show.add(0.0, bridge, ('RGBW', '1'), mci.ColorGroup.COLOR[0], 176)
+
+    The records are written to a spool file next to the show in sorted chunks (of CHUNK
+    records), which are merged when the file is closed, so a long recording doesn't pile up
+    in memory.
+    """
+    def __init__(self, path):
+        """ init """
+        self.path = path
+        self.bridges = list()
+        # the records that haven't been written to the spool file yet
+        self.records = bytearray()
+        self.count = 0
+        self.duration = 0.0
+        self._sorted = True
+        self._spool = None
+        # the number of records of each sorted chunk in the spool file
+        self._chunks = list()
+        # number of packets that couldn't be stored (e.g. disco codes, see add_packet)
+        self.skipped = 0
+        self.lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+        return False
+
+    def bridge(self, ip_address, port=8899, pause=0.1):
+        """ return the index of bridge (ip_address, port) in the show (it is added if it's new) """
+        with self.lock:
+            for (i, (address, p, _)) in enumerate(self.bridges):
+                if (address, p) == (ip_address, port):
+                    return i
+            self.bridges.append((ip_address, port, pause))
+            return len(self.bridges) - 1
+
+    def add(self, offset, bridge, group, opcode, value=0, select=None):
+        """ Add command \"opcode\" with byte2 \"value\" for \"group\" (a (kind, group) tuple, or None
+        if the command needs no group selection) on bridge index \"bridge\", at \"offset\" seconds.
+        \"select\" is the group selection command, if it isn't the GROUP_ON command of the group """
+        code = NONE if group is None else GROUP_CODES[group]
+        select = 0 if (group is None) or (not select) or (select == SELECTS[group]) else select[0]
+        with self.lock:
+            if offset < self.duration:
+                self._sorted = False
+            else:
+                self.duration = offset
+            self.records += RECORD.pack(offset, bridge, code, opcode, value, select)
+            self.count += 1
+            if len(self.records) >= CHUNK * RECORD.size:
+                self._write_chunk()
+
+    def add_packet(self, offset, bridge, group, packet, select=None):
+        """ Add \"packet\" (see add), returns False if it can't be stored in a record: only single
+        commands (3 bytes, ending with 0x55) can, not sequences like the disco codes """
+        if (len(packet) != 3) or (packet[2] != 0x55):
+            self.skipped += 1
+            return False
+        self.add(offset, bridge, group, packet[0], packet[1], select)
+        return True
+
+    def add_schedule(self, bridge, timestamps, groups, opcodes, values=None, kind='RGBW'):
+        """ Add the columns of a schedule (see Group.send_schedule) for groups of \"kind\" """
+        if values is None:
+            values = [0] * len(timestamps)
+        for (offset, group, opcode, value) in zip(timestamps, groups, opcodes, values):
+            number = str(group) if str(group) in GROUPS[1:] else 'ALL'
+            self.add(offset, bridge, (kind, number), opcode, value)
+
+    def _write_chunk(self):
+        """ Sort the records in memory and write them to the spool file (with the lock held) """
+        records = self.records
+        count = len(records) // RECORD.size
+        if not count:
+            return
+        if not self._sorted:
+            records = b"".join(sorted((records[i:i + RECORD.size] for i in range(0, len(records), RECORD.size)),
+                                      key=lambda r: OFFSET.unpack_from(r)[0]))
+        if self._spool is None:
+            self._spool = open(self.path + '.records.%d' % os.getpid(), 'w+b')
+        self._spool.write(records)
+        self._spool.flush()
+        self._chunks.append(count)
+        self.records = bytearray()
+
+    def _merged(self):
+        """ Generate the records of the spool file, merged in order of their offsets """
+        self._spool.seek(0)
+        if self._sorted:
+            while True:
+                data = self._spool.read(CHUNK * RECORD.size)
+                if not data:
+                    return
+                yield data
+        with mmap.mmap(self._spool.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            def chunk(start, count):
+                for i in range(start, start + count * RECORD.size, RECORD.size):
+                    yield (OFFSET.unpack_from(data, i)[0], i)
+            chunks = list()
+            start = 0
+            for count in self._chunks:
+                chunks.append(chunk(start, count))
+                start += count * RECORD.size
+            for (_, i) in heapq.merge(*chunks, key=lambda r: r[0]):
+                yield data[i:i + RECORD.size]
+
+    def close(self):
+        """ Write the file """
+        with self.lock:
+            self._write_chunk()
+            tmp = self.path + '.%d' % os.getpid()
+            with open(tmp, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION, len(self.bridges), self.count, self.duration))
+                for (ip_address, port, pause) in self.bridges:
+                    f.write(BRIDGE.pack(ip_address.encode('utf-8'), port, pause))
+                if self._spool is not None:
+                    for records in self._merged():
+                        f.write(records)
+            self._remove_spool()
+            os.replace(tmp, self.path)
+
+    def discard(self):
+        """ Drop the records, the show isn't written """
+        with self.lock:
+            self._remove_spool()
+            self.records = bytearray()
+
+    def _remove_spool(self):
+        """ Close and remove the spool file (with the lock held) """
+        if self._spool is not None:
+            self._spool.close()
+            os.remove(self._spool.name)
+            self._spool = None
+        self._chunks = list()
+
+class ShowRecorder(object):
+    """ Records the commands sent to \"bridges\" (default: all bridges at the time the recording
+    starts) into the show file at \"path\", at the time they were scheduled. The group selections
+    are not recorded as commands, the bridges send them again when the show is played. """
+    def __init__(self, path, bridges=None):
+        """ init """
+        self.writer = ShowWriter(path)
+        self.bridges = bridges
+        self.start_time = None
+        # the bridges whose metrics were enabled for the recording
+        self._enabled = list()
+        # the hook (one bound method, so remove_hook finds it)
+        self._hook = self.record
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def start(self):
+        """ Start recording (the metrics of the bridges are enabled, see Bridge.enable_metrics) """
+        if self.bridges is None:
+            self.bridges = mci.Bridge.bridges()
+        self.start_time = time.monotonic()
+        for bridge in self.bridges:
+            self.writer.bridge(bridge.ip_address, bridge.port, bridge.pause)
+            if bridge.metrics is None:
+                self._enabled.append(bridge)
+            bridge.enable_metrics().add_hook(self._hook)
+        return self
+
+    def record(self, bridge, packet, command, now):
+        """ Metrics hook: record \"packet\" of \"command\" (None for a group selection) """
+        if command is None:
+            return
+        index = self.writer.bridge(bridge.ip_address, bridge.port, bridge.pause)
+        self.writer.add_packet(max(0.0, command.when - self.start_time), index, command.group, packet,
+                               command.select)
+
+    def stop(self):
+        """ Stop recording and write the file, the metrics that were enabled by start are disabled """
+        for bridge in self.bridges:
+            if bridge.metrics is not None:
+                bridge.metrics.remove_hook(self._hook)
+        for bridge in self._enabled:
+            bridge.enable_metrics(False)
+        self._enabled = list()
+        self.writer.close()
+
+class Show(object):
+    """ A show file, memory-mapped (see ShowWriter for the format) """
+    def __init__(self, path):
+        """ init """
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, nbridges, self.count, self.duration) = HEADER.unpack_from(self.map)
+        if (magic != MAGIC) or (version != VERSION):
+            self.map.close()
+            raise ValueError('Not a (version %d) show file: %s' % (VERSION, path))
+        self.bridges = list()
+        for i in range(nbridges):
+            (address, port, pause) = BRIDGE.unpack_from(self.map, HEADER.size + i * BRIDGE.size)
+            self.bridges.append((address.rstrip(b"\x00").decode('utf-8'), port, pause))
+        self.start = HEADER.size + nbridges * BRIDGE.size
+        self.offsets = Offsets(self)
+
+    def close(self):
+        self.map.close()
+
+    def __len__(self):
+        return self.count
+
+    def record(self, i):
+        """ return record \"i\" as (offset, bridge index, group, opcode, value, select), where group
+        is a (kind, group) tuple or None and select the group selection command (or None) """
+        (offset, bridge, code, opcode, value, select) = RECORD.unpack_from(self.map, self.start + i * RECORD.size)
+        group = GROUP_KEYS.get(code)
+        if group is None:
+            select = None
+        elif select:
+            select = bytes((select, 0, 0x55))
+        else:
+            select = SELECTS[group]
+        return (offset, bridge, group, opcode, value, select)
+
+    def offset(self, i):
+        """ return the time offset of record \"i\" """
+        return OFFSET.unpack_from(self.map, self.start + i * RECORD.size)[0]
+
+    def find(self, offset):
+        """ return the index of the first record at or after time \"offset\" (binary search) """
+        return bisect.bisect_left(self.offsets, offset)
+
+class Offsets(object):
+    """ The time offsets of the records of a Show, as a sequence (for bisect) """
+    def __init__(self, show):
+        """ init """
+        self.show = show
+
+    def __len__(self):
+        return self.show.count
+
+    def __getitem__(self, i):
+        return self.show.offset(i)
+
+class ShowPlayer(object):
+    """ Plays a Show (or the show file at \"show\"), on the bridges in the show (or on \"bridges\",
+    a list of Bridge objects in the order of the table of the show). The commands are queued
+    \"lookahead\" seconds before they are due, so only those are kept in memory. """
+    def __init__(self, show, bridges=None, lookahead=1.0):
+        """ init """
+        if not isinstance(show, Show):
+            show = Show(show)
+        self.show = show
+        if bridges is None:
+            bridges = [mci.Bridge.get(address, port, pause) for (address, port, pause) in show.bridges]
+        self.bridges = bridges
+        self.lookahead = lookahead
+        self.condition = Condition()
+        # monotonic time at which offset 0 of the show plays, and the next record to queue
+        self._base = None
+        self._index = 0
+        self._stopped = False
+        # commands that have been queued and may not have been sent yet, and the (bridge index,
+        # commands) that didn't fit in the queue of their bridge yet (see limit_queue)
+        self._queued = deque()
+        self._waiting = list()
+        self._pending = 0
+        # incremented by play, the commands of an earlier play don't count
+        self._generation = 0
+        # True until the feeder thread has queued the last record (see seek)
+        self._feeding = False
+        # number of commands sent
+        self.sent = 0
+        self.future = None
+        self.thread = Thread()
+
+    def play(self, position=0.0, when=None):
+        """ Play the show from \"position\" (seconds) at (epoch) time \"when\" (default: now).
+        Returns a future which is done (with the number of commands sent) at the end of the
+        show, or cancelled when it is stopped. """
+        self.stop()
+        with self.condition:
+            start = time.monotonic() if when is None else mci.monotonic_time(when)
+            self._base = start - position
+            self._index = self.show.find(position)
+            self._stopped = False
+            self.sent = 0
+            self._pending = 0
+            self._generation += 1
+            self.future = Future()
+        for bridge in self.bridges:
+            bridge.start()
+        with self.condition:
+            self._start_feeder()
+        return self.future
+
+    def seek(self, position):
+        """ Continue playing from \"position\" (seconds), the commands queued for the old position
+        are cancelled """
+        with self.condition:
+            self._base = time.monotonic() - position
+            self._index = self.show.find(position)
+            queued = self._take_queued()
+            self.condition.notify_all()
+            # the feeder stops when all records have been queued
+            restart = not (self._stopped or self._feeding or (self.future is None) or self.future.done())
+            thread = self.thread
+        for command in queued:
+            command.cancel()
+        if restart:
+            # let the old feeder finish first
+            thread.join()
+            with self.condition:
+                if not (self._stopped or self._feeding or self.future.done()):
+                    self._start_feeder()
+
+    def _start_feeder(self):
+        """ Start the thread that queues the records (with the lock held) """
+        self._feeding = True
+        self.thread = Thread(target=self.feed, daemon=True, name='milight-show')
+        self.thread.start()
+
+    def position(self):
+        """ return the current time in the show (seconds), or None if it isn't playing """
+        with self.condition:
+            if (self._base is None) or self._stopped:
+                return None
+            return time.monotonic() - self._base
+
+    def stop(self):
+        """ Stop playing, the queued commands are cancelled """
+        with self.condition:
+            self._stopped = True
+            queued = self._take_queued()
+            future = self.future
+            self.condition.notify_all()
+        for command in queued:
+            command.cancel()
+        if self.thread.is_alive():
+            self.thread.join()
+        if future is not None:
+            future.cancel()
+
+    def _take_queued(self):
+        """ return (and forget) the commands that haven't been sent yet (with the lock held) """
+        queued = list(self._queued)
+        self._queued.clear()
+        self._waiting = list()
+        return queued
+
+    def _put(self, bridge, commands):
+        """ Queue \"commands\" on the bridge with index \"bridge\" (with the lock held), the ones
+        that don't fit in its queue are tried again later """
+        try:
+            self.bridges[bridge].put_commands(commands)
+        except Full:
+            commands = [c for c in commands if (c.seq is None) and not c.cancelled]
+            if commands:
+                self._waiting.append((bridge, commands))
+            return False
+        return True
+
+    def done(self, generation):
+        """ return the done callback of the commands queued by play number "generation" """
+        def done(sent):
+            with self.condition:
+                if generation != self._generation:
+                    return
+                self._pending -= 1
+                if sent:
+                    self.sent += 1
+                self._finish()
+        return done
+
+    def _finish(self):
+        """ Set the result when all records have been queued and sent (with the lock held) """
+        if (self._pending == 0) and (self._index >= self.show.count) and not (self._stopped or self._waiting):
+            if not self.future.done():
+                self.future.set_result(self.sent)
+
+    def feed(self):
+        """ Queue the records of the show when they are due within the lookahead (thread) """
+        show = self.show
+        packets = mci.PACKETS
+        with self.condition:
+            done = self.done(self._generation)
+            try:
+                while not self._stopped:
+                    # the commands that didn't fit in the queue of their bridge, in the order of the show
+                    (waiting, self._waiting) = (self._waiting, list())
+                    for (bridge, commands) in waiting:
+                        self._put(bridge, commands)
+                    if (self._index >= show.count) and not self._waiting:
+                        self._finish()
+                        return
+                    batches = dict()
+                    horizon = time.monotonic() + self.lookahead
+                    base = self._base
+                    while (self._index < show.count) and (base + show.offset(self._index) <= horizon):
+                        (offset, bridge, group, opcode, value, select) = show.record(self._index)
+                        self._index += 1
+                        command = mci.Command(base + offset, packets[opcode][value], select, group, done)
+                        batches.setdefault(bridge, list()).append(command)
+                    for (bridge, commands) in batches.items():
+                        self._pending += len(commands)
+                        self._queued.extend(commands)
+                        if any(b == bridge for (b, _) in self._waiting):
+                            # after the commands of the bridge that are waiting already
+                            self._waiting.append((bridge, commands))
+                        else:
+                            self._put(bridge, commands)
+                    # forget the commands that have been sent (or cancelled)
+                    while self._queued and (self._queued[0].scheduler is None) and \
+                            ((self._queued[0].seq is not None) or self._queued[0].cancelled):
+                        self._queued.popleft()
+                    timeout = None
+                    if self._index < show.count:
+                        timeout = max(0.001, base + show.offset(self._index) - self.lookahead - time.monotonic())
+                    if self._waiting:
+                        # try again when the queues have drained a bit
+                        pause = min(self.bridges[bridge].pause for (bridge, _) in self._waiting)
+                        timeout = pause if timeout is None else min(timeout, pause)
+                    self.condition.wait(timeout)
+            finally:
+                self._feeding = False
+
+def color_value(text):
+    """ return the color code (0 to 255) for \"text\": a number, a color name or '#RRGGBB' """
+    try:
+        return max(0, min(255, int(text)))
+    except ValueError:
+        pass
+    if text.upper() in mci.ColorGroup.COLOR_CODES:
+        return mci.ColorGroup.COLOR_CODES[text.upper()][0]
+    return mci.rgb_code(text)[0]
+
+def compile_action(kind, group, action, argument=None):
+    """ return the (opcode, value) of \"action\" of a script (see compile_script) """
+    cls = mci.ColorGroup if kind == 'RGBW' else mci.WhiteGroup
+    per_group = {'on': 'GROUP_ON', 'off': 'GROUP_OFF', 'white': 'GROUP_WHITE',
+                 'brightmode': 'FULL_BRIGHTNESS', 'nightmode': 'NIGHT_MODE'}
+    simple = {'disco': 'DISCO_MODE', 'disco_faster': 'DISCO_SPEED_FASTER', 'disco_slower': 'DISCO_SPEED_SLOWER',
+              'brightness_up': 'BRIGHTNESS_UP', 'brightness_down': 'BRIGHTNESS_DOWN',
+              'warmer': 'WARM_WHITE_INCREASE', 'cooler': 'COOL_WHITE_INCREASE'}
+    if (action in per_group) and hasattr(cls, per_group[action]):
+        return (getattr(cls, per_group[action])[group][0], 0)
+    if (action in simple) and hasattr(cls, simple[action]):
+        return (getattr(cls, simple[action])[0], 0)
+    if (action == 'brightness') and (kind == 'RGBW'):
+        return (cls.BRIGHTNESS[0], max(0, min(25, int(argument))) + 2)
+    if (action == 'color') and (kind == 'RGBW'):
+        return (cls.COLOR[0], color_value(argument))
+    raise ValueError('Unknown action for ' + kind + ' groups: ' + action)
+
+def compile_script(lines, path, port=8899, pause=0.1):
+    """ Compile the script \"lines\" into the show file at \"path\", returns the number of records.
+    Each line is 'TIME ADDRESS[:PORT] KIND GROUP ACTION [ARGUMENT]', e.g. '1.5 10.0.0.60 RGBW 1
+    color #FF8000', with TIME in seconds, KIND RGBW or WHITE, GROUP 1 to 4 or ALL, and ACTION
+    one of on, off, white, brightness N, color C, disco, disco_faster, disco_slower (RGBW),
+    brightness_up, brightness_down, warmer, cooler, brightmode, nightmode (WHITE). Empty lines and
+    lines starting with '#' are skipped. """
+    with ShowWriter(path) as writer:
+        for (number, line) in enumerate(lines, 1):
+            fields = line.split()
+            if (not fields) or fields[0].startswith('#'):
+                continue
+            try:
+                (offset, address, kind, group, action) = fields[:5]
+                (address, _, bridge_port) = address.partition(':')
+                bridge = writer.bridge(address, int(bridge_port or port), pause)
+                kind = kind.upper()
+                group = group.upper() if group.upper() in GROUPS else str(int(group))
+                (opcode, value) = compile_action(kind, group, action.lower(), fields[5] if len(fields) > 5 else None)
+                writer.add(float(offset), bridge, (kind, group), opcode, value)
+            except (ValueError, KeyError, TypeError) as e:
+                raise ValueError('line %d: %s (%s)' % (number, line.strip(), e))
+    return writer.count
+
+def main():
+    """ Main. """
+    parser = argparse.ArgumentParser(description='MiLight shows')
+    commands = parser.add_subparsers(dest='command')
+    compile_parser = commands.add_parser('compile', help='Compile a script into a show file')
+    compile_parser.add_argument('script', help='The script (- for stdin), see compile_script')
+    compile_parser.add_argument('show', help='The show file to write')
+    compile_parser.add_argument('-P', '--port', type=int, default=8899, help='Port of the bridges (default: 8899)')
+    compile_parser.add_argument('-p', '--pause', type=float, default=0.1, help='Pause between packets (default: 0.1)')
+    play_parser = commands.add_parser('play', help='Play a show file')
+    play_parser.add_argument('show', help='The show file')
+    play_parser.add_argument('--seek', type=float, default=0.0, help='Start at this time in the show, in seconds')
+    info_parser = commands.add_parser('info', help='Show the bridges, records and duration of a show file')
+    info_parser.add_argument('show', help='The show file')
+    args = parser.parse_args()
+    if args.command == 'compile':
+        import sys
+        source = sys.stdin if args.script == '-' else open(args.script)
+        with source:
+            count = compile_script(source, args.show, args.port, args.pause)
+        print('%d records written to %s' % (count, args.show))
+    elif args.command == 'play':
+        player = ShowPlayer(args.show)
+        try:
+            print('%d commands sent' % player.play(args.seek).result())
+        except KeyboardInterrupt:
+            player.stop()
+    elif args.command == 'info':
+        show = Show(args.show)
+        for (address, port, pause) in show.bridges:
+            print('bridge %s:%d (pause %.3f)' % (address, port, pause))
+        print('%d records, %.3f seconds' % (show.count, show.duration))
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
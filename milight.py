@@ -3,19 +3,106 @@
 """ MiLight Commandline Interface """
 
 import argparse
-import mci
-import time
 import subprocess
+import socket
+import json
+import sys
+import os
+import re
+import shlex
+import signal
+import time
+import datetime
+from concurrent.futures import wait
 
-def main():
-    """ Main. """
-    # Parse commandline arguments
+# mci is imported when it is needed, so forwarding to a daemon stays fast
+
+# seconds to wait for the daemon to reply, before executing the actions locally
+FORWARD_TIMEOUT = 5.0
+
+def default_socket():
+    """ return the default path of the daemon's unix socket """
+    directory = os.environ.get('XDG_RUNTIME_DIR')
+    if directory:
+        return os.path.join(directory, 'milight.sock')
+    return '/tmp/milight-%d.sock' % os.getuid()
+
+# seconds per unit of a relative time in --when (e.g. "+5 seconds", "2 min ago")
+TIME_UNITS = {'s': 1, 'sec': 1, 'secs': 1, 'second': 1, 'seconds': 1,
+              'min': 60, 'mins': 60, 'minute': 60, 'minutes': 60,
+              'h': 3600, 'hour': 3600, 'hours': 3600,
+              'day': 86400, 'days': 86400, 'week': 604800, 'weeks': 604800}
+RELATIVE_TIME = re.compile(r'([+-]?)\s*(\d+(?:\.\d*)?)\s*([a-z]+)(\s+ago)?')
+CLOCK_TIME = re.compile(r'^(\d{4}-\d{2}-\d{2})?[ T]?(\d{1,2}):(\d{2})(?::(\d{2}(?:\.\d*)?))?$')
+
+def parse_when(value, now=None):
+    """ return the (epoch) time for the --when argument \"value\": '@<epoch time>', 'now',
+    a relative time like '+10 seconds', '5 min', 'now + 1 hour' or '2 hours ago', a clock
+    time 'HH:MM[:SS]' (today, or preceded by 'today' or 'tomorrow'), or a date and time
+    'YYYY-MM-DD[ HH:MM[:SS]]' (local time), like the \"date\" command reads them. Other strings
+    are passed to the \"date\" command. """
+    if now is None:
+        now = time.time()
+    text = value.strip().lower()
+    if text.startswith('@'):
+        try:
+            return float(text[1:])
+        except ValueError:
+            pass
+    # relative to now
+    rest = text[3:].strip() if text.startswith('now') else text
+    if rest == '':
+        return now
+    offset = 0.0
+    position = 0
+    for match in RELATIVE_TIME.finditer(rest):
+        if (rest[position:match.start()].strip() not in ('', '+', 'and')) or (match.group(3) not in TIME_UNITS):
+            break
+        seconds = float(match.group(2)) * TIME_UNITS[match.group(3)]
+        if (match.group(1) == '-') or match.group(4):
+            seconds = -seconds
+        offset += seconds
+        position = match.end()
+    else:
+        if (position > 0) and (rest[position:].strip() == ''):
+            return now + offset
+    # a clock time, today or tomorrow
+    day = None
+    if text.startswith('today'):
+        (day, text) = (0, text[5:].strip())
+    elif text.startswith('tomorrow'):
+        (day, text) = (1, text[8:].strip())
+    try:
+        if re.match(r'^\d{4}-\d{2}-\d{2}$', text) and (day is None):
+            return time.mktime(datetime.datetime.strptime(text, '%Y-%m-%d').timetuple())
+        match = CLOCK_TIME.match(text)
+        if match is not None:
+            (date, hours, minutes, seconds) = match.groups()
+            seconds = float(seconds or 0)
+            if date is not None:
+                start = datetime.datetime.strptime(date, '%Y-%m-%d')
+            else:
+                start = datetime.datetime.fromtimestamp(now).replace(hour=0, minute=0, second=0, microsecond=0)
+            moment = start.replace(hour=int(hours), minute=int(minutes), second=int(seconds),
+                                   microsecond=int(round((seconds % 1) * 1000000)))
+            if (date is None) and (day is not None):
+                moment += datetime.timedelta(days=day)
+            return time.mktime(moment.timetuple()) + moment.microsecond / 1000000.0
+    except ValueError:
+        pass
+    # anything else the date command understands
+    return float(subprocess.check_output(['date', '+%s', '--date', value]))
+
+def parse_args(argv=None, defaults=None):
+    """ Parse commandline arguments, \"defaults\" (a dict) overrides the default values """
     parser = argparse.ArgumentParser()
     parser.add_argument('-S', '--scan', action='store_true', dest='scan',
                         help='Search wifi bridges.', default=False, required=False)
+    parser.add_argument('--expect', action='store', dest='expect', type=int,
+                        help='Stop searching once this number of wifi bridges have responded (default: wait 5 seconds)', default=None, required=False)
 
     parser.add_argument('-i', '--ip_address', action='store', nargs='?', dest='address',
-                        help='IP address.', default='10.0.0.60', required=False, type=str)
+                        help='IP address, or mac address of a bridge (found with --scan, or searched for).', default='10.0.0.60', required=False, type=str)
     parser.add_argument('-P', '--port', action='store', nargs='?', dest='port',
                         help='Port number.', default=8899, required=False, type=int)
 
@@ -32,9 +119,8 @@ def main():
                             help='Pause between steps, in seconds (minimum=default=0.1)', default=0.1, required=False)
     parser.add_argument('-t', '--period', action='store', dest='period', type=float,
                             help='Period of time (in seconds) over which steps should be performed (default=1)', default=None, required=False)
-    # TODO: accept a time as a string for the --when argument
     parser.add_argument('-W', '--when', action='store', dest='when', default=None, required=False,
-                            help='Time at which command should be executed. Can be any string accepted by the linux "date" command (default=now)')
+                            help='Time at which command should be executed, e.g. "+10 seconds", "21:30" or "@1700000000". Can be any string accepted by the linux "date" command (default=now)')
     parser.add_argument('-I', '--interleave', action='store_true',dest='interleave', help='Dont wait for command(s) to finish, and allow interleaving with other commands.', default=False, required=False)
     parser.add_argument('--on', action='store_true', dest='action_on',
                         help='Action: ON', default=False, required=False)
@@ -46,7 +132,7 @@ def main():
     parser.add_argument('--br', action='store', nargs='?', dest='action_br',
                         help='Action (rgbw bulbs/strips only): set brightness (0 <= value <= 25)', default=None, required=False, type=int)
     parser.add_argument('--cc', action='store', nargs='?', dest='action_cc',
-                        help='Action (rgbw bulbs/strips only): set color (int: 0 <= value <= 255)', default=None, required=False)
+                        help='Action (rgbw bulbs/strips only): set color (int: 0 <= value <= 255, name or hex: #RRGGBB or RRGGBB)', default=None, required=False)
     parser.add_argument('--d', action='store_true', dest='action_d',
                         help='Action (rgbw bulbs/strips only): DISCO_MODE', default=False, required=False)
     parser.add_argument('--id', action='store_true', dest='action_id',
@@ -66,18 +152,28 @@ def main():
                         help='Action (white bulbs/strips only): BRIGHT_MODE', default=False, required=False)
     parser.add_argument('--n', action='store_true', dest='action_n',
                         help='Action (white bulbs/strips only): NIGHT_MODE', default=False, required=False)
+
+    parser.add_argument('--daemon', action='store_true', dest='daemon',
+                        help='Run as a daemon, which executes the actions of other milight.py calls (so they share the bridge pacing)', default=False, required=False)
+    parser.add_argument('--socket', action='store', dest='socket',
+                        help='Unix socket of the daemon (default: ' + default_socket() + ')', default=default_socket(), required=False)
+    parser.add_argument('--shared_state', action='store_true', dest='shared_state',
+                        help='Keep the state of the lights in a file shared with other processes, and skip commands that don\'t change it', default=False, required=False)
+    parser.add_argument('-B', '--batch', action='store', dest='batch',
+                        help='Execute the actions on each line of this file (- for stdin), e.g. "-c 1 --on" or "-w 2 -a INC_BRIGHTNESS -s 5 -W \'+2 seconds\'", in one process', default=None, required=False)
+    parser.add_argument('--local', action='store_true', dest='local',
+                        help='Execute the actions in this process, even if a daemon is running', default=False, required=False)
     parser.set_defaults(steps=1, period=None, pause=0.1, when=None)
-    args = parser.parse_args()
+    if defaults:
+        parser.set_defaults(**defaults)
+    return parser.parse_args(argv)
+
+def execute(args):
+    """ Execute the actions in \"args\", returns the futures of the commands """
+    import mci
     address = args.address
     port = args.port
 
-    # Scan for wifi bridges (to find the ip address)
-    if args.scan:
-        print('Discovering bridges')
-        dg = mci.DiscoverBridge(port=48899).discover()
-        for (addr, mac) in dg:
-            print(' - ip address :' + addr + '\tmac: ' + mac)
-
     # Set the requested actions
     action_on = args.action_on
     action_off = args.action_off
@@ -95,10 +191,6 @@ def main():
     action_dw = args.action_dw
     action_b = args.action_b
     action_n = args.action_n
-    # convert "when" argument to float if present
-    if args.when is not None:
-        args.when = float(subprocess.check_output("date +%s --date " + args.when, shell=True))
-        
     if args.action is not None:
         if args.action == 'ON':
             action_on = True
@@ -125,8 +217,9 @@ def main():
         elif args.action == 'NIGHT_MODE':
             action_n = True
         else:
-            print('Requested action invalid: ' + args.action)
+            raise ValueError('Requested action invalid: ' + args.action)
 
+    futures = list()
     # Execute action rgbw bulbs/strips
     if args.rgbw is not None:
         # Set the groupnumber
@@ -134,24 +227,26 @@ def main():
         if args.rgbw in ['1', '2', '3', '4']:
             group = int(args.rgbw)
         lc = mci.ColorGroup(address, port, group=group)
+        # set for every call, a daemon keeps the bridge (and its cache) for the calls that follow
+        lc.bridge.enable_cache(args.shared_state, shared=True)
         if action_on:
-            lc.on()
+            futures.append(lc.on())
         if action_off:
-            lc.off()
+            futures.append(lc.off())
         if action_ew:
-            lc.white()
+            futures.append(lc.white())
         if action_br is not None:
-            lc.brightness(int(action_br), when=args.when)
+            futures.append(lc.brightness(int(action_br), when=args.when))
         if action_cc is not None:
-            lc.color(action_cc, when=args.when)
+            futures.append(lc.color(action_cc, when=args.when))
         if action_d:
-            lc.disco(when=args.when)
+            futures.append(lc.disco(when=args.when))
         if action_id:
-            lc.increase_disco_speed(steps=args.steps, period=args.period, pause=args.pause,
-                                        when=args.when, interleave=args.interleave)
+            futures.append(lc.increase_disco_speed(steps=args.steps, period=args.period, pause=args.pause,
+                                        when=args.when, interleave=args.interleave))
         if action_dd:
-            lc.decrease_disco_speed(steps=args.steps, period=args.period, pause=args.pause,
-                                        when=args.when, interleave=args.interleave)
+            futures.append(lc.decrease_disco_speed(steps=args.steps, period=args.period, pause=args.pause,
+                                        when=args.when, interleave=args.interleave))
 
     # Execute action White bulbs/strips
     if args.white is not None:
@@ -160,29 +255,174 @@ def main():
         if args.white in ['1', '2', '3', '4']:
             group = int(args.white)
         lc = mci.WhiteGroup(address, port, group=group)
+        lc.bridge.enable_cache(args.shared_state, shared=True)
         if action_on:
-            lc.on()
+            futures.append(lc.on())
         if action_off:
-            lc.off()
+            futures.append(lc.off())
         if action_ib:
-            lc.increase_brightness(steps=args.steps, period=args.period, pause=args.pause,
-                                       when=args.when, interleave=args.interleave)
+            futures.append(lc.increase_brightness(steps=args.steps, period=args.period, pause=args.pause,
+                                       when=args.when, interleave=args.interleave))
         if action_db:
-            lc.decrease_brightness(steps=args.steps, period=args.period, pause=args.pause,
-                                       when=args.when, interleave=args.interleave)
+            futures.append(lc.decrease_brightness(steps=args.steps, period=args.period, pause=args.pause,
+                                       when=args.when, interleave=args.interleave))
         if action_iw:
-            lc.increase_warmth(steps=args.steps, period=args.period, pause=args.pause,
-                                   when=args.when, interleave=args.interleave)
+            futures.append(lc.increase_warmth(steps=args.steps, period=args.period, pause=args.pause,
+                                   when=args.when, interleave=args.interleave))
         if action_dw:
-            lc.decrease_warmth(steps=args.steps, period=args.period, pause=args.pause,
-                                   when=args.when, interleave=args.interleave)
+            futures.append(lc.decrease_warmth(steps=args.steps, period=args.period, pause=args.pause,
+                                   when=args.when, interleave=args.interleave))
         if action_b:
-            lc.brightmode(when=args.when)
+            futures.append(lc.brightmode(when=args.when))
         if action_n:
-            lc.nightmode(when=args.when)
+            futures.append(lc.nightmode(when=args.when))
             
-    while not lc.finished:
-        time.sleep(0.1)
+    return futures
+
+def forward(args):
+    """ Send the actions in \"args\" to the daemon, returns False if no daemon is running (or it
+    doesn't reply). Exits (with status 1) if the daemon couldn't execute them. """
+    if not hasattr(socket, 'AF_UNIX'):
+        return False
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(FORWARD_TIMEOUT)
+    try:
+        sock.connect(args.socket)
+    except OSError:
+        sock.close()
+        return False
+    with sock:
+        try:
+            sock.sendall(json.dumps(vars(args)).encode('utf-8') + b'\n')
+            reply = sock.makefile('rb').readline().decode('utf-8').strip()
+        except OSError:
+            # socket.timeout too: the daemon hangs
+            print('The daemon at ' + args.socket + ' does not reply, executing the actions locally',
+                  file=sys.stderr)
+            return False
+    if not reply:
+        return False  # the daemon stopped before replying
+    if reply != 'ok':
+        print(reply, file=sys.stderr)
+        sys.exit(1)
+    return True
+
+def serve(path):
+    """ Run as daemon: execute the actions that milight.py calls send to the unix socket \"path\" """
+    import mci
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            print('A daemon is already listening on ' + path)
+            return
+        except OSError:
+            os.unlink(path)  # left behind by a daemon that is gone
+        finally:
+            probe.close()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    os.chmod(path, 0o600)
+    server.listen(16)
+    # clean up the socket when the daemon is stopped
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            (conn, _) = server.accept()
+            with conn:
+                try:
+                    request = json.loads(conn.makefile('rb').readline().decode('utf-8'))
+                    # queue the actions without waiting for them, the bridges pace them
+                    with mci.Scene():
+                        execute(argparse.Namespace(**request))
+                    reply = 'ok'
+                except Exception as e:
+                    reply = 'error: ' + str(e)
+                try:
+                    conn.sendall(reply.encode('utf-8') + b'\n')
+                except OSError:
+                    pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.unlink(path)
+
+def run_batch(args):
+    """ Execute the actions on each line of the file (or stdin) \"args.batch\", in this process
+    (one after the other, like separate milight.py calls) or by the daemon. Lines take the
+    ip address, port and the other options that aren't actions from \"args\" as defaults,
+    empty lines and lines starting with '#' are skipped. Returns the number of failed lines. """
+    inherit = ('address', 'port', 'shared_state', 'local', 'socket')
+    defaults = dict((name, getattr(args, name)) for name in inherit)
+    forwarding = not args.local
+    futures = list()
+    failed = 0
+    source = sys.stdin if args.batch == '-' else open(args.batch)
+    with source:
+        for (number, line) in enumerate(source, 1):
+            line = line.strip()
+            if (not line) or line.startswith('#'):
+                continue
+            try:
+                line_args = parse_args(shlex.split(line), defaults)
+                if line_args.when is not None:
+                    line_args.when = parse_when(line_args.when)
+                if (line_args.rgbw is None) and (line_args.white is None):
+                    continue
+                if forwarding and forward(line_args):
+                    continue
+                forwarding = False
+                if not futures:
+                    # all bridges are driven by one thread
+                    import mci
+                    mci.Dispatcher.install()
+                futures.extend(execute(line_args))
+            except SystemExit:
+                # argparse has printed the error
+                print('line %d: %s' % (number, line), file=sys.stderr)
+                failed += 1
+            except Exception as e:
+                print('line %d: %s: %s' % (number, line, e), file=sys.stderr)
+                failed += 1
+    # wait until all the commands (including interleaved ones) have been sent
+    wait(futures)
+    return failed
+
+def main():
+    """ Main. """
+    args = parse_args()
+    if args.daemon:
+        serve(args.socket)
+        return
+
+    # Scan for wifi bridges (to find the ip address)
+    if args.scan:
+        import mci
+        print('Discovering bridges')
+        dg = mci.DiscoverBridge(port=48899).discover(expected=args.expect)
+        for (addr, mac) in dg:
+            print(' - ip address :' + addr + '\tmac: ' + mac)
+
+    # convert "when" argument to float if present
+    if args.when is not None:
+        args.when = parse_when(args.when)
+
+    if args.batch is not None:
+        if run_batch(args):
+            sys.exit(1)
+        return
+    if (args.rgbw is None) and (args.white is None):
+        return
+    if (not args.local) and forward(args):
+        return
+    try:
+        futures = execute(args)
+    except ValueError as e:
+        print('error: ' + str(e), file=sys.stderr)
+        sys.exit(1)
+    # wait until all the commands (including interleaved ones) have been sent
+    wait(futures)
 
 if __name__ == '__main__':
     main()